@@ -0,0 +1,424 @@
+import argparse
+import contextlib
+import datetime
+import glob
+import importlib.metadata
+import importlib.util
+import json
+import multiprocessing as mp
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from common.hparam_search import thread_env, limit_threads
+
+CARTPOLE_THRESHOLD = 475
+
+
+class _Stop(Exception):
+    '''
+        Raised from inside env.step to end a run: the budget is spent or the task is solved
+    '''
+
+
+class _Recorder:
+    '''
+        Counts the env steps and the episode returns of every env of the run (see _instrument_envs) and the learner
+        updates, and stops the run at the step or time budget, or once the average of the last 100 returns passes
+        the threshold. The clock starts at the first env step, so the imports and the graph building are left out
+        of the throughputs (they are the setup time).
+    '''
+
+    def __init__(self, max_steps, max_seconds, threshold=None):
+        self.max_steps, self.max_seconds, self.threshold = max_steps, max_seconds, threshold
+        self.start = None
+        self.steps = 0
+        self.updates = 0
+        self.returns = []
+        self.solved_steps = self.solved_seconds = None
+        self.stop_reason = 'completed'
+
+    def step(self, env, reward, ended):
+        if self.start is None:
+            self.start = time.perf_counter()
+        self.steps += 1
+        # steps past the end of an episode (before the reset) cost time but belong to no episode
+        if not getattr(env, '_bench_ended', False):
+            env._bench_return = getattr(env, '_bench_return', 0.0) + float(reward)
+            if ended:
+                env._bench_ended = True
+                self.returns.append(env._bench_return)
+                if self.threshold is not None and self.solved_steps is None and len(self.returns) >= 100 and \
+                        np.mean(self.returns[-100:]) > self.threshold:
+                    self.solved_steps, self.solved_seconds = self.steps, time.perf_counter() - self.start
+                    self.stop_reason = 'solved'
+                    raise _Stop()
+        if self.steps >= self.max_steps:
+            self.stop_reason = 'step_budget'
+            raise _Stop()
+        if time.perf_counter() - self.start > self.max_seconds:
+            self.stop_reason = 'time_budget'
+            raise _Stop()
+
+    @staticmethod
+    def reset(env):
+        env._bench_return, env._bench_ended = 0.0, False
+
+
+@contextlib.contextmanager
+def _patched(obj, name, value):
+    old = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, old)
+
+
+def _instrument_envs(stack, recorder):
+    '''
+        Route the steps of every gym and gymnasium env made with make() to the recorder, through their TimeLimit
+        wrapper (the sub-envs of vector envs included). Evaluation runs in common.evaluation.BatchedCartPole are
+        not counted.
+    '''
+    modules = [importlib.import_module('gym.wrappers')]
+    if importlib.util.find_spec('gymnasium') is not None:
+        modules.append(importlib.import_module('gymnasium.wrappers'))
+    for module in modules:
+        cls = module.TimeLimit
+        step, reset = cls.step, cls.reset
+
+        def counted_step(self, action, step=step):
+            result = step(self, action)
+            ended = result[2] or result[3] if len(result) == 5 else result[2]
+            recorder.step(self, result[1], ended)
+            return result
+
+        def counted_reset(self, *args, reset=reset, **kwargs):
+            recorder.reset(self)
+            return reset(self, *args, **kwargs)
+
+        stack.enter_context(_patched(cls, 'step', counted_step))
+        stack.enter_context(_patched(cls, 'reset', counted_reset))
+
+
+def _count_calls(stack, recorder, cls, name, n_updates=lambda self, result: 1):
+    '''
+        Count the learner updates of an agent through one of its methods
+    '''
+    method = getattr(cls, name)
+
+    def counted(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        recorder.updates += n_updates(self, result)
+        return result
+
+    stack.enter_context(_patched(cls, name, counted))
+
+
+def _count_tf1_updates(stack, recorder):
+    '''
+        Count the session runs that execute an operation (the optimizer steps) as the updates of a TF1 agent.
+        Forward passes only fetch tensors.
+    '''
+    import tensorflow.compat.v1 as tf
+
+    def has_op(fetches):
+        if isinstance(fetches, (list, tuple)):
+            return any(has_op(f) for f in fetches)
+        return isinstance(fetches, tf.Operation)
+
+    run = tf.Session.run
+
+    def counted(self, fetches, *args, **kwargs):
+        result = run(self, fetches, *args, **kwargs)
+        recorder.updates += has_op(fetches)
+        return result
+
+    stack.enter_context(_patched(tf.Session, 'run', counted))
+
+
+def _old_step_api(env):
+    '''
+        The gym < 0.26 API (reset returning the observation, four-value step, seed()) that ex1/DQN.py and
+        actor_critic.run are written against
+    '''
+    import gym
+
+    class OldStepAPI(gym.Wrapper):
+        _seed = None
+
+        def seed(self, seed=None):
+            self._seed = seed
+
+        def reset(self, **kwargs):
+            obs, _ = self.env.reset(seed=self._seed, **kwargs)
+            self._seed = None
+            return obs
+
+        def step(self, action):
+            obs, reward, terminated, truncated, info = self.env.step(action)
+            return obs, reward, terminated or truncated, info
+
+    return OldStepAPI(env)
+
+
+def _q1_tabular(stack, recorder, seed, batched=False):
+    sys.path.insert(0, os.path.join(ROOT, 'ex1'))
+    import q1
+    np.random.seed(seed)
+    if batched:
+        counters = {}
+        Q, returns, steps = q1.Q_learning_batched(q1.env, 0.1, 0.9, q1.n_episodes, q1.max_steps, 1.0, 0.01, 0.001,
+                                                  rng=np.random.default_rng(seed), counters=counters)
+        # BatchedFrozenLake runs in NumPy, outside of the instrumented envs
+        recorder.steps += counters['transitions']
+        recorder.returns.extend(returns)
+    else:
+        Q, returns, steps = q1.Q_learning(q1.env, 0.1, 0.9, q1.n_episodes, q1.max_steps, 1.0, 0.01, 0.001)
+    # one table update per transition
+    recorder.updates = recorder.steps
+    return {'success_rate': float(q1.success_rate(q1.env, Q, q1.max_steps))}
+
+
+def _q2_dqn(stack, recorder, seed):
+    sys.path.insert(0, os.path.join(ROOT, 'ex1'))
+    import q2
+    import torch
+    torch.manual_seed(seed)
+    _count_calls(stack, recorder, q2.DQN, 'learn_step')
+    d = q2.DQN(64, hidden_layers=[128, 128, 128], replay_buffer_memory_size=10000)
+    d.train(3000, 100000, epsilon=1, gamma=0.99, lr=0.0001, C=5)
+
+
+def _keras_dqn(stack, recorder, seed):
+    sys.path.insert(0, os.path.join(ROOT, 'ex1'))
+    import gym
+    import tensorflow as tf
+    import DQN
+    tf.random.set_seed(seed)
+    _count_calls(stack, recorder, DQN.DQN, 'learn', lambda self, losses: len(losses))
+    env = _old_step_api(gym.make('CartPole-v1'))
+    env.action_space.seed(seed)
+    DQN.DQN(env, double_dqn=True).train(10000)
+
+
+def _actor_critic(stack, recorder, seed, algorithm='actor_critic'):
+    sys.path.insert(0, os.path.join(ROOT, 'ex2'))
+    import gym
+    import actor_critic
+    actor_critic.SEED = seed
+    _count_tf1_updates(stack, recorder)
+    if algorithm == 'actor_critic':
+        make = gym.make
+        stack.enter_context(_patched(actor_critic.gym, 'make', lambda env_id: _old_step_api(make(env_id))))
+        actor_critic.run(0.99, 0.01, 0.0007)
+    elif algorithm == 'a2c':
+        actor_critic.run_a2c(0.99, 0.002, 0.002)
+    else:
+        actor_critic.run_ppo(0.99, 0.003, 0.003)
+
+
+def _reinforce(stack, recorder, seed):
+    # the file name holds right-to-left marks, so it is loaded from its path
+    path = glob.glob(os.path.join(ROOT, 'ex2', '*policy_gradients_baseline.py'))[0]
+    spec = importlib.util.spec_from_file_location('policy_gradients_baseline', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    np.random.seed(seed)
+    module.tf.set_random_seed(seed)
+    _count_tf1_updates(stack, recorder)
+    module.run()
+
+
+# name: (entry point, env steps budget, seconds budget, solve threshold)
+AGENTS = {
+    'q1_tabular': (_q1_tabular, 10 ** 7, 600, None),
+    'q1_tabular_batched': (lambda *args: _q1_tabular(*args, batched=True), 10 ** 7, 600, None),
+    'q2_dqn': (_q2_dqn, 300000, 1800, CARTPOLE_THRESHOLD),
+    'keras_dqn': (_keras_dqn, 300000, 1800, CARTPOLE_THRESHOLD),
+    'actor_critic': (_actor_critic, 300000, 1800, CARTPOLE_THRESHOLD),
+    'a2c': (lambda *args: _actor_critic(*args, algorithm='a2c'), 300000, 1800, CARTPOLE_THRESHOLD),
+    'ppo': (lambda *args: _actor_critic(*args, algorithm='ppo'), 300000, 1800, CARTPOLE_THRESHOLD),
+    'reinforce': (_reinforce, 300000, 1800, CARTPOLE_THRESHOLD),
+}
+
+
+def _run_agent(name, seed, budget_scale, n_threads, conn):
+    '''
+        One benchmark run, in its own process (so the peak RSS is the run's) and in a temporary working directory
+        for the logs and plots the agents write, headless and quiet
+    '''
+    # the thread variables are set by the parent (see run_benchmarks), this covers the pools numpy already made
+    if n_threads:
+        limit_threads(n_threads)
+    os.environ['MPLBACKEND'] = 'Agg'
+    random.seed(seed)
+    np.random.seed(seed)
+    fn, max_steps, max_seconds, threshold = AGENTS[name]
+    recorder = _Recorder(int(max_steps * budget_scale), max_seconds * budget_scale, threshold)
+    extra, error = {}, None
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, 'w') as devnull:
+        os.chdir(workdir)
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+            _instrument_envs(stack, recorder)
+            setup_start = time.perf_counter()
+            try:
+                extra = fn(stack, recorder, seed) or {}
+            except _Stop:
+                pass
+            except Exception:
+                error = traceback.format_exc()
+                recorder.stop_reason = 'failed'
+            end = time.perf_counter()
+        start = setup_start if recorder.start is None else recorder.start
+        wall = max(end - start, 1e-9)
+        os.chdir(ROOT)
+    returns = np.asarray(recorder.returns, dtype=float)
+    conn.send({
+        'seed': seed,
+        'stop_reason': recorder.stop_reason,
+        'error': error,
+        'setup_seconds': start - setup_start,
+        'wall_clock': wall,
+        'env_steps': recorder.steps,
+        'updates': recorder.updates,
+        'episodes': len(returns),
+        'env_steps_per_sec': recorder.steps / wall,
+        'updates_per_sec': recorder.updates / wall,
+        'steps_to_solve': recorder.solved_steps,
+        'seconds_to_solve': recorder.solved_seconds,
+        'final_avg_return': float(returns[-100:].mean()) if len(returns) else None,
+        # kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        **extra,
+    })
+
+
+def _summary(runs):
+    '''
+        Mean, std, min and max over the seeds of every numeric metric (the unsolved runs are left out of the
+        time-to-solve metrics)
+    '''
+    summary = {}
+    for key in runs[0]:
+        values = [r[key] for r in runs if isinstance(r.get(key), (int, float)) and not isinstance(r[key], bool)]
+        if key != 'seed' and values:
+            summary[key] = {'mean': float(np.mean(values)), 'std': float(np.std(values)),
+                            'min': float(np.min(values)), 'max': float(np.max(values)), 'n': len(values)}
+    return summary
+
+
+def _metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    versions = {}
+    for package in ('numpy', 'gym', 'gymnasium', 'torch', 'tensorflow', 'tensorflow-cpu'):
+        try:
+            versions[package] = importlib.metadata.version(package)
+        except importlib.metadata.PackageNotFoundError:
+            versions[package] = None
+    return {
+        'commit': commit,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'versions': versions,
+    }
+
+
+def run_benchmarks(agents=tuple(AGENTS), seeds=(0, 1, 2), budget_scale=1.0, n_threads=1, out_path=None):
+    '''
+        Run every agent once per seed, one run at a time, each in a fresh process with n_threads threads per math
+        library and the step and time budgets of AGENTS scaled by budget_scale. Returns (and writes to out_path as
+        JSON) the metadata of the build and, per agent, the metrics of every run and their summary over the seeds.
+    '''
+    ctx = mp.get_context('spawn')
+    report = {'meta': _metadata(), 'budget_scale': budget_scale, 'n_threads': n_threads, 'agents': {}}
+    for name in agents:
+        runs = []
+        for seed in seeds:
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_run_agent, args=(name, seed, budget_scale, n_threads, child_conn))
+            with thread_env(n_threads) if n_threads else contextlib.nullcontext():
+                process.start()
+            child_conn.close()
+            try:
+                run = conn.recv()
+                print(f"{name} seed {seed}: {run['stop_reason']} in {run['wall_clock']:.1f}s, "
+                      f"{run['env_steps_per_sec']:.0f} steps/s, {run['updates_per_sec']:.0f} updates/s")
+            except EOFError:
+                run = {'seed': seed, 'stop_reason': 'crashed', 'error': None}
+                print(f"{name} seed {seed}: crashed")
+            process.join()
+            if run['stop_reason'] == 'crashed':
+                run['error'] = f'exit code {process.exitcode}'
+            runs.append(run)
+            if run['error']:
+                print(run['error'])
+        report['agents'][name] = {'runs': runs, 'summary': _summary(runs)}
+    if out_path is not None:
+        with open(out_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+# metric: +1 when higher is better, -1 when lower is better
+COMPARED_METRICS = {'env_steps_per_sec': 1, 'updates_per_sec': 1, 'wall_clock': -1, 'steps_to_solve': -1,
+                    'peak_rss_mb': -1}
+
+
+def compare(baseline, current, tolerance=0.1):
+    '''
+        The regressions of a benchmark report against a baseline one: the metrics whose mean over the seeds got
+        worse by more than the tolerance (a fraction), as printable lines
+    '''
+    regressions = []
+    for name, agent in current['agents'].items():
+        if name not in baseline['agents']:
+            continue
+        for metric, sign in COMPARED_METRICS.items():
+            old = baseline['agents'][name]['summary'].get(metric)
+            new = agent['summary'].get(metric)
+            if old is None or new is None or old['mean'] == 0:
+                continue
+            change = (new['mean'] - old['mean']) / old['mean']
+            if sign * change < -tolerance:
+                regressions.append(f'{name} {metric}: {old["mean"]:.4g} -> {new["mean"]:.4g} ({change:+.1%})')
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Headless throughput and time-to-solve benchmark of the agents')
+    parser.add_argument('--agents', nargs='+', default=list(AGENTS), choices=list(AGENTS))
+    parser.add_argument('--seeds', nargs='+', type=int, default=[0, 1, 2])
+    parser.add_argument('--budget_scale', type=float, default=1.0)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--out', type=str, default='benchmark.json')
+    parser.add_argument('--compare', type=str, default=None, help='baseline report to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = run_benchmarks(args.agents, args.seeds, args.budget_scale, args.threads, args.out)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        print('\n'.join(regressions) if regressions else 'no regressions')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,122 @@
+import glob
+import os
+import pickle
+import random
+import sys
+import threading
+import numpy as np
+
+
+def rng_state():
+    '''
+        The states of the global random generators: Python's, NumPy's and torch's when torch is loaded
+    '''
+    state = {'random': random.getstate(), 'numpy': np.random.get_state()}
+    if 'torch' in sys.modules:
+        state['torch'] = sys.modules['torch'].get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    if 'torch' in state:
+        sys.modules['torch'].set_rng_state(state['torch'])
+
+
+def _list_checkpoints(directory):
+    return sorted(glob.glob(os.path.join(directory, 'ckpt-*.pkl')))
+
+
+class AsyncCheckpointer:
+    '''
+        Full-state checkpoints written by a background thread. save() only queues a snapshot, a dict of arrays and
+        plain values the caller has already copied out of the trainer, and the thread pickles it into a temporary
+        file that is then renamed into place, so a checkpoint on disk is always complete. If a snapshot is still
+        waiting when the next one comes, the newer one replaces it, so the training thread never waits on the disk.
+        Only the max_to_keep most recent checkpoints are kept.
+    '''
+
+    def __init__(self, directory, max_to_keep=3):
+        self.directory = directory
+        self.max_to_keep = max_to_keep
+        os.makedirs(directory, exist_ok=True)
+        self._pending = None
+        self._busy = False
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _path(self, step):
+        return os.path.join(self.directory, f'ckpt-{step:08d}.pkl')
+
+    def save(self, step, state):
+        self._raise_error()
+        with self._cond:
+            self._pending = (step, state)
+            self._cond.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                if self._pending is None:
+                    return
+                (step, state), self._pending = self._pending, None
+                self._busy = True
+            try:
+                self._write(step, state)
+            except Exception as e:
+                self._error = e
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
+
+    def _write(self, step, state):
+        path = self._path(step)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump({'step': step, 'state': state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        for old in _list_checkpoints(self.directory)[:-self.max_to_keep]:
+            os.remove(old)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def wait(self):
+        '''
+            Block until the queued snapshot is on disk
+        '''
+        with self._cond:
+            while self._pending is not None or self._busy:
+                self._cond.wait()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._writer.join()
+
+
+def load_checkpoint(path):
+    '''
+        Load a checkpoint written by AsyncCheckpointer, given its path or its directory (the latest one is taken).
+        Returns the step and the state, or None when the directory holds no checkpoint.
+    '''
+    if os.path.isdir(path):
+        checkpoints = _list_checkpoints(path)
+        if not checkpoints:
+            return None
+        path = checkpoints[-1]
+    with open(path, 'rb') as f:
+        checkpoint = pickle.load(f)
+    return checkpoint['step'], checkpoint['state']
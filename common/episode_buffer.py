@@ -0,0 +1,65 @@
+import numpy as np
+from scipy.signal import lfilter
+
+
+def discounted_returns(rewards, gamma):
+    '''
+        G_t = r_t + gamma * G_(t+1) for every step of an episode, computed as one reverse scan (a first order linear
+        filter over the reversed rewards) in O(T)
+    '''
+    return lfilter([1.0], [1.0, -gamma], np.asarray(rewards, dtype=np.float64)[::-1])[::-1]
+
+
+def n_step_returns(rewards, dones, last_values, gamma):
+    '''
+        The bootstrapped returns of a rollout of n steps of N envs (rewards and dones of shape (n, N)):
+        G_t = r_t + gamma * G_(t+1), cut at the steps that end an episode, and G_n = V(S_n) = last_values.
+        One backward pass over the n steps, vectorized over the envs.
+    '''
+    returns = np.zeros(np.shape(rewards))
+    G = np.asarray(last_values, dtype=np.float64)
+    for t in reversed(range(len(rewards))):
+        G = rewards[t] + gamma * G * (1.0 - dones[t])
+        returns[t] = G
+    return returns
+
+
+class EpisodeBuffer:
+    '''
+        The states, actions and rewards of one episode in arrays preallocated for max_steps transitions, so the
+        whole episode can be fed to the networks as one batch. The properties are views on the first len(self)
+        transitions.
+    '''
+
+    def __init__(self, max_steps, state_size):
+        self._states = np.zeros((max_steps, state_size), dtype=np.float32)
+        self._actions = np.zeros(max_steps, dtype=np.int64)
+        self._rewards = np.zeros(max_steps, dtype=np.float64)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def reset(self):
+        self.n = 0
+
+    def add(self, state, action, reward):
+        self._states[self.n] = np.ravel(state)
+        self._actions[self.n] = action
+        self._rewards[self.n] = reward
+        self.n += 1
+
+    @property
+    def states(self):
+        return self._states[:self.n]
+
+    @property
+    def actions(self):
+        return self._actions[:self.n]
+
+    @property
+    def rewards(self):
+        return self._rewards[:self.n]
+
+    def returns(self, gamma):
+        return discounted_returns(self.rewards, gamma)
@@ -0,0 +1,116 @@
+import gym
+import numpy as np
+from gym.utils import seeding
+
+
+class BatchedCartPole:
+    '''
+        n_envs CartPole instances stepped together in pure NumPy, with the physics constants taken from a gym
+        CartPole env. The dynamics are the env's own (float64 state, float32 observations), and the episode of
+        seed s starts from the same state as env.reset(seed=s), so the trajectories are the ones of the gym env.
+    '''
+
+    def __init__(self, env, n_envs):
+        cp = env.unwrapped
+        self.gravity, self.masspole, self.total_mass = cp.gravity, cp.masspole, cp.total_mass
+        self.length, self.polemass_length = cp.length, cp.polemass_length
+        self.force_mag, self.tau = cp.force_mag, cp.tau
+        self.euler = cp.kinematics_integrator == 'euler'
+        self.x_threshold, self.theta_threshold = cp.x_threshold, cp.theta_threshold_radians
+        self.n_envs = n_envs
+        self.states = np.zeros((n_envs, 4))
+
+    def reset(self, seeds):
+        for i, seed in enumerate(seeds):
+            self.states[i] = seeding.np_random(int(seed))[0].uniform(low=-0.05, high=0.05, size=(4,))
+        return self.states.astype(np.float32)
+
+    def step(self, actions, active=None):
+        '''
+            Advance the envs selected by the boolean mask active (all of them by default). Returns the float32
+            observations of all the envs and the terminated flags of the advanced ones (False elsewhere).
+        '''
+        active = np.ones(self.n_envs, dtype=bool) if active is None else active
+        x, x_dot, theta, theta_dot = self.states[active].T
+        force = np.where(np.asarray(actions) == 1, self.force_mag, -self.force_mag)
+        costheta, sintheta = np.cos(theta), np.sin(theta)
+        temp = (force + self.polemass_length * theta_dot ** 2 * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / (
+                self.length * (4.0 / 3.0 - self.masspole * costheta ** 2 / self.total_mass))
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+        if self.euler:
+            x, x_dot = x + self.tau * x_dot, x_dot + self.tau * xacc
+            theta, theta_dot = theta + self.tau * theta_dot, theta_dot + self.tau * thetaacc
+        else:
+            x_dot = x_dot + self.tau * xacc
+            x = x + self.tau * x_dot
+            theta_dot = theta_dot + self.tau * thetaacc
+            theta = theta + self.tau * theta_dot
+        self.states[active] = np.stack([x, x_dot, theta, theta_dot], axis=1)
+        terminated = np.zeros(self.n_envs, dtype=bool)
+        terminated[active] = (np.abs(x) > self.x_threshold) | (np.abs(theta) > self.theta_threshold)
+        return self.states.astype(np.float32), terminated
+
+
+def tail_stats(returns):
+    '''
+        Summary of the returns of an evaluation, including the low tail: the 5th and 25th percentiles and the mean
+        of the worst 10% of the episodes
+    '''
+    returns = np.sort(np.asarray(returns, dtype=float))
+    n_worst = max(1, int(np.ceil(0.1 * len(returns))))
+    return {
+        'mean': returns.mean(),
+        'std': returns.std(),
+        'min': returns[0],
+        'p05': np.percentile(returns, 5),
+        'p25': np.percentile(returns, 25),
+        'median': np.median(returns),
+        'max': returns[-1],
+        'worst10_mean': returns[:n_worst].mean(),
+    }
+
+
+def evaluate_policy(policy, env_id='CartPole-v1', n_episodes=100, seed=0, max_steps=None):
+    '''
+        Run n_episodes greedy episodes in lockstep, episode i being seeded with seed + i. policy maps a batch of
+        observations to their actions (e.g. a NumpyPolicy with the 'argmax' head) and is called once per tick on
+        the episodes still running; finished episodes are masked out. max_steps defaults to the env's time limit.
+        CartPole is simulated by BatchedCartPole, other envs by n_episodes gym envs.
+        Returns the per-episode returns and lengths, and their tail_stats.
+    '''
+    env = gym.make(env_id)
+    max_steps = max_steps or env.spec.max_episode_steps
+    seeds = seed + np.arange(n_episodes)
+    cartpole = env_id.startswith('CartPole')
+    if cartpole:
+        batched = BatchedCartPole(env, n_episodes)
+        obs = batched.reset(seeds)
+    else:
+        envs = [gym.make(env_id) for _ in range(n_episodes)]
+        obs = np.stack([e.reset(seed=int(s))[0] for e, s in zip(envs, seeds)])
+    env.close()
+
+    returns = np.zeros(n_episodes)
+    lengths = np.zeros(n_episodes, dtype=np.int64)
+    active = np.ones(n_episodes, dtype=bool)
+    for _ in range(max_steps):
+        actions = policy(obs[active])
+        if cartpole:
+            # CartPole rewards 1 per step, including the terminating one
+            obs, terminated = batched.step(actions, active)
+            returns[active] += 1
+        else:
+            terminated = np.zeros(n_episodes, dtype=bool)
+            for i, action in zip(np.flatnonzero(active), actions):
+                obs[i], reward, terminated[i], truncated, _ = envs[i].step(int(action))
+                returns[i] += reward
+                terminated[i] |= truncated
+        lengths[active] += 1
+        active &= ~terminated
+        if not active.any():
+            break
+    if not cartpole:
+        for e in envs:
+            e.close()
+    return returns, lengths, tail_stats(returns)
@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+
+
+class FlatParams:
+    '''
+        The parameters of a torch module moved into one contiguous float32 buffer: every parameter becomes a view
+        into flat (in module.parameters() order), so the optimizers, state_dict()/load_state_dict() and the
+        NumpyPolicy views of the module keep working, in place, on the same memory.
+
+        A whole-network update is then a single operation over flat, without allocation: polyak_(source, tau) and
+        copy_(source) for the target networks, publish(shared) for the weight broadcasting.
+
+        out, a float32 numpy array of size n (e.g. an array of a SharedArrays block), is used as the buffer instead of
+        a new one. With copy=False the module takes the values already in out instead, e.g. to attach a read-only
+        replica in another process.
+    '''
+
+    def __init__(self, module, out=None, copy=True):
+        params = list(module.parameters())
+        self.n = sum(p.numel() for p in params)
+        if out is None:
+            self.flat = torch.empty(self.n, dtype=torch.float32)
+        else:
+            assert out.dtype == np.float32 and out.size == self.n, "The buffer does not match the parameters"
+            self.flat = torch.from_numpy(out.reshape(-1))
+        offset = 0
+        with torch.no_grad():
+            for p in params:
+                view = self.flat[offset:offset + p.numel()].view_as(p)
+                if copy:
+                    view.copy_(p)
+                p.data = view
+                offset += p.numel()
+
+    def numpy(self):
+        '''
+            The buffer itself as a numpy array (no copy)
+        '''
+        return self.flat.numpy()
+
+    def copy_(self, source):
+        '''
+            Hard update: self <- source
+        '''
+        self.flat.copy_(source.flat)
+
+    def polyak_(self, source, tau):
+        '''
+            Soft update: self <- (1 - tau) * self + tau * source, fused in one pass
+        '''
+        self.flat.lerp_(source.flat, tau)
+
+    def publish(self, shared):
+        '''
+            Copy the buffer into shared['weights'], a float32 array of size n in shared memory, under the seqlock of
+            shared['version'] (odd while writing), the protocol of ex1.async_actors. A reader copies the weights and
+            keeps them only when the version, read before and after, is the same even number.
+        '''
+        shared['version'][0] += 1
+        np.copyto(shared['weights'], self.numpy())
+        shared['version'][0] += 1
@@ -0,0 +1,193 @@
+import contextlib
+import importlib
+import itertools
+import multiprocessing as mp
+import os
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+import numpy as np
+import pandas as pd
+
+# the thread pools of NumPy's BLAS, torch and TensorFlow, all sized by the environment when the library loads
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS',
+                   'TF_NUM_INTEROP_THREADS')
+
+
+@contextlib.contextmanager
+def thread_env(n_threads):
+    '''
+        Set THREAD_ENV_VARS to n_threads while the processes are started inside, and restore them after. They must
+        be in the environment of a spawned child from its start: the child imports numpy (to unpickle its target)
+        and the parent's __main__ before any of its own code runs.
+    '''
+    saved = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(n_threads) for var in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+
+def limit_threads(n_threads):
+    '''
+        Resize the thread pools of the math libraries already loaded in this process: the BLAS pools through
+        threadpoolctl when it is installed, torch and TensorFlow (which only accepts it before its runtime starts)
+    '''
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(n_threads)
+    except ImportError:
+        pass
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(n_threads)
+    if 'tensorflow' in sys.modules:
+        threading = sys.modules['tensorflow'].config.threading
+        try:
+            threading.set_intra_op_parallelism_threads(n_threads)
+            threading.set_inter_op_parallelism_threads(n_threads)
+        except RuntimeError:
+            pass
+
+
+def grid(**values):
+    '''
+        Every combination of the given values, as a list of configs: grid(lr=[0.1, 0.01], g=[0.9]) ->
+        [{'lr': 0.1, 'g': 0.9}, {'lr': 0.01, 'g': 0.9}]
+    '''
+    keys = list(values)
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values.values())]
+
+
+def _worker(entry, paths, rungs, core, quiet, conn):
+    '''
+        A search worker: pinned to one core with single-threaded math libraries (started under thread_env(1), and
+        limited again once the entry point's module is imported) and a headless matplotlib. Runs the trials it
+        receives until it gets None.
+    '''
+    os.environ['MPLBACKEND'] = 'Agg'
+    if core is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {core})
+    sys.path[:0] = paths
+    module_name, fn_name = entry.split(':')
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull if quiet else sys.stdout):
+        trial_fn = getattr(importlib.import_module(module_name), fn_name)
+        limit_threads(1)
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            trial_id, config = task
+            next_rung = 0
+
+            def report(step, value):
+                '''
+                    Stream an intermediate result. At a rung the trial waits for the decision, and it must stop
+                    when report returns False.
+                '''
+                nonlocal next_rung
+                rung = next_rung if next_rung < len(rungs) and step >= rungs[next_rung] else None
+                conn.send(('report', trial_id, step, float(value), rung))
+                if rung is None:
+                    return True
+                next_rung += 1
+                return conn.recv()
+
+            start = time.time()
+            try:
+                result = trial_fn(dict(config), report)
+                conn.send(('done', trial_id, result, time.time() - start))
+            except Exception:
+                conn.send(('failed', trial_id, traceback.format_exc(), time.time() - start))
+
+
+def successive_halving(entry, configs, rungs, eta=3, n_workers=None, paths=(), out_path=None, quiet=True):
+    '''
+        Run the trial function entry ('module:function', the module being importable from sys.path + paths) on
+        every config across a pool of n_workers processes (one per core by default), each pinned to its own core.
+        A trial is called as fn(config, report) and calls report(step, value) with its intermediate results (e.g.
+        the rolling reward after every episode); its return value is the final result.
+
+        Asynchronous successive halving: when a trial's step reaches a rung (rungs is increasing), it keeps running
+        only if its value is in the best 1/eta of the values reported at that rung so far (the first eta - 1 trials
+        to reach a rung always go on); otherwise report returns False and the trial stops, freeing its worker.
+
+        Returns one table row per trial (the config, the status: completed, pruned or failed, the last reported
+        step and value, the result and the time), best first, also written to out_path as CSV when given.
+    '''
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else [None]
+    n_workers = min(n_workers or len(cores), len(configs))
+    ctx = mp.get_context('spawn')
+    rows = [dict(trial=i, **config, status='queued', step=None, value=np.nan, result=None, seconds=np.nan)
+            for i, config in enumerate(configs)]
+    rung_values = [[] for _ in rungs]
+    queue = list(range(len(configs)))
+    workers = {}
+    assigned = {}
+    for i in range(n_workers):
+        conn, child_conn = ctx.Pipe()
+        process = ctx.Process(target=_worker, args=(entry, list(paths), list(rungs), cores[i % len(cores)], quiet,
+                                                    child_conn), daemon=True)
+        with thread_env(1):
+            process.start()
+        workers[conn] = process
+
+    def dispatch(conn):
+        if queue:
+            trial_id = queue.pop(0)
+            rows[trial_id]['status'] = 'running'
+            assigned[conn] = trial_id
+            conn.send((trial_id, configs[trial_id]))
+            return True
+        conn.send(None)
+        return False
+
+    running = {conn for conn in workers if dispatch(conn)}
+    try:
+        while running:
+            for conn in wait(list(running)):
+                try:
+                    kind, trial_id, *payload = conn.recv()
+                except EOFError:
+                    # the worker died (e.g. killed for its memory): its trial fails and the pool shrinks
+                    rows[assigned[conn]]['status'] = 'failed'
+                    running.discard(conn)
+                    continue
+                row = rows[trial_id]
+                if kind == 'report':
+                    row['step'], row['value'], rung = payload
+                    if rung is not None:
+                        values = rung_values[rung]
+                        values.append(-np.inf if np.isnan(row['value']) else row['value'])
+                        keep = len(values) < eta or sum(v > values[-1] for v in values) < len(values) / eta
+                        if not keep:
+                            row['status'] = 'pruned'
+                            print(f'trial {trial_id} pruned at rung {rungs[rung]} with {row["value"]:.2f}')
+                        conn.send(keep)
+                    continue
+                if row['status'] != 'pruned':
+                    row['status'] = 'completed' if kind == 'done' else 'failed'
+                    print(f'trial {trial_id} {row["status"]} with {row["value"]:.2f}')
+                if kind == 'failed':
+                    print(payload[0])
+                row['result'] = payload[0] if kind == 'done' else None
+                row['seconds'] = payload[1]
+                if not dispatch(conn):
+                    running.discard(conn)
+    finally:
+        for process in workers.values():
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+    table = pd.DataFrame(rows)
+    order = table['status'].map({'completed': 0, 'pruned': 1, 'failed': 2, 'running': 3, 'queued': 3})
+    table = table.assign(_order=order).sort_values(['_order', 'value'], ascending=[True, False]).drop(columns='_order')
+    if out_path is not None:
+        table.to_csv(out_path, index=False)
+    return table
@@ -0,0 +1,132 @@
+import collections
+import csv
+import json
+import threading
+import time
+
+
+class JSONLBackend:
+    '''
+        One JSON object per scalar: {"name", "value", "step", "time"}
+    '''
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+
+    def write(self, records):
+        self._file.writelines(json.dumps({'name': name, 'value': value, 'step': step, 'time': t}) + '\n'
+                              for name, value, step, t in records)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class CSVBackend:
+    '''
+        One row per scalar: name, value, step, time
+    '''
+
+    def __init__(self, path):
+        self._file = open(path, 'a', newline='')
+        self._writer = csv.writer(self._file)
+        if self._file.tell() == 0:
+            self._writer.writerow(['name', 'value', 'step', 'time'])
+
+    def write(self, records):
+        self._writer.writerows(records)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class TensorBoardBackend:
+    '''
+        The scalars as TensorBoard summaries, through a tf.summary file writer or one created in log_dir
+    '''
+
+    def __init__(self, writer=None, log_dir=None):
+        import tensorflow as tf
+        self._tf = tf
+        self._writer = tf.summary.create_file_writer(log_dir) if writer is None else writer
+
+    def write(self, records):
+        with self._writer.as_default():
+            for name, value, step, _ in records:
+                self._tf.summary.scalar(name, value, step=step)
+        self._writer.flush()
+
+    def close(self):
+        self._writer.flush()
+
+
+class MetricsSink:
+    '''
+        Scalars logged from the training loop without blocking it: scalar() only appends a tuple to a queue, and a
+        background thread takes everything queued every flush_interval seconds, converts the values to floats and
+        hands the batch to every backend (JSONLBackend, CSVBackend, TensorBoardBackend).
+
+        console() keeps only the latest progress line and the thread prints it at most once every
+        console_interval seconds, so a line per episode costs an assignment and its formatting happens off the
+        loop. Lines passed with force=True (e.g. "solved") are printed right away, after the pending one.
+    '''
+
+    def __init__(self, backends=(), flush_interval=1.0, console_interval=2.0):
+        self.backends = list(backends)
+        self.flush_interval = flush_interval
+        self.console_interval = console_interval
+        self._queue = collections.deque()
+        self._console_line = None
+        self._last_console = 0.0
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def scalar(self, name, value, step):
+        self._queue.append((name, value, step, time.time()))
+
+    def scalars(self, values, step):
+        t = time.time()
+        self._queue.extend((name, value, step, t) for name, value in values.items())
+
+    def console(self, fmt, *args, force=False):
+        if force:
+            # the pending progress line (e.g. of the solving episode) goes out first
+            with self._lock:
+                line, self._console_line = self._console_line, None
+                if line is not None:
+                    print(line[0].format(*line[1]))
+                print(fmt.format(*args))
+                self._last_console = time.time()
+        else:
+            self._console_line = (fmt, args)
+
+    def _write_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self, console=False):
+        '''
+            Write out the queued scalars, and the pending console line if it is due or console is True
+        '''
+        with self._lock:
+            records = []
+            while self._queue:
+                name, value, step, t = self._queue.popleft()
+                records.append((name, float(value), int(step), t))
+            if records:
+                for backend in self.backends:
+                    backend.write(records)
+            line, now = self._console_line, time.time()
+            if line is not None and (console or now - self._last_console >= self.console_interval):
+                self._console_line, self._last_console = None, now
+                print(line[0].format(*line[1]))
+
+    def close(self):
+        self._stop.set()
+        self._writer.join()
+        self.flush(console=True)
+        for backend in self.backends:
+            backend.close()
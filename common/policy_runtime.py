@@ -0,0 +1,161 @@
+import numpy as np
+
+ACTIVATIONS = ('relu', 'tanh', 'sigmoid', 'linear', None)
+
+
+def _activate(x, activation):
+    if activation == 'relu':
+        return np.maximum(x, 0, out=x)
+    if activation == 'tanh':
+        return np.tanh(x, out=x)
+    if activation == 'sigmoid':
+        return 1 / (1 + np.exp(-x))
+    if activation in ('linear', None):
+        return x
+    raise ValueError(f'Unsupported activation {activation}')
+
+
+class NumpyPolicy:
+    '''
+        Framework-free inference engine for the small Dense (+ activation) stacks of our agents. The network is a
+        list of (W, b, activation) layers computing activation(x @ W + b), followed by a head: 'argmax' (greedy
+        action), 'softmax' (action distribution) or None (raw outputs). Inputs can be a single state or a batch.
+
+        The exporters (from_torch, from_keras, from_tf1) pull the weights out of each framework. By default they
+        are packed into one contiguous float32 buffer (params), which is also the format of save/load.
+    '''
+
+    def __init__(self, layers, head=None):
+        for _, _, activation in layers:
+            if activation not in ACTIVATIONS:
+                raise ValueError(f'Unsupported activation {activation}')
+        self.layers = [(W, b, activation) for W, b, activation in layers]
+        self.head = head
+        self.params = None
+
+    @classmethod
+    def from_layers(cls, layers, head=None):
+        '''
+            Copy the layers into one contiguous float32 buffer, every W and b being a view into it
+        '''
+        params = np.concatenate([np.asarray(a, dtype=np.float32).ravel() for W, b, _ in layers for a in (W, b)])
+        return cls.from_flat(params, [np.shape(W) for W, _, _ in layers], [a for _, _, a in layers], head)
+
+    @classmethod
+    def from_flat(cls, params, shapes, activations, head=None):
+        '''
+            Build the layers as views into a flat parameter buffer, given the (n_in, n_out) shape of every W
+        '''
+        layers, offset = [], 0
+        for (n_in, n_out), activation in zip(shapes, activations):
+            W = params[offset:offset + n_in * n_out].reshape(n_in, n_out)
+            offset += n_in * n_out
+            b = params[offset:offset + n_out]
+            offset += n_out
+            layers.append((W, b, activation))
+        policy = cls(layers, head)
+        policy.params = params
+        return policy
+
+    @property
+    def shapes(self):
+        return [W.shape for W, _, _ in self.layers]
+
+    @property
+    def activations(self):
+        return [activation for _, _, activation in self.layers]
+
+    @classmethod
+    def from_torch(cls, module, head=None, copy=True):
+        '''
+            Export a torch module made of nn.Linear layers, activations and dropouts (dropout is the identity at
+            inference), such as QNet. With copy=False the layers are views on the parameters' own memory, so the
+            policy follows the in-place optimizer updates of the module without any re-export.
+        '''
+        import torch.nn as nn
+        layers = []
+        for m in module.modules():
+            if isinstance(m, nn.Linear):
+                layers.append([m.weight.detach().numpy().T, m.bias.detach().numpy(), 'linear'])
+            elif isinstance(m, (nn.ReLU, nn.Tanh, nn.Sigmoid)):
+                layers[-1][2] = type(m).__name__.lower()
+            elif not isinstance(m, (nn.Sequential, nn.Dropout)) and m is not module:
+                raise ValueError(f'Unsupported module {type(m).__name__}')
+        return cls.from_layers(layers, head) if copy else cls(layers, head)
+
+    @classmethod
+    def from_keras(cls, model, head=None):
+        '''
+            Export a Keras Sequential model of Dense, Dropout and BatchNormalization layers. Every batch
+            normalization is folded into the following Dense layer (or kept as a diagonal layer at the end).
+        '''
+        layers, scale, shift = [], None, None
+        weights = model.get_weights()
+        i = 0
+        for layer in model.layers:
+            kind = type(layer).__name__
+            if kind == 'Dense':
+                W, b = weights[i], weights[i + 1]
+                i += 2
+                if scale is not None:
+                    # dense(x * scale + shift) == x @ (scale[:, None] * W) + (shift @ W + b)
+                    W, b = scale[:, None] * W, shift @ W + b
+                    scale, shift = None, None
+                layers.append((W, b, layer.activation.__name__))
+            elif kind == 'BatchNormalization':
+                gamma, beta, mean, var = weights[i:i + 4]
+                i += 4
+                s = gamma / np.sqrt(var + layer.epsilon)
+                t = beta - mean * s
+                scale, shift = (s, t) if scale is None else (scale * s, shift * s + t)
+            elif kind != 'Dropout':
+                raise ValueError(f'Unsupported layer {kind}')
+        if scale is not None:
+            layers.append((np.diag(scale), shift, 'linear'))
+        return cls.from_layers(layers, head)
+
+    @classmethod
+    def from_tf1(cls, sess, params, activations, head=None):
+        '''
+            Export a TF1 graph network given its [(W, b), ...] variables and the activation of every layer, e.g.
+            from_tf1(sess, [(policy.W1, policy.b1), (policy.W2, policy.b2)], ['relu', 'linear'], 'softmax')
+        '''
+        values = sess.run(params)
+        return cls.from_layers([(W, b, a) for (W, b), a in zip(values, activations)], head)
+
+    def forward(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        for W, b, activation in self.layers:
+            x = _activate(x @ W + b, activation)
+        return x
+
+    def __call__(self, x):
+        out = self.forward(x)
+        if self.head == 'argmax':
+            return np.argmax(out, axis=-1)
+        if self.head == 'softmax':
+            e = np.exp(out - out.max(axis=-1, keepdims=True))
+            return e / e.sum(axis=-1, keepdims=True)
+        return out
+
+    def save(self, path):
+        policy = self if self.params is not None else NumpyPolicy.from_layers(self.layers, self.head)
+        np.savez(path, params=policy.params, shapes=np.array(policy.shapes), activations=np.array(policy.activations),
+                 head=np.array(policy.head or ''))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls.from_flat(data['params'], [tuple(s) for s in data['shapes']], [str(a) for a in data['activations']],
+                             str(data['head']) or None)
+
+
+def sample_categorical(probs, rng=np.random):
+    '''
+        One action per row of a batch of action distributions, by inverse CDF: the first action whose cumulative
+        probability exceeds a uniform draw
+    '''
+    probs = np.atleast_2d(probs)
+    u = rng.random_sample((len(probs), 1)) if rng is np.random else rng.random((len(probs), 1))
+    # clipping guards against the cumulative sum ending slightly below 1
+    return np.minimum((np.cumsum(probs, axis=1) <= u).sum(axis=1), probs.shape[1] - 1)
@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+from time import perf_counter_ns
+import numpy as np
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    '''
+        The reusable context manager timing one phase. Entries nest (the start times are stacked), so a phase may
+        contain itself. The durations are only aggregated: their count, total and max, and a histogram whose bin k
+        counts the durations of k bits in nanoseconds, i.e. in [2^(k-1), 2^k) ns.
+    '''
+    __slots__ = ('profiler', 'id', 'count', 'total', 'max', 'bins', 'starts')
+
+    def __init__(self, profiler, phase_id):
+        self.profiler = profiler
+        self.id = phase_id
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.bins = [0] * 64
+        self.starts = []
+
+    def __enter__(self):
+        self.starts.append(perf_counter_ns())
+
+    def __exit__(self, exc_type, exc, tb):
+        end = perf_counter_ns()
+        start = self.starts.pop()
+        duration = end - start
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        self.bins[duration.bit_length()] += 1
+        events = self.profiler.events
+        if len(events) < self.profiler.max_events:
+            events.append((self.id, start, duration, threading.get_ident()))
+
+    def percentile(self, q):
+        '''
+            The q-th percentile of the durations in nanoseconds, interpolated linearly inside its histogram bin
+        '''
+        rank = q / 100 * self.count
+        seen = 0
+        for k, n in enumerate(self.bins):
+            if n and seen + n >= rank:
+                low, high = (2 ** (k - 1) if k else 0), min(2 ** k, self.max + 1)
+                return min(low + (high - low) * max(rank - seen, 0) / n, self.max)
+            seen += n
+        return self.max
+
+
+class Profiler:
+    '''
+        Scoped timers and counters for the phases of a training loop:
+
+            with profiler.phase('env_step'):
+                ...
+            profiler.count('episodes')
+
+        A phase streams the aggregates of its entries (count, total, max and a log2-spaced histogram, from which
+        summary() estimates the percentiles), so its memory does not grow with the run, and the profiler keeps the
+        first max_events entries as a timeline, for save_chrome_trace() (open it in chrome://tracing or Perfetto).
+        A disabled profiler hands out one shared no-op context and ignores the counts, so the instrumentation can
+        stay in the loops. Nested phases overlap, so their fractions of the wall time do not add up.
+    '''
+
+    def __init__(self, enabled=True, max_events=1_000_000):
+        self.enabled = enabled
+        self.max_events = max_events
+        self._phases = {}
+        self.counters = {}
+        self.events = []
+        self.start = perf_counter_ns()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        phase = self._phases.get(name)
+        if phase is None:
+            phase = self._phases[name] = _Phase(self, name)
+        return phase
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        '''
+            Per phase: the number of entries, the total time and its fraction of the wall time since the profiler
+            was created, the mean, percentiles (estimated from the histogram) and max of an entry, and a histogram of
+            the entries' durations with power-of-two bin edges in microseconds. And the counters.
+        '''
+        wall = (perf_counter_ns() - self.start) / 1e3
+        phases = {}
+        for name, phase in self._phases.items():
+            if not phase.count:
+                continue
+            used = np.flatnonzero(phase.bins)
+            first, last = used[0], used[-1] + 1
+            edges = [2.0 ** (k - 1) / 1e3 if k else 0.0 for k in range(first, last + 1)]
+            phases[name] = {
+                'count': phase.count,
+                'total_s': phase.total / 1e9,
+                'fraction': phase.total / 1e3 / wall,
+                'mean_us': phase.total / phase.count / 1e3,
+                'p50_us': phase.percentile(50) / 1e3,
+                'p90_us': phase.percentile(90) / 1e3,
+                'p99_us': phase.percentile(99) / 1e3,
+                'max_us': phase.max / 1e3,
+                'histogram': {'edges_us': edges, 'counts': phase.bins[first:last]},
+            }
+        phases = dict(sorted(phases.items(), key=lambda item: -item[1]['total_s']))
+        return {'wall_s': wall / 1e6, 'phases': phases, 'counters': dict(self.counters)}
+
+    def report(self):
+        '''
+            The summary as a table, the phases taking the most time first
+        '''
+        summary = self.summary()
+        lines = [f"wall {summary['wall_s']:.2f}s",
+                 f"{'phase':<20}{'count':>10}{'total s':>10}{'%':>7}{'mean us':>10}{'p50 us':>10}{'p99 us':>10}"]
+        for name, s in summary['phases'].items():
+            lines.append(f"{name:<20}{s['count']:>10}{s['total_s']:>10.3f}{100 * s['fraction']:>7.1f}"
+                         f"{s['mean_us']:>10.1f}{s['p50_us']:>10.1f}{s['p99_us']:>10.1f}")
+        lines.extend(f'{name:<20}{n:>10}' for name, n in summary['counters'].items())
+        return '\n'.join(lines)
+
+    def save_summary(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, default=float)
+
+    def save_chrome_trace(self, path):
+        '''
+            Write the timeline in the Chrome trace event format, one complete event per phase entry
+        '''
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'ts': (start - self.start) / 1e3, 'dur': duration / 1e3, 'pid': pid,
+                   'tid': tid} for name, start, duration, tid in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# the default of the instrumented loops
+NULL_PROFILER = Profiler(enabled=False)
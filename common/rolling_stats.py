@@ -0,0 +1,96 @@
+import numpy as np
+
+
+class RollingStats:
+    '''
+        Streaming statistics of a sequence of values (typically episode rewards), updated in O(number of windows)
+        per value whatever the window sizes: the rolling sum and sum of squares of every window, the running mean
+        and variance of the whole sequence (Welford), the smoothed learning curve of every window, and the first
+        index at which each window's mean crossed the threshold.
+    '''
+
+    # the rolling sums are recomputed exactly from the ring every RESYNC_INTERVAL values to stop the float drift
+    RESYNC_INTERVAL = 1 << 16
+
+    def __init__(self, windows=(100,), threshold=None):
+        self.windows = tuple(sorted(set(windows)))
+        self.threshold = threshold
+        self._ring = np.zeros(max(self.windows))
+        self._sums = dict.fromkeys(self.windows, 0.0)
+        self._sq_sums = dict.fromkeys(self.windows, 0.0)
+        self._curves = {w: [] for w in self.windows}
+        self.crossings = {}
+        self.count = 0
+        self.last = np.nan
+        self.running_mean = 0.0
+        self._m2 = 0.0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, x):
+        x = float(x)
+        size = len(self._ring)
+        for w in self.windows:
+            dropped = self._ring[(self.count - w) % size] if self.count >= w else 0.0
+            self._sums[w] += x - dropped
+            self._sq_sums[w] += x * x - dropped * dropped
+        self._ring[self.count % size] = x
+        self.count += 1
+        self.last = x
+        delta = x - self.running_mean
+        self.running_mean += delta / self.count
+        self._m2 += delta * (x - self.running_mean)
+        if self.count % self.RESYNC_INTERVAL == 0:
+            self._resync()
+        for w in self.windows:
+            mean = self.mean(w)
+            self._curves[w].append(mean)
+            if self.threshold is not None and w not in self.crossings and self.full(w) and mean > self.threshold:
+                self.crossings[w] = self.count - 1
+
+    def extend(self, values):
+        for x in values:
+            self.append(x)
+
+    def _resync(self):
+        size = len(self._ring)
+        for w in self.windows:
+            idx = (self.count - 1 - np.arange(min(w, self.count))) % size
+            self._sums[w] = float(self._ring[idx].sum())
+            self._sq_sums[w] = float(np.square(self._ring[idx]).sum())
+
+    def full(self, w):
+        return self.count >= w
+
+    def mean(self, w):
+        '''
+            Mean of the last w values (of all of them while there are fewer than w), nan before the first value
+        '''
+        n = min(w, self.count)
+        return self._sums[w] / n if n else np.nan
+
+    def var(self, w):
+        n = min(w, self.count)
+        if not n:
+            return np.nan
+        mean = self._sums[w] / n
+        return max(self._sq_sums[w] / n - mean * mean, 0.0)
+
+    def crossed(self, w, threshold=None):
+        '''
+            True when the sum of the last w values exceeds w * threshold. Missing values count as zeros, like
+            sum(values[-w:]) / w > threshold, so a window is never crossed before it could be filled.
+        '''
+        threshold = self.threshold if threshold is None else threshold
+        return self._sums[w] > threshold * w
+
+    @property
+    def running_var(self):
+        return self._m2 / self.count if self.count else np.nan
+
+    def curve(self, w):
+        '''
+            The rolling mean of window w after every full window, like np.convolve(values, np.ones(w) / w, 'valid')
+        '''
+        return np.array(self._curves[w][w - 1:])
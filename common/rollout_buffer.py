@@ -0,0 +1,85 @@
+import numpy as np
+
+
+def gae_advantages(rewards, values, dones, last_values, gamma, lam):
+    '''
+        Generalized advantage estimates of a rollout of n steps of N envs (arrays of shape (n, N)): the TD errors
+        delta_t = r_t + gamma * V(S_(t+1)) - V(S_t) of all the steps at once, then one backward scan
+        A_t = delta_t + gamma * lam * A_(t+1), cut at the steps that end an episode and vectorized over the envs.
+        last_values are the values of the states following the rollout.
+    '''
+    not_done = 1.0 - np.asarray(dones, dtype=np.float64)
+    next_values = np.concatenate([values[1:], np.asarray(last_values, dtype=np.float64)[None]])
+    deltas = rewards + gamma * next_values * not_done - values
+    advantages = np.zeros_like(deltas)
+    A = np.zeros(deltas.shape[1:])
+    for t in reversed(range(len(deltas))):
+        A = deltas[t] + gamma * lam * not_done[t] * A
+        advantages[t] = A
+    return advantages
+
+
+class RolloutBuffer:
+    '''
+        A fixed-length rollout of n_steps ticks of n_envs envs in preallocated (n_steps, n_envs) arrays, with the
+        values and the log-probabilities of the actions under the policy that collected it. After
+        compute_advantages, minibatches reuses the rollout for several shuffled epochs.
+    '''
+
+    def __init__(self, n_steps, n_envs, state_size):
+        self.n_steps = n_steps
+        self.n_envs = n_envs
+        self.states = np.zeros((n_steps, n_envs, state_size), dtype=np.float32)
+        self.actions = np.zeros((n_steps, n_envs), dtype=np.int64)
+        self.rewards = np.zeros((n_steps, n_envs))
+        self.dones = np.zeros((n_steps, n_envs))
+        self.values = np.zeros((n_steps, n_envs))
+        self.log_probs = np.zeros((n_steps, n_envs))
+        self.advantages = np.zeros((n_steps, n_envs))
+        self.returns = np.zeros((n_steps, n_envs))
+        self.t = 0
+
+    def full(self):
+        return self.t == self.n_steps
+
+    def reset(self):
+        self.t = 0
+
+    def add(self, states, actions, rewards, dones, values, log_probs):
+        t = self.t
+        self.states[t] = states
+        self.actions[t] = actions
+        self.rewards[t] = rewards
+        self.dones[t] = dones
+        self.values[t] = values
+        self.log_probs[t] = log_probs
+        self.t += 1
+
+    def compute_advantages(self, last_values, gamma, lam=0.95):
+        '''
+            GAE advantages, and the returns A_t + V(S_t) the critic is fitted to
+        '''
+        self.advantages[:] = gae_advantages(self.rewards, self.values, self.dones, last_values, gamma, lam)
+        self.returns[:] = self.advantages + self.values
+
+    def minibatches(self, batch_size, n_epochs, rng=np.random, normalize_advantages=True):
+        '''
+            Yield n_epochs shuffled passes over the flattened rollout, in minibatches of batch_size transitions
+            (dicts of states, actions, log_probs, advantages and returns). The advantages are normalized over the
+            whole rollout.
+        '''
+        n = self.n_steps * self.n_envs
+        data = {
+            'states': self.states.reshape(n, -1),
+            'actions': self.actions.ravel(),
+            'log_probs': self.log_probs.ravel(),
+            'advantages': self.advantages.ravel(),
+            'returns': self.returns.ravel(),
+        }
+        if normalize_advantages:
+            data['advantages'] = (data['advantages'] - data['advantages'].mean()) / (data['advantages'].std() + 1e-8)
+        for _ in range(n_epochs):
+            order = rng.permutation(n)
+            for start in range(0, n, batch_size):
+                idx = order[start:start + batch_size]
+                yield {k: v[idx] for k, v in data.items()}
@@ -1,13 +1,14 @@
+import copy
 import random
+import sys
 from os import path
 import gym
 import datetime
 from keras.models import Sequential
 from keras.layers import Dense, Dropout, BatchNormalization
 from keras.optimizers import Adam, RMSprop, SGD
-# import tensorflow as tf
+import tensorflow as tf
 import pandas as pd
-from collections import deque
 from typing import Tuple, List, Union
 from tqdm import tqdm
 import numpy as np
@@ -15,6 +16,18 @@ import matplotlib.pyplot as plt
 import argparse
 import inspect
 import json
+import time
+from replay import ReplayBuffer
+from replay_dataset import ReplayDataset
+from async_actors import AsyncActors
+
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), '..'))
+from common.rolling_stats import RollingStats
+from common.policy_runtime import NumpyPolicy
+from common.evaluation import evaluate_policy
+from common.checkpoint import AsyncCheckpointer, load_checkpoint, rng_state, set_rng_state
+from common.profiler import Profiler, NULL_PROFILER
+from common.metrics import MetricsSink, TensorBoardBackend
 
 OPTIMIZERS = {
     'Adam': Adam,
@@ -23,29 +36,6 @@ OPTIMIZERS = {
 }
 
 
-class ExperienceReplay:
-    def __init__(self, size: int):
-        self.size: int = size
-        self._exp_rep: deque = deque([], maxlen=size)
-
-    def append(self, experience):
-        self._exp_rep.append(experience)
-
-    def sample(self, batch_size: int):
-        rand_sample = random.sample(self._exp_rep, batch_size)
-        dict_batch = {
-            'states': np.stack([b_step[0] for b_step in rand_sample]),
-            'actions': np.array([b_step[1] for b_step in rand_sample]),
-            'rewards': np.array([b_step[2] for b_step in rand_sample]),
-            'next_states': np.stack([b_step[3] for b_step in rand_sample]),
-            'dones': np.array([b_step[4] for b_step in rand_sample])
-        }
-        return dict_batch
-
-    def __len__(self):
-        return self._exp_rep.__len__()
-
-
 class DQN():
     def __init__(
             self, env: gym.Env, double_dqn: bool = False, hidden_dims: List[int] = [16, 32, 32, 16, 16],
@@ -57,7 +47,8 @@ class DQN():
             verbose: Union[str, int] = 0,
             final_activation: str = 'relu', optimizer_name: str = 'Adam', loss_fn_name: str = 'mse',
             dropout: float = 0.1, batch_norm: bool = False,
-            kernel_initializer: str = 'he_normal', report_interval: int = 5, save_interval: int = 200):
+            kernel_initializer: str = 'he_normal', report_interval: int = 5, save_interval: int = 200,
+            save_replay: bool = True, replay_dataset: str = None):
         assert optimizer_name in OPTIMIZERS.keys(), "Unknown optimizer"
         self.env = env
         self.double_dqn = double_dqn
@@ -79,18 +70,25 @@ class DQN():
         self.final_activation = final_activation
         self.optimizer_name = optimizer_name
         self.loss_fn_name = loss_fn_name
+        self.loss_fn = tf.keras.losses.get(loss_fn_name)
         self.kernel_initializer = kernel_initializer
         self.verbose = verbose
         self.learning_epochs = learning_epochs
         self.batch_size = batch_size
         self.report_interval = report_interval
-        self.replay_buffer = ExperienceReplay(buffer_size)
+        self.replay_buffer = ReplayBuffer(buffer_size, self.state_space)
         self.save_interval = save_interval
+        self.save_replay = save_replay
+        self.replay_dataset = replay_dataset
         self.dropout = dropout
         self.bn = batch_norm
         self.q = self._build_model()
         self.q_target = self._build_model()
+        # NumPy copy of q used to act, re-exported whenever q may have changed
+        self.policy = NumpyPolicy.from_keras(self.q, head='argmax')
         self.train_log_dir = self._setup_tensorboard()
+        # the summaries are queued and written to TensorBoard by a background thread, a sink per training run
+        self.metrics = None
         self.opt_init_states = [var.value() for var in self.q.optimizer.variables()]
         m_args = locals().copy()
         m_args.pop('self')
@@ -98,12 +96,17 @@ class DQN():
         with open(path.join(self.train_log_dir, 'params.json'), 'w') as f:
             f.write(json.dumps(m_args, indent=4))
 
-        self.running_rews = deque([], maxlen=100)
+        self.running_rews = RollingStats(windows=(100,), threshold=450)
 
-        self.ckpt = tf.train.Checkpoint(step=tf.Variable(1), q=self.q, target=self.q_target)
-        self.ckpt_mgr = tf.train.CheckpointManager(self.ckpt, path.join(self.train_log_dir, 'tf_ckpts'), max_to_keep=3)
+        # full training state, written in the background (see snapshot and resume)
+        self.checkpointer = AsyncCheckpointer(path.join(self.train_log_dir, 'ckpts'), max_to_keep=3)
+        self.epoch = -1
+        # set by resume when the replay buffer comes from the checkpoint, which then replaces the decorrelation steps
+        self.replay_restored = False
 
         self.q_updates = []
+        # phase timers of the training loop (see common.profiler), replace with a Profiler to enable them
+        self.profiler = NULL_PROFILER
 
     def _build_model(self):
         net = Sequential()
@@ -118,8 +121,59 @@ class DQN():
         net.compile(loss=self.loss_fn_name, optimizer=OPTIMIZERS[self.optimizer_name](self.lr))
         return net
 
+    def snapshot(self):
+        '''
+            Copy of everything needed to resume the training after the current epoch: both networks, the optimizer
+            variables and learning rate, the epsilon and lr schedules, the random generators, the statistics and,
+            with save_replay, the replay buffer
+        '''
+        state = {
+            'epoch': self.epoch,
+            'q': self.q.get_weights(),
+            'q_target': self.q_target.get_weights(),
+            'optimizer': [var.numpy() for var in self.q.optimizer.variables()],
+            'optimizer_lr': float(self.q.optimizer.learning_rate.numpy()),
+            'epsilon': self.epsilon,
+            'epsilons': list(self.epsilons),
+            'lr': self.lr,
+            'rng': rng_state(),
+            'action_space_rng': copy.deepcopy(self.env.action_space.np_random.bit_generator.state),
+            'running_rews': copy.deepcopy(self.running_rews),
+        }
+        # a ReplayDataset (train_offline) is on disk already
+        if self.save_replay and isinstance(self.replay_buffer, ReplayBuffer):
+            state['replay_buffer'] = self.replay_buffer.state_dict()
+        return state
+
+    def resume(self, checkpoint):
+        '''
+            Restore the training state from a checkpoint file, or from the latest checkpoint of a directory. train
+            and train_async then continue from the epoch following the checkpoint, and skip the decorrelation steps
+            when the replay buffer was restored.
+        '''
+        _, state = load_checkpoint(checkpoint)
+        self.q.set_weights(state['q'])
+        self.q_target.set_weights(state['q_target'])
+        if len(self.q.optimizer.variables()) < len(state['optimizer']):
+            # the slots of the optimizer are only created by its first step
+            self.q.optimizer.build(self.q.trainable_variables)
+        for var, value in zip(self.q.optimizer.variables(), state['optimizer']):
+            var.assign(value)
+        self.q.optimizer.learning_rate = state['optimizer_lr']
+        self.epoch = state['epoch']
+        self.epsilon = state['epsilon']
+        self.epsilons = state['epsilons']
+        self.lr = state['lr']
+        set_rng_state(state['rng'])
+        self.env.action_space.np_random.bit_generator.state = state['action_space_rng']
+        self.running_rews = state['running_rews']
+        if 'replay_buffer' in state:
+            self.replay_buffer.load_state_dict(state['replay_buffer'])
+            self.replay_restored = True
+        self.policy = NumpyPolicy.from_keras(self.q, head='argmax')
+
     def _save_model(self):
-        self.ckpt_mgr.save()
+        self.checkpointer.save(self.epoch, self.snapshot())
 
     def _setup_tensorboard(self):
         current_time = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
@@ -127,8 +181,16 @@ class DQN():
         self.summary_writer = tf.summary.create_file_writer(train_log_dir)
         return train_log_dir
 
+    @tf.function
+    def _copy_to_target(self):
+        '''
+            q_target <- q, variable to variable inside the graph, without the numpy round trip of get/set_weights
+        '''
+        for target, source in zip(self.q_target.variables, self.q.variables):
+            target.assign(source)
+
     def _update_target(self):
-        self.q_target.set_weights(self.q.get_weights())
+        self._copy_to_target()
         for val, var in zip(self.opt_init_states, self.q.optimizer.variables()):
             var.assign(val)
         self.q.optimizer.learning_rate = self.lr
@@ -148,27 +210,53 @@ class DQN():
         if epsilon > random.random():
             action = self.env.action_space.sample()
         else:
-            action = np.argmax(self.q(state))
+            action = int(self.policy(state)[0])
         return action
 
-    def learn(self):
-        batch = self.replay_buffer.sample(self.batch_size)
-        gamma = (1 - batch['dones']) * self.gamma
+    @tf.function
+    def _train_step(self, states, actions, rewards, next_states, dones):
+        '''
+            One compiled gradient step on a sampled batch. The standard or double DQN target is computed in-graph
+            and the loss is taken on the Q values of the actions taken only, divided by the number of actions: the
+            fit() on a full target row it replaces averaged over all of them, the other entries contributing zero.
+            Returns the loss.
+        '''
         if self.double_dqn:
-            decoupled_action = np.argmax(self.q(batch['next_states']), axis=1)
-            y = batch['rewards'] + gamma * tf.gather(params=self.q_target(batch['next_states']),
-                                                     indices=decoupled_action,
-                                                     batch_dims=1)
+            decoupled_action = tf.argmax(self.q(next_states, training=False), axis=1)
+            next_values = tf.gather(self.q_target(next_states, training=False), decoupled_action, batch_dims=1)
         else:
-            y = batch['rewards'] + gamma * np.max(self.q_target(batch['next_states']), axis=1)
-        y_q = self.q(batch['states']).numpy()  # Predict Qs on all actions
-        y_q[np.arange(len(y_q)).tolist(), batch['actions'].astype(
-            int).tolist()] = y  # Change the values of the actual actions to target (y)
-        loss = self.q.fit(batch['states'], y_q, batch_size=self.batch_size, verbose=0).history[
-            'loss']  # loss != 0 only on actual actions takes
+            next_values = tf.reduce_max(self.q_target(next_states, training=False), axis=1)
+        y = rewards + (1.0 - tf.cast(dones, tf.float32)) * self.gamma * next_values
+        with tf.GradientTape() as tape:
+            q_taken = tf.gather(self.q(states, training=True), actions, batch_dims=1)
+            loss = tf.reduce_mean(self.loss_fn(y[:, None], q_taken[:, None])) / self.action_space
+        grads = tape.gradient(loss, self.q.trainable_variables)
+        self.q.optimizer.apply_gradients(zip(grads, self.q.trainable_variables))
         return loss
 
+    def learn(self):
+        '''
+            learning_epochs compiled gradient steps, each on a batch freshly sampled from the replay buffer.
+            Returns their losses.
+        '''
+        losses = []
+        prof = self.profiler
+        for _ in range(self.learning_epochs):
+            with prof.phase('replay_sample'):
+                batch = self.replay_buffer.sample(self.batch_size)
+            with prof.phase('train_step'):
+                loss = self._train_step(tf.constant(batch['states']), tf.constant(batch['actions'].astype(np.int32)),
+                                        tf.constant(batch['rewards']), tf.constant(batch['next_states']),
+                                        tf.constant(batch['dones']))
+                losses.append(float(loss))
+            prof.count('updates')
+        return losses
+
     def collect_batch(self, n_steps, epsilon=None, show_progress=False):
+        prof = self.profiler
+        # q only changes in learn(), so one export per batch keeps the per-step actions off Keras
+        with prof.phase('policy_export'):
+            self.policy = NumpyPolicy.from_keras(self.q, head='argmax')
         ep_lengths = []
         episodes = 0
         episode_steps = 0
@@ -178,19 +266,26 @@ class DQN():
             pbar = tqdm(total=n_steps)
         for step_num in range(
                 10000):  # larger than n_steps to make sure we finish the episodes, but no too large so infinite episodes will not result in infinite loops
-            action = self.get_action(np.expand_dims(state, 0), epsilon)
-            next_state, reward, done, info = self.env.step(action)
-            if done:
-                # This will throw a warning, but it is the only way to know if the episode was truncated or terminated
-                _, tmp_reward, _, _ = self.env.step(self.env.action_space.sample())
-                if tmp_reward < 1.0:
-                    reward = -10
+            with prof.phase('action'):
+                action = self.get_action(np.expand_dims(state, 0), epsilon)
+            with prof.phase('env_step'):
+                next_state, reward, done, info = self.env.step(action)
+                if done:
+                    # This will throw a warning, but it is the only way to know if the episode was truncated or
+                    # terminated
+                    _, tmp_reward, _, _ = self.env.step(self.env.action_space.sample())
+                    if tmp_reward < 1.0:
+                        reward = -10
+            prof.count('env_steps')
             episode_steps += 1
-            self.replay_buffer.append([state, action, reward, next_state, done])
+            with prof.phase('replay_append'):
+                self.replay_buffer.append(state, action, reward, next_state, done)
             assert len(self.replay_buffer) <= self.replay_buffer.size
             state = next_state
             if done:
-                state = self.env.reset()
+                with prof.phase('env_reset'):
+                    state = self.env.reset()
+                prof.count('episodes')
                 episodes += 1
                 ep_lengths.append(episode_steps)
                 episode_steps = 0
@@ -204,23 +299,15 @@ class DQN():
         ep_lengths.append(episode_steps)
         return ep_reward / episodes, sum(ep_lengths) / len(ep_lengths)
 
-    def evaluate(self, n_ep=5):
-        rewards = []
-        ep_lengths = []
-        for _ in range(n_ep):
-            episode_steps = 0
-            rewards.append(0)
-            state = self.env.reset()
-            for step_num in range(500):
-                action = np.argmax(self.q(np.expand_dims(state, 0)))
-                next_state, reward, done, info = self.env.step(action)
-                rewards[-1] += 1
-                if done:
-                    ep_lengths.append(episode_steps)
-                    break
-                state = next_state
-                episode_steps += 1
-        return (rewards, ep_lengths)
+    def evaluate(self, n_ep=5, seed=None):
+        '''
+            Greedy evaluation of n_ep episodes run in lockstep (see common.evaluation.evaluate_policy), seeded with
+            seed, seed + 1, ... (a random seed by default). The tail statistics are kept in self.eval_stats.
+        '''
+        self.policy = NumpyPolicy.from_keras(self.q, head='argmax')
+        seed = np.random.randint(2 ** 31 - n_ep) if seed is None else seed
+        rewards, ep_lengths, self.eval_stats = evaluate_policy(self.policy, self.env.spec.id, n_ep, seed)
+        return (list(rewards), list(ep_lengths))
 
     def output_report(self):
         fig, ax = plt.subplots(2, 2, figsize=(10, 10))
@@ -234,42 +321,144 @@ class DQN():
         plt.savefig('progress.png')
         plt.close('all')
 
-    def train(self, n_epochs):
-        self.ckpt.step.assign_add(1)
+    def _write_summaries(self, ep, loss, rews, lengths):
+        self.metrics.scalars({
+            'loss': np.mean(loss),
+            'Avg_reward': np.mean(rews),
+            'Avg_len': np.mean(lengths),
+            'Running_Avg_Rew': self.running_rews.mean(100),
+            'Epsilon': self.epsilon,
+            'Learning_rate': self.q.optimizer.lr.numpy(),
+        }, step=ep)
+
+    def _end_epoch(self, ep, loss):
+        '''
+            Reporting, target update and checkpointing after the learning step of an epoch.
+            Returns True once the target is reached.
+        '''
+        prof = self.profiler
+        if ep % self.report_interval == 0:
+            with prof.phase('evaluate'):
+                self.last_eval = self.evaluate()
+            self.running_rews.extend(self.last_eval[0])
+            with prof.phase('logging'):
+                self._write_summaries(ep, loss, *self.last_eval)
+        if ep % self.target_update_interval == 0:
+            with prof.phase('target_update'):
+                self._update_target()
+        if ep % self.save_interval == 0:
+            with prof.phase('checkpoint'):
+                self._save_model()
+        if self.running_rews.mean(100) > self.running_rews.threshold:
+            self._save_model()
+            # running_rews only moves at the reports, whose summaries are written already
+            print('Reached Target!!!!')
+            return True
+        return False
+
+    def _fill_replay(self, collect):
+        '''
+            Get the replay buffer to min_steps_learn transitions before learning: from the replay_dataset when it
+            has some, otherwise with collect(), whose transitions are then saved to the replay_dataset so the next
+            runs skip the collection. A replay buffer restored by resume, or warm-started from the dataset, is used
+            as it is (its length stays below its size, the episode ends taking observation-only slots).
+        '''
+        if self.replay_restored or len(self.replay_buffer) >= self.min_steps_learn:
+            return
+        if self.replay_dataset is not None and path.exists(path.join(self.replay_dataset, 'meta.json')):
+            dataset = ReplayDataset(self.replay_dataset)
+            if len(dataset):
+                self.replay_buffer.load_dataset(dataset)
+                print(f'warm start from {len(dataset)} transitions of {self.replay_dataset}')
+                return
         print('collecting decorrelation steps')
-        avg_rew, avg_len = self.collect_batch(self.min_steps_learn, epsilon=1, show_progress=True)
+        collect()
+        if self.replay_dataset is not None:
+            dataset = ReplayDataset(self.replay_dataset, self.state_space, mode='a')
+            self.replay_buffer.export(dataset)
+            dataset.close()
+
+    def train(self, n_epochs):
+        self._fill_replay(lambda: self.collect_batch(self.min_steps_learn, epsilon=1, show_progress=True))
         self.n_epochs = n_epochs
         print(f'Training for {n_epochs} epochs')
-        for ep in tqdm(range(n_epochs)):
-            self.epoch = ep
-            self._update_eps()
-            _, _ = self.collect_batch(self.steps_per_epoch)
-            loss = self.learn()
-            if ep % self.report_interval == 0:
-                rews, lengths = self.evaluate()
-                self.running_rews.extend(rews)
-                with self.summary_writer.as_default():
-                    tf.summary.scalar('loss', loss[0], step=ep)
-                    tf.summary.scalar('Avg_reward', np.mean(rews), step=ep)
-                    tf.summary.scalar('Avg_len', np.mean(lengths), step=ep)
-                    tf.summary.scalar('Running_Avg_Rew', np.mean(self.running_rews), step=ep)
-                    tf.summary.scalar('Epsilon', self.epsilon, step=ep)
-                    tf.summary.scalar('Learning_rate', self.q.optimizer.lr.numpy(), step=ep)
-            if ep % self.target_update_interval == 0:
-                self._update_target()
-            if ep % self.save_interval == 0:
-                self._save_model()
-            if np.mean(self.running_rews) > 450:
-                self._save_model()
-                print('Reached Target!!!!')
-                with self.summary_writer.as_default():
-                    tf.summary.scalar('loss', loss[0], step=ep)
-                    tf.summary.scalar('Avg_reward', np.mean(rews), step=ep)
-                    tf.summary.scalar('Avg_len', np.mean(lengths), step=ep)
-                    tf.summary.scalar('Running_Avg_Rew', np.mean(self.running_rews), step=ep)
-                    tf.summary.scalar('Epsilon', self.epsilon, step=ep)
-                    tf.summary.scalar('Learning_rate', self.q.optimizer.lr.numpy(), step=ep)
-                break
+        self.metrics = MetricsSink([TensorBoardBackend(self.summary_writer)])
+        try:
+            for ep in tqdm(range(self.epoch + 1, n_epochs)):
+                self.epoch = ep
+                self._update_eps()
+                with self.profiler.phase('collect'):
+                    _, _ = self.collect_batch(self.steps_per_epoch)
+                with self.profiler.phase('learn'):
+                    loss = self.learn()
+                if self._end_epoch(ep, loss):
+                    break
+        finally:
+            self.checkpointer.wait()
+            self.metrics.close()
+
+    def train_async(self, n_epochs, n_actors=4, weight_sync_interval=4):
+        '''
+            Like train, but the transitions come from n_actors actor processes (see async_actors.AsyncActors) that
+            keep playing CartPole while the learner trains, so collection and learning overlap instead of
+            alternating. The actors' copy of q is refreshed every weight_sync_interval epochs.
+        '''
+        actors = AsyncActors(self.env.spec.id, self.q, n_actors)
+        actors.set_epsilon(1)
+        actors.start()
+        self.metrics = MetricsSink([TensorBoardBackend(self.summary_writer)])
+        try:
+            def collect():
+                # counted like the steps of collect_batch: len(replay_buffer) stays below its size, as the episode
+                # ends take observation-only slots
+                n_collected = 0
+                while n_collected < self.min_steps_learn:
+                    n_drained = actors.drain(self.replay_buffer)
+                    n_collected += n_drained
+                    if not n_drained:
+                        time.sleep(0.01)
+
+            self._fill_replay(collect)
+            self.n_epochs = n_epochs
+            print(f'Training for {n_epochs} epochs')
+            for ep in tqdm(range(self.epoch + 1, n_epochs)):
+                self.epoch = ep
+                self._update_eps()
+                actors.set_epsilon(self.epsilon)
+                with self.profiler.phase('replay_drain'):
+                    actors.drain(self.replay_buffer)
+                with self.profiler.phase('learn'):
+                    loss = self.learn()
+                if ep % weight_sync_interval == 0:
+                    with self.profiler.phase('publish_weights'):
+                        actors.publish(self.q)
+                if self._end_epoch(ep, loss):
+                    break
+        finally:
+            actors.stop()
+            self.checkpointer.wait()
+            self.metrics.close()
+
+    def train_offline(self, n_epochs):
+        '''
+            Train on the logged transitions of the replay_dataset alone, with the batches sampled straight from its
+            files, so the dataset can be far larger than the memory. Evaluation, target updates and checkpoints are
+            the ones of train.
+        '''
+        self.replay_buffer = ReplayDataset(self.replay_dataset)
+        self.n_epochs = n_epochs
+        print(f'Training offline for {n_epochs} epochs on {len(self.replay_buffer)} transitions')
+        self.metrics = MetricsSink([TensorBoardBackend(self.summary_writer)])
+        try:
+            for ep in tqdm(range(self.epoch + 1, n_epochs)):
+                self.epoch = ep
+                self._update_eps()
+                loss = self.learn()
+                if self._end_epoch(ep, loss):
+                    break
+        finally:
+            self.checkpointer.wait()
+            self.metrics.close()
 
 
 def parse_args():
@@ -282,6 +471,10 @@ def parse_args():
 
     for arg in args.keys():
         parser.add_argument(f'--{arg}', type=args[arg][0], default=args[arg][1], required=False)
+    # not DQN arguments: a checkpoint file or directory to continue the training from, and a file prefix for the
+    # phase timings (<prefix>.json summary and <prefix>.trace.json Chrome trace)
+    parser.add_argument('--resume', type=str, default=None, required=False)
+    parser.add_argument('--profile', type=str, default=None, required=False)
     args = vars(parser.parse_args())
     return (args)
 
@@ -317,6 +510,18 @@ if __name__ == '__main__':
     device = tf.test.gpu_device_name() if len(tf.config.list_physical_devices('GPU')) > 0 else '/device:CPU:0'
     with tf.device(device):
         print(f"Device: {device}")
+        resume = args.pop('resume')
+        profile = args.pop('profile')
         dqn = DQN(env, **args)
-        dqn.train(10000)
+        if resume is not None:
+            dqn.resume(resume)
+        if profile is not None:
+            dqn.profiler = Profiler()
+        try:
+            dqn.train(10000)
+        finally:
+            if profile is not None:
+                print(dqn.profiler.report())
+                dqn.profiler.save_summary(profile + '.json')
+                dqn.profiler.save_chrome_trace(profile + '.trace.json')
     # basic_plotter()
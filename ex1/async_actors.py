@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import multiprocessing as mp
+import gym
+import numpy as np
+from shm_arrays import SharedArrays
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.policy_runtime import NumpyPolicy
+
+
+def actor_loop(actor_id, env_id, shapes, activations, ring, shared, seed, refresh_interval):
+    '''
+        One actor process: plays the env with an epsilon-greedy policy over its local NumpyPolicy copy of q and
+        pushes every transition into its ring in the shared memory. The weights are refreshed from the learner's
+        published copy every refresh_interval steps.
+    '''
+    env = gym.make(env_id)
+    rng = np.random.default_rng(seed)
+    capacity = ring['states'].shape[1]
+    policy, version = None, -1
+    state, _ = env.reset(seed=seed)
+    step = 0
+    while not shared['stop'][0]:
+        if step % refresh_interval == 0:
+            params, version = _read_weights(shared, version)
+            if params is not None:
+                policy = NumpyPolicy.from_flat(params, shapes, activations, head='argmax')
+        if policy is None or rng.random() < shared['epsilon'][0]:
+            action = env.action_space.sample()
+        else:
+            action = int(policy(state))
+        next_state, reward, terminated, truncated, _ = env.step(action)
+        if terminated:
+            # failing before the time limit is penalized like in DQN.collect_batch
+            reward = -10
+
+        # back-pressure: wait for the learner to drain the ring when it is full
+        while ring['written'][actor_id] - ring['read'][actor_id] >= capacity:
+            if shared['stop'][0]:
+                return
+            time.sleep(0.0005)
+        i = ring['written'][actor_id] % capacity
+        ring['states'][actor_id, i] = state
+        ring['actions'][actor_id, i] = action
+        ring['rewards'][actor_id, i] = reward
+        ring['next_states'][actor_id, i] = next_state
+        ring['dones'][actor_id, i] = terminated
+        ring['episode_ends'][actor_id, i] = terminated or truncated
+        # publish the slot only after it is written
+        ring['written'][actor_id] += 1
+
+        state = env.reset()[0] if terminated or truncated else next_state
+        step += 1
+    env.close()
+
+
+def _read_weights(shared, version):
+    # seqlock read: the version is odd while the learner writes, and must not change during the copy.
+    # Returns the new parameters (None when there is no new consistent copy) and their version.
+    new_version = int(shared['version'][0])
+    if new_version == version or new_version % 2 or new_version == 0:
+        return None, version
+    params = shared['weights'].copy()
+    if int(shared['version'][0]) != new_version:
+        return None, version
+    return params, new_version
+
+
+class AsyncActors:
+    '''
+        n_actors processes collecting transitions while the learner trains. Each actor writes into its own ring of
+        ring_size transitions in shared memory, and the learner drains the rings into its replay buffer (one stream
+        per actor). The learner publishes q, exported as a NumpyPolicy, into a shared flat array that the actors
+        poll.
+    '''
+
+    def __init__(self, env_id, model, n_actors=4, ring_size=4096, refresh_interval=100, seed=0):
+        self.env_id = env_id
+        self.n_actors = n_actors
+        self.refresh_interval = refresh_interval
+        self.seed = seed
+        policy = NumpyPolicy.from_keras(model)
+        self.shapes, self.activations = policy.shapes, policy.activations
+        state_dim = model.input_shape[-1]
+        self.ring = SharedArrays({
+            'states': ((n_actors, ring_size, state_dim), np.float32),
+            'actions': ((n_actors, ring_size), np.int8),
+            'rewards': ((n_actors, ring_size), np.float32),
+            'next_states': ((n_actors, ring_size, state_dim), np.float32),
+            'dones': ((n_actors, ring_size), bool),
+            'episode_ends': ((n_actors, ring_size), bool),
+            'written': ((n_actors,), np.int64),
+            'read': ((n_actors,), np.int64),
+        })
+        self.shared = SharedArrays({
+            'weights': ((policy.params.size,), np.float32),
+            'version': ((1,), np.int64),
+            'epsilon': ((1,), np.float64),
+            'stop': ((1,), bool),
+        })
+        self.processes = []
+
+    def start(self):
+        # spawn, as forking a process that runs tensorflow is unsafe. The actors still import it, since spawn
+        # re-imports the learner's __main__ (DQN.py), but they never build a graph or start its runtime
+        ctx = mp.get_context('spawn')
+        self.processes = [ctx.Process(target=actor_loop, daemon=True,
+                                      args=(i, self.env_id, self.shapes, self.activations, self.ring, self.shared,
+                                            self.seed + i, self.refresh_interval))
+                          for i in range(self.n_actors)]
+        for p in self.processes:
+            p.start()
+
+    def publish(self, model):
+        '''
+            Publish the current weights of the model to the actors
+        '''
+        params = NumpyPolicy.from_keras(model).params
+        self.shared['version'][0] += 1
+        self.shared['weights'][:] = params
+        self.shared['version'][0] += 1
+
+    def set_epsilon(self, epsilon):
+        self.shared['epsilon'][0] = epsilon
+
+    def drain(self, replay_buffer):
+        '''
+            Move all the transitions written since the last drain into the replay buffer. Returns their number.
+        '''
+        ring, capacity = self.ring, self.ring['states'].shape[1]
+        n_total = 0
+        for a in range(self.n_actors):
+            read, written = int(ring['read'][a]), int(ring['written'][a])
+            if written == read:
+                continue
+            idx = np.arange(read, written) % capacity
+            replay_buffer.append_sequence(ring['states'][a, idx], ring['actions'][a, idx], ring['rewards'][a, idx],
+                                          ring['next_states'][a, idx], ring['dones'][a, idx],
+                                          ring['episode_ends'][a, idx], stream=a)
+            ring['read'][a] = written
+            n_total += written - read
+        return n_total
+
+    def stop(self):
+        self.shared['stop'][0] = True
+        for p in self.processes:
+            p.join()
+        self.ring.close()
+        self.shared.close()
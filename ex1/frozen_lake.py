@@ -0,0 +1,122 @@
+import numpy as np
+from scipy import sparse
+
+
+class FrozenLakeModel:
+    '''
+        The exact FrozenLake model taken from the env's own transition table (env.unwrapped.P), compiled into dense
+        arrays of shape (n_states, n_actions, n_outcomes). Missing outcomes are padded with zero probability so every
+        (state, action) pair has the same number of outcomes.
+    '''
+
+    def __init__(self, env):
+        P = env.unwrapped.P
+        self.n_states = env.observation_space.n
+        self.n_actions = env.action_space.n
+        self.n_outcomes = max(len(P[s][a]) for s in P for a in P[s])
+        shape = (self.n_states, self.n_actions, self.n_outcomes)
+        # padded outcomes stay in place with zero probability
+        self.next_states = np.broadcast_to(np.arange(self.n_states)[:, None, None], shape).copy()
+        self.probs = np.zeros(shape)
+        self.rewards = np.zeros(shape)
+        self.dones = np.zeros(shape, dtype=bool)
+        for s in P:
+            for a in P[s]:
+                for k, (prob, next_state, reward, done) in enumerate(P[s][a]):
+                    self.probs[s, a, k] = prob
+                    self.next_states[s, a, k] = next_state
+                    self.rewards[s, a, k] = reward
+                    self.dones[s, a, k] = done
+        # normalizing by the total makes the last entry exactly 1.0, so a uniform sample in [0, 1) always lands
+        # on a real outcome
+        cum_probs = np.cumsum(self.probs, axis=2)
+        self.cum_probs = cum_probs / cum_probs[:, :, -1:]
+        self.initial_state_distrib = np.asarray(env.unwrapped.initial_state_distrib, dtype=float)
+
+    def transition_matrix(self):
+        '''
+            Sparse (n_states * n_actions, n_states) matrix of the probabilities to continue from (s, a) into s'.
+            Transitions that end the episode are left out, so T @ V already excludes bootstrapping from terminal states.
+        '''
+        rows = np.broadcast_to(np.arange(self.n_states * self.n_actions)[:, None],
+                               (self.n_states * self.n_actions, self.n_outcomes))
+        probs = np.where(self.dones, 0.0, self.probs).reshape(rows.shape)
+        T = sparse.csr_matrix((probs.ravel(), (rows.ravel(), self.next_states.ravel())),
+                              shape=(self.n_states * self.n_actions, self.n_states))
+        T.eliminate_zeros()
+        return T
+
+    def expected_rewards(self):
+        '''
+            The expected immediate reward of every (s, a) pair, flattened to (n_states * n_actions,)
+        '''
+        return (self.probs * self.rewards).sum(axis=2).ravel()
+
+
+class BatchedFrozenLake:
+    '''
+        n_envs independent FrozenLake instances stepped together in pure NumPy. Every call to step advances all of
+        them by one transition sampled from the compiled model.
+    '''
+
+    def __init__(self, model, n_envs, rng=None):
+        self.model = model
+        self.n_envs = n_envs
+        self.rng = np.random.default_rng(0) if rng is None else rng
+        self.states = np.zeros(n_envs, dtype=np.int64)
+        self._initial_cum_probs = np.cumsum(model.initial_state_distrib)
+        self._initial_cum_probs /= self._initial_cum_probs[-1]
+
+    def reset(self, mask=None, u=None):
+        '''
+            Reset all the environments, or only the ones selected by the boolean mask. u optionally supplies the
+            uniform samples (one per reset env) instead of drawing them from self.rng.
+        '''
+        n = self.n_envs if mask is None else int(np.count_nonzero(mask))
+        u = self.rng.random(n) if u is None else u
+        initial_states = np.searchsorted(self._initial_cum_probs, u, side='right')
+        if mask is None:
+            self.states[:] = initial_states
+        else:
+            self.states[mask] = initial_states
+        return self.states
+
+    def step(self, actions, u=None):
+        '''
+            Advance every environment with its action. Returns the (next_states, rewards, dones) arrays.
+            u optionally supplies the uniform samples (one per env) instead of drawing them from self.rng.
+        '''
+        s, a = self.states, actions
+        u = self.rng.random(self.n_envs) if u is None else u
+        # inverse-CDF sampling of the outcome index over the (padded) outcomes of each (state, action)
+        k = np.count_nonzero(u[:, None] >= self.model.cum_probs[s, a], axis=1)
+        next_states = self.model.next_states[s, a, k]
+        rewards = self.model.rewards[s, a, k]
+        dones = self.model.dones[s, a, k]
+        self.states = next_states
+        return next_states, rewards, dones
+
+
+class MemberStreams:
+    '''
+        One independent RNG stream per population member. Uniforms are drawn in blocks of chunk ticks per member,
+        so the Python loop over the members runs once per chunk instead of once per tick, and every member sees the
+        same numbers whatever the size of the population it runs in.
+    '''
+
+    def __init__(self, seeds, n_per_tick, chunk=1024):
+        self.generators = [np.random.default_rng(seed) for seed in seeds]
+        self.n_per_tick = n_per_tick
+        self.chunk = chunk
+        self._tick = chunk
+
+    def next(self):
+        '''
+            The uniforms of the next tick, shaped (n_per_tick, n_members)
+        '''
+        if self._tick == self.chunk:
+            self._block = np.stack([g.random((self.chunk, self.n_per_tick)) for g in self.generators], axis=2)
+            self._tick = 0
+        u = self._block[self._tick]
+        self._tick += 1
+        return u
@@ -0,0 +1,91 @@
+import numpy as np
+from scipy import sparse
+from frozen_lake import FrozenLakeModel
+
+
+def q_from_values(T, R, V, gamma, n_states, n_actions):
+    '''
+        One Bellman backup: Q(s,a) = R(s,a) + gamma * sum_s' T(s,a,s') V(s')
+    '''
+    return (R + gamma * (T @ V)).reshape(n_states, n_actions)
+
+
+def value_iteration(env, gamma, tol=1e-10, max_iterations=100000):
+    '''
+        Vectorized value iteration over the exact model of the env. Stops when the largest change of V in a sweep
+        is below tol. Returns the Q table of the converged values, with the same (n_states, n_actions) layout as
+        the one learned by Q_learning.
+    '''
+    model = FrozenLakeModel(env)
+    T, R = model.transition_matrix(), model.expected_rewards()
+    V = np.zeros(model.n_states)
+    for _ in range(max_iterations):
+        Q = q_from_values(T, R, V, gamma, model.n_states, model.n_actions)
+        new_V = Q.max(axis=1)
+        delta = np.abs(new_V - V).max()
+        V = new_V
+        if delta < tol:
+            break
+    return q_from_values(T, R, V, gamma, model.n_states, model.n_actions)
+
+
+def policy_iteration(env, gamma, tol=1e-10, max_iterations=1000, max_evaluation_iterations=100000):
+    '''
+        Policy iteration over the exact model of the env. Every policy is evaluated iteratively up to tol (this also
+        works for gamma=1, where the linear system can be singular), then improved greedily. Stops when the greedy
+        policy is stable. Returns the Q table of the final policy.
+    '''
+    model = FrozenLakeModel(env)
+    T, R = model.transition_matrix(), model.expected_rewards()
+    rows = np.arange(model.n_states) * model.n_actions
+    policy = np.zeros(model.n_states, dtype=np.int64)
+    V = np.zeros(model.n_states)
+    for _ in range(max_iterations):
+        # policy evaluation on the rows of the chosen actions only
+        T_pi, R_pi = T[rows + policy], R[rows + policy]
+        for _ in range(max_evaluation_iterations):
+            new_V = R_pi + gamma * (T_pi @ V)
+            delta = np.abs(new_V - V).max()
+            V = new_V
+            if delta < tol:
+                break
+        # policy improvement, keeping the current action on ties so the loop terminates
+        Q = q_from_values(T, R, V, gamma, model.n_states, model.n_actions)
+        best = Q.max(axis=1)
+        new_policy = np.where(Q[np.arange(model.n_states), policy] >= best - tol, policy, Q.argmax(axis=1))
+        if np.array_equal(new_policy, policy):
+            break
+        policy = new_policy
+    return q_from_values(T, R, V, gamma, model.n_states, model.n_actions)
+
+
+def greedy_success_rate(env, Q, max_steps):
+    '''
+        The exact probability (in percent) that the greedy policy of Q collects the goal reward within max_steps,
+        computed on the absorbing Markov chain of the policy instead of sampled rollouts. Q can also be a stack of
+        Q tables of shape (K, n_states, n_actions); all K chains are then propagated together as one block-diagonal
+        sparse matrix, and an array of K success rates is returned.
+    '''
+    model = FrozenLakeModel(env)
+    Qs = np.asarray(Q)
+    single = Qs.ndim == 2
+    Qs = Qs[None] if single else Qs
+    K, S = Qs.shape[0], model.n_states
+    policies = np.argmax(Qs, axis=2)  # (K, S), ties broken like np.argmax in success_rate
+
+    # rows/cols of the block-diagonal chain: member k lives in the block [k*S, (k+1)*S)
+    offsets = (np.arange(K) * S)[:, None, None]
+    states = np.arange(S)[None, :, None]
+    probs = np.where(model.dones, 0.0, model.probs)[states, policies[:, :, None], np.arange(model.n_outcomes)]
+    rows = np.broadcast_to(offsets + states, probs.shape)
+    cols = offsets + model.next_states[states, policies[:, :, None], np.arange(model.n_outcomes)]
+    chain = sparse.csr_matrix((probs.ravel(), (cols.ravel(), rows.ravel())), shape=(K * S, K * S))
+    rewards = (model.probs * model.rewards).sum(axis=2)[np.arange(S)[None, :], policies].ravel()
+
+    d = np.tile(model.initial_state_distrib, K)
+    success = np.zeros(K * S)
+    for _ in range(max_steps):
+        success += d * rewards
+        d = chain @ d
+    rates = success.reshape(K, S).sum(axis=1) * 100
+    return rates[0] if single else rates
@@ -2,6 +2,9 @@ import gym
 import numpy as np
 from tqdm import tqdm
 import matplotlib.pyplot as plt
+from frozen_lake import FrozenLakeModel, BatchedFrozenLake, MemberStreams
+from planning import greedy_success_rate
+from snapshots import QSnapshotRecorder, render_snapshots
 np.random.seed(0)
 
 
@@ -17,7 +20,12 @@ def plot_Q(Q):
     plt.show()
 
 
-def success_rate(env, Q, max_steps):
+def success_rate(env, Q, max_steps, exact=True):
+    if exact:
+        # exact evaluation on the greedy policy's Markov chain (see planning.greedy_success_rate)
+        rate = greedy_success_rate(env, Q, max_steps)
+        print(f"Success rate = {rate}%")
+        return rate
     episodes = 100
     nb_success = 0
     # Evaluation
@@ -61,7 +69,15 @@ min_epsilon=0.001
 decay_ratio=0.2
 
 
-def Q_learning(env, alpha, gamma, n_episodes, max_steps, init_epsilon, min_epsilon, decay_ratio):
+def Q_learning(env, alpha, gamma, n_episodes, max_steps, init_epsilon, min_epsilon, decay_ratio, n_envs=1,
+               snapshots=None):
+    '''
+        snapshots is an optional QSnapshotRecorder, the Q table is recorded every snapshots.interval episodes and at
+        the end of the training (render the journal afterwards with render_snapshots)
+    '''
+    if n_envs > 1:
+        return Q_learning_batched(env, alpha, gamma, n_episodes, max_steps, init_epsilon, min_epsilon, decay_ratio,
+                                  n_envs, snapshots=snapshots)
     # Q-value initialization
     Q = np.zeros((n_states, n_actions))
     steps = []
@@ -100,14 +116,146 @@ def Q_learning(env, alpha, gamma, n_episodes, max_steps, init_epsilon, min_epsil
                     steps.append(100)
                 break
         returns.append(rewards)
-        if e == 500 or e == 2000:
-            print(f'Q-table after {e} episodes')
-            plot_Q(Q)
+        if snapshots is not None and snapshots.due(e):
+            snapshots.record(e, Q)
 
-    print(f'Final Q-table')
-    plot_Q(Q)
+    if snapshots is not None:
+        snapshots.record(n_episodes, Q)
     return Q, returns, steps
 
 
-Q, returns, steps = Q_learning(env, 0.1, 0.9, n_episodes, max_steps, 1.0, 0.01, 0.001)
-success_rate(env, Q, max_steps)
+def Q_learning_batched(env, alpha, gamma, n_episodes, max_steps, init_epsilon, min_epsilon, decay_ratio, n_envs=1024,
+                       rng=None, snapshots=None, counters=None):
+    '''
+        Q-learning over n_envs FrozenLake instances stepped together in NumPy (see frozen_lake.BatchedFrozenLake).
+        Every env slot plays one episode at a time and picks up the next episode index when it finishes, so the
+        epsilon schedule follows the episode index exactly like in Q_learning. All the transitions of a tick update
+        the shared Q table together: transitions hitting the same (state, action) pair are averaged into one target.
+        counters, when given a dict, gets 'transitions': the number of transitions actually played (the returned
+        steps count max_steps for every failed episode, however early it fell into a hole).
+    '''
+    rng = np.random.default_rng(0) if rng is None else rng
+    model = FrozenLakeModel(env)
+    n_envs = min(n_envs, n_episodes)
+    envs = BatchedFrozenLake(model, n_envs, rng)
+    Q = np.zeros((model.n_states, model.n_actions))
+    returns = np.zeros(n_episodes)
+    steps = np.full(n_episodes, max_steps)
+
+    state = envs.reset()
+    episode = np.arange(n_envs)
+    next_episode = n_envs
+    active = np.ones(n_envs, dtype=bool)
+    ep_rewards = np.zeros(n_envs)
+    current_step = np.zeros(n_envs, dtype=np.int64)
+    n_finished = 0
+    n_transitions = 0
+    pbar = tqdm(total=n_episodes)
+    while active.any():
+        epsilon = min_epsilon + (init_epsilon - min_epsilon) * np.exp(-decay_ratio * episode)
+        explore = rng.uniform(size=n_envs) <= epsilon
+        action = np.where(explore, rng.integers(model.n_actions, size=n_envs), np.argmax(Q[state], axis=1))
+        next_state, reward, done = envs.step(action)
+
+        target = np.where(done, reward, reward + gamma * Q[next_state].max(axis=1))
+        # average the targets of the active transitions per (state, action) cell
+        cell = (state * model.n_actions + action)[active]
+        counts = np.bincount(cell, minlength=Q.size)
+        sums = np.bincount(cell, weights=target[active], minlength=Q.size)
+        visited = counts > 0
+        Q_flat = Q.reshape(-1)
+        Q_flat[visited] = (1 - alpha) * Q_flat[visited] + alpha * sums[visited] / counts[visited]
+        n_transitions += int(np.count_nonzero(active))
+
+        ep_rewards += reward
+        current_step += 1
+        finished = active & (done | (current_step >= max_steps))
+        if finished.any():
+            ended = episode[finished]
+            returns[ended] = ep_rewards[finished]
+            steps[ended] = np.where(done[finished] & (reward[finished] > 0), current_step[finished], max_steps)
+            pbar.update(len(ended))
+            crossed = (n_finished + len(ended)) // snapshots.interval > n_finished // snapshots.interval \
+                if snapshots is not None else False
+            n_finished += len(ended)
+            if crossed:
+                snapshots.record(n_finished, Q)
+            # hand the next episode indices to the finished slots, slots with nothing left to play go idle
+            n_new = min(len(ended), n_episodes - next_episode)
+            slots = np.flatnonzero(finished)
+            episode[slots[:n_new]] = np.arange(next_episode, next_episode + n_new)
+            next_episode += n_new
+            active[slots[n_new:]] = False
+            ep_rewards[finished] = 0
+            current_step[finished] = 0
+            envs.reset(finished)
+        state = envs.states
+    pbar.close()
+    if snapshots is not None and n_episodes % snapshots.interval:
+        snapshots.record(n_episodes, Q)
+    if counters is not None:
+        counters['transitions'] = n_transitions
+    return Q, returns.tolist(), steps.tolist()
+
+
+def Q_learning_population(env, alphas, gammas, n_episodes, max_steps, init_epsilon, min_epsilon, decay_ratios, seeds):
+    '''
+        Trains K independent Q tables at once, stacked in one (K, n_states, n_actions) array. alphas, gammas,
+        decay_ratios and seeds are broadcast to K members, each member plays its own FrozenLake instance with its
+        own RNG stream and n_episodes episodes, and all members advance in lockstep. Members that finish their
+        episodes early go idle until the slowest one is done. Returns the stacked Q tables and the per-member
+        (K, n_episodes) returns and steps arrays.
+    '''
+    alphas, gammas, decay_ratios, seeds = np.broadcast_arrays(alphas, gammas, decay_ratios, seeds)
+    K = alphas.size
+    alphas, gammas, decay_ratios = alphas.ravel(), gammas.ravel(), decay_ratios.ravel()
+    model = FrozenLakeModel(env)
+    envs = BatchedFrozenLake(model, K)
+    # per tick: exploration, random action, transition and reset uniforms
+    streams = MemberStreams(seeds.ravel(), n_per_tick=4)
+    members = np.arange(K)
+    Q = np.zeros((K, model.n_states, model.n_actions))
+    returns = np.zeros((K, n_episodes))
+    steps = np.full((K, n_episodes), max_steps)
+
+    state = envs.reset(u=streams.next()[3])
+    episode = np.zeros(K, dtype=np.int64)
+    active = np.ones(K, dtype=bool)
+    ep_rewards = np.zeros(K)
+    current_step = np.zeros(K, dtype=np.int64)
+    pbar = tqdm(total=n_episodes)
+    while active.any():
+        u_explore, u_action, u_step, u_reset = streams.next()
+        epsilon = min_epsilon + (init_epsilon - min_epsilon) * np.exp(-decay_ratios * episode)
+        random_action = (u_action * model.n_actions).astype(np.int64)
+        action = np.where(u_explore <= epsilon, random_action, np.argmax(Q[members, state], axis=1))
+        next_state, reward, done = envs.step(action, u_step)
+
+        target = np.where(done, reward, reward + gammas * Q[members, next_state].max(axis=1))
+        m, s, a = members[active], state[active], action[active]
+        Q[m, s, a] = (1 - alphas[active]) * Q[m, s, a] + alphas[active] * target[active]
+
+        ep_rewards += reward
+        current_step += 1
+        finished = active & (done | (current_step >= max_steps))
+        if finished.any():
+            m, e = members[finished], episode[finished]
+            returns[m, e] = ep_rewards[finished]
+            steps[m, e] = np.where(done[finished] & (reward[finished] > 0), current_step[finished], max_steps)
+            episode[finished] += 1
+            active &= episode < n_episodes
+            ep_rewards[finished] = 0
+            current_step[finished] = 0
+            envs.reset(finished, u_reset[finished])
+            pbar.update(int(episode.min()) - pbar.n)
+        state = envs.states
+    pbar.close()
+    return Q, returns, steps
+
+
+if __name__ == '__main__':
+    snapshots = QSnapshotRecorder('q_snapshots.npy', (n_states, n_actions), n_episodes // 500 + 2, interval=500)
+    Q, returns, steps = Q_learning(env, 0.1, 0.9, n_episodes, max_steps, 1.0, 0.01, 0.001, snapshots=snapshots)
+    snapshots.close()
+    render_snapshots('q_snapshots.npy', 'q_snapshots.png')
+    success_rate(env, Q, max_steps)
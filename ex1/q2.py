@@ -1,3 +1,6 @@
+import copy
+import os
+import sys
 import gym
 import numpy as np
 from tqdm import tqdm
@@ -6,6 +9,18 @@ import random
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+from replay import ReplayBuffer, PrioritizedReplayBuffer
+from replay_dataset import ReplayDataset
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.rolling_stats import RollingStats
+from common.policy_runtime import NumpyPolicy
+from common.evaluation import evaluate_policy
+from common.checkpoint import AsyncCheckpointer, load_checkpoint, rng_state, set_rng_state
+from common.hparam_search import grid, successive_halving
+from common.profiler import NULL_PROFILER
+from common.metrics import MetricsSink
+from common.flat_params import FlatParams
 
 np.random.seed(0)
 torch.manual_seed(0)
@@ -71,34 +86,57 @@ class DQN():
         A class encapsulating the Deep Q-learning process (includes the model's and the training and testing procedures)
     '''
 
-    def __init__(self, batch_size, hidden_layers=[16, 32, 16], replay_buffer_memory_size=1000):
+    def __init__(self, batch_size, hidden_layers=[16, 32, 16], replay_buffer_memory_size=1000, prioritized_replay=False,
+                 priority_alpha=0.6, priority_beta=0.4, n_envs=1, profiler=None, metrics=None):
         self.batch_size = batch_size
+        # phase timers of the training loops (see common.profiler), no-ops by default
+        self.profiler = NULL_PROFILER if profiler is None else profiler
+        # per-episode scalars and the rate-limited progress line, written in the background (see common.metrics):
+        # each training run opens and closes its own sink, unless one is given here
+        self.metrics_sink = metrics
+        self.metrics = metrics
         self.env = ENV
         self.hidden_layers = hidden_layers
         self.Qnet = QNet(hidden_layers_size=hidden_layers)
         self.QNetTarget = QNet(hidden_layers_size=hidden_layers)
+        # both networks in flat buffers, so a target update is a single in-place operation (see update_target)
+        self.Qnet_params = FlatParams(self.Qnet)
+        self.QNetTarget_params = FlatParams(self.QNetTarget)
+        # greedy acting without torch dispatch, on views of Qnet's parameters so it follows the training in place
+        self.policy = NumpyPolicy.from_torch(self.Qnet, head='argmax', copy=False)
         n_states = self.env.observation_space
         n_actions = self.env.action_space
-        self.replay_buffer = []
-        self.replay_buffer_idx = 0
+        self.n_envs = n_envs
+        self.prioritized_replay = prioritized_replay
+        self.priority_beta = priority_beta
+        if prioritized_replay:
+            # sample according to the TD error as explained in the lecture
+            self.replay_buffer = PrioritizedReplayBuffer(replay_buffer_memory_size, n_states.shape[0], n_envs,
+                                                         alpha=priority_alpha, beta=priority_beta)
+        else:
+            self.replay_buffer = ReplayBuffer(replay_buffer_memory_size, n_states.shape[0], n_envs)
         self.replay_buffer_memory_size = replay_buffer_memory_size
-        self.replay_buffer_full = False
         self.acc_reward_list = []
+        # every window of the epsilon schedule and the stop rule, and the 100 runs of the plot
+        self.reward_stats = RollingStats(windows=(5, 10, 15, 25, 50, 75, 100, 130), threshold=475)
         self.loss_list = []
 
     def sample_minibatch(self):
         '''
             get a random minibatch from the memory buffer(from the last 5000 experiences)
+            with prioritized replay it also holds the sampled "indices" and their importance-sampling "weights"
         '''
-        minibatch = random.sample(self.replay_buffer,
-                                  self.batch_size)  # p=...) we can add a distribution here according to the td value as explained in the lecture
+        minibatch = self.replay_buffer.sample(self.batch_size, as_tensors=True)
         minibatch_dict = {
-            "state": torch.vstack([tup[0] for tup in minibatch]),
-            "action": torch.vstack([tup[1] for tup in minibatch]),
-            "reward": torch.vstack([torch.tensor(tup[2]) for tup in minibatch]),
-            "next_state": torch.vstack([torch.from_numpy(tup[3]) for tup in minibatch]),
-            "done": torch.vstack([torch.tensor(tup[4]) for tup in minibatch])
+            "state": minibatch["states"],
+            "action": minibatch["actions"].view(-1, 1),
+            "reward": minibatch["rewards"].view(-1, 1),
+            "next_state": minibatch["next_states"],
+            "done": minibatch["dones"].view(-1, 1)
         }
+        if self.prioritized_replay:
+            minibatch_dict["indices"] = minibatch["indices"]
+            minibatch_dict["weights"] = minibatch["weights"].view(-1, 1)
         return minibatch_dict
 
     def epsilon_greedy_action(self, epsilon, Qnet, state):
@@ -107,96 +145,237 @@ class DQN():
             This helps the model explore more and not get stuck in exploitation
         '''
         if np.random.uniform() > epsilon:  # ep
-            action = torch.argmax(self.Qnet(state))
+            action = int(self.policy(state.numpy()))
         else:
-            action = torch.tensor(random.randint(0, self.env.action_space.n - 1))
+            action = random.randint(0, self.env.action_space.n - 1)
         return action
 
-    def append_to_replay_buffer(self, item):
+    def evaluate(self, n_episodes=100, seed=0):
         '''
-            Add a new memory to the replay buffer.
-            This is a cyclic buffer, it will start rewriting itself when it is full
+            Greedy evaluation of n_episodes seeded episodes run in lockstep (see common.evaluation.evaluate_policy).
+            Returns the per-episode returns and lengths, and their tail statistics.
         '''
-        if self.replay_buffer_full:
-            self.replay_buffer[self.replay_buffer_idx] = item
-        else:
-            self.replay_buffer.append(item)
-        self.replay_buffer_idx = self.replay_buffer_idx + 1
-        if self.replay_buffer_idx >= self.replay_buffer_memory_size:
-            self.replay_buffer_idx = 0
-            self.replay_buffer_full = True
-
+        return evaluate_policy(self.policy, 'CartPole-v1', n_episodes, seed)
 
-    def test_agent(self, video = False):
-        env = gym.make('CartPole-v1')
-        if video:
-          from gym.wrappers.record_video import RecordVideo
-          env = RecordVideo(env, './video',  episode_trigger = lambda episode_number: True)
+    def test_agent(self, video = False, n_episodes=1):
+        if not video:
+            returns, _, _ = self.evaluate(n_episodes)
+            return returns.mean()
+        # recording needs a real env, played one episode at a time
+        from gym.wrappers.record_video import RecordVideo
+        env = RecordVideo(gym.make('CartPole-v1'), './video',  episode_trigger = lambda episode_number: True)
 
         state = env.reset()
-        state = torch.from_numpy(state).float()
         done = False
         rewards = 0
 
         while not done:
-            action = torch.argmax(self.Qnet(state))
-            next_state, reward, done, _  = env.step(action.item())
-            next_state = torch.from_numpy(next_state).float()
+            action = int(self.policy(state))
+            next_state, reward, done, _  = env.step(action)
             rewards += reward
             state = next_state
         env.close()
         return rewards
 
-    def train(self, n_episodes, T, epsilon, gamma, lr, C, improved_mode=False, min_epsilon=0.05, stable_epsilon=0.005):
+    def learn_step(self, Qnet_optimizer, gamma):
+        '''
+            Sample a minibatch and take one optimizer step on the temporal difference error. Returns the loss.
+        '''
+        with self.profiler.phase('replay_sample'):
+            minibatch = self.sample_minibatch()
+        # TODO: from this part and forward, not fully tested
+
+        # the error in DQN is the temporal difference function
+        with self.profiler.phase('forward_backward'):
+            Qnet_optimizer.zero_grad()
+            esstimation, reference = temporal_difference(self.QNetTarget,
+                                                         self.Qnet,
+                                                         minibatch["state"],
+                                                         minibatch["next_state"],
+                                                         minibatch["action"],
+                                                         minibatch["reward"],
+                                                         minibatch["done"],
+                                                         gamma)
+            # learning:
+
+            # MSE_loss = torch.mean(error**2)
+            if self.prioritized_replay:
+                criterion = nn.SmoothL1Loss(reduction='none')
+                loss = torch.mean(minibatch["weights"] * criterion(esstimation, reference))
+                td_error = (reference - esstimation).detach().numpy().ravel()
+            else:
+                criterion = nn.SmoothL1Loss()
+                loss = criterion(esstimation, reference)
+            loss.backward()
+            Qnet_optimizer.step()
+        if self.prioritized_replay:
+            with self.profiler.phase('priority_update'):
+                self.replay_buffer.update_priorities(minibatch["indices"], td_error)
+        return loss.item()
+
+    def update_target(self, ep, C, improved_mode, n_finished=1):
+        '''
+            Update Q-target after an episode: a soft update in improved mode, otherwise a hard copy every C episodes.
+            n_finished episodes ending together compound the soft update and trigger the hard copy when one of them
+            is a multiple of C.
+        '''
+        if improved_mode:
+            tau = 1 - (1 - 0.005) ** n_finished
+            self.QNetTarget_params.polyak_(self.Qnet_params, tau)
+        else:
+            if any(e % C == 0 for e in range(ep - n_finished + 1, ep + 1)):
+                self.QNetTarget_params.copy_(self.Qnet_params)
+
+    def plot_training(self):
+        plt.figure()
+
+        # means = np.array(self.acc_reward_list).unfold(0, 100, 1).mean(1).view(-1)
+        # means = torch.cat((torch.zeros(99), means))
+        # plt.plot(means.numpy())
+
+        running_avg_acc_reward = self.reward_stats.curve(100)
+        plt.plot(running_avg_acc_reward, linewidth=2.5)
+
+        plt.plot(self.acc_reward_list, alpha=0.7)
+        plt.ylabel("accumulated reward")
+        plt.xlabel("episode")
+        plt.legend(["accumulated reward", "average of last 100 runs"])
+
+        plt.figure()
+        plt.plot(self.loss_list, alpha=0.7)
+        plt.ylabel("loss")
+        plt.xlabel("episode")
+
+        plt.show()
+
+    def snapshot(self, next_episode, epsilon, step_counter, Qnet_optimizer, save_replay=True):
+        '''
+            Copy of everything train needs to continue from next_episode: both networks, the optimizer state,
+            epsilon, the random generators, the statistics and, with save_replay, the replay buffer
+        '''
+        state = {
+            'next_episode': next_episode,
+            'epsilon': epsilon,
+            'step_counter': step_counter,
+            'Qnet': {k: v.clone() for k, v in self.Qnet.state_dict().items()},
+            'QNetTarget': {k: v.clone() for k, v in self.QNetTarget.state_dict().items()},
+            'optimizer': copy.deepcopy(Qnet_optimizer.state_dict()),
+            'rng': rng_state(),
+            'acc_reward_list': list(self.acc_reward_list),
+            'loss_list': list(self.loss_list),
+            'reward_stats': copy.deepcopy(self.reward_stats),
+        }
+        if save_replay:
+            state['replay_buffer'] = self.replay_buffer.state_dict()
+        return state
+
+    def restore(self, state, Qnet_optimizer):
+        '''
+            Load a snapshot into the model and the optimizer. Returns the episode to continue from, epsilon and the
+            step counter.
+        '''
+        # in place, so the NumPy policy keeps viewing Qnet's parameters
+        self.Qnet.load_state_dict(state['Qnet'])
+        self.QNetTarget.load_state_dict(state['QNetTarget'])
+        Qnet_optimizer.load_state_dict(state['optimizer'])
+        set_rng_state(state['rng'])
+        self.acc_reward_list = state['acc_reward_list']
+        self.loss_list = state['loss_list']
+        self.reward_stats = state['reward_stats']
+        if 'replay_buffer' in state:
+            self.replay_buffer.load_state_dict(state['replay_buffer'])
+        return state['next_episode'], state['epsilon'], state['step_counter']
+
+    def _open_metrics(self):
+        if self.metrics_sink is None:
+            self.metrics = MetricsSink()
+
+    def _close_metrics(self):
+        '''
+            Stop the writer thread of the run's own sink, a sink given to the constructor is only flushed
+        '''
+        if self.metrics_sink is None:
+            self.metrics.close()
+        else:
+            self.metrics.flush(console=True)
+
+    def train(self, n_episodes, T, epsilon, gamma, lr, C, improved_mode=False, min_epsilon=0.05, stable_epsilon=0.005,
+              checkpoint_dir=None, checkpoint_interval=100, save_replay=True, replay_dataset=None, report=None):
         '''
             Train the model for n episodes with a max iteration count of T per episode using epsilon greedy policy with
-            a reward degradation of gamma a learning rate lr and update period for the target Q model of C iterations
+            a reward degradation of gamma a learning rate lr and update period for the target Q model of C iterations.
+            With a checkpoint_dir, the full training state is saved there in the background every checkpoint_interval
+            episodes, and a run started on a directory that already holds a checkpoint resumes from the latest one.
+            replay_dataset is the directory of a ReplayDataset: the replay buffer is warm-started from it when it
+            exists, otherwise the buffer is saved there at the end of the training.
+            report(episode, average reward of the last 100 episodes) is called after every episode, and the
+            training stops when it returns False (see common.hparam_search).
         '''
         # weight_decay = 0.00005
         Qnet_optimizer = torch.optim.Adam(self.Qnet.parameters(), lr=lr)
+        self._open_metrics()
         step_counter = 0
         flag = False
-        for ep in range(n_episodes):
+        start_episode = 0
+        checkpointer = None
+        if checkpoint_dir is not None:
+            checkpoint = load_checkpoint(checkpoint_dir) if os.path.isdir(checkpoint_dir) else None
+            if checkpoint is not None:
+                start_episode, epsilon, step_counter = self.restore(checkpoint[1], Qnet_optimizer)
+                print("resuming from episode {0}".format(start_episode))
+            checkpointer = AsyncCheckpointer(checkpoint_dir)
+        warm_started = replay_dataset is not None and os.path.exists(os.path.join(replay_dataset, 'meta.json'))
+        if warm_started and start_episode == 0:
+            self.replay_buffer.load_dataset(ReplayDataset(replay_dataset))
+        prof = self.profiler
+        for ep in range(start_episode, n_episodes):
             # add graphics every x episodes
             #            if ep%100==0:
             #               self.env = gym.make('CartPole-v1',render_mode="human") # graphics enabled
             #          else:
-            self.env = gym.make('CartPole-v1')  # graphics disabled
+            with prof.phase('env_reset'):
+                self.env = gym.make('CartPole-v1')  # graphics disabled
+                state, _ = self.env.reset()
+                state = torch.tensor(state)
+            if self.prioritized_replay:
+                # anneal the importance-sampling correction to 1 over the training
+                self.replay_buffer.beta = self.priority_beta + (1 - self.priority_beta) * ep / n_episodes
 
-            state, _ = self.env.reset()
-            state = torch.tensor(state)
             acc_reward = 0
             ep_loss_list = []
             for t in range(T):  # max T steps in each experience
                 # Early stopping
-                if sum(self.acc_reward_list[-130:]) / 130 > 475:
+                if self.reward_stats.crossed(130):
                     flag = True
                     break
-                if sum(self.acc_reward_list[-75:]) / 75 > 475:
+                if self.reward_stats.crossed(75):
                     epsilon = 0.00025
-                elif sum(self.acc_reward_list[-50:]) / 50 > 475:
+                elif self.reward_stats.crossed(50):
                     epsilon = 0.0005
-                elif sum(self.acc_reward_list[-25:]) / 25 > 475:
+                elif self.reward_stats.crossed(25):
                     epsilon = 0.005
-                elif sum(self.acc_reward_list[-15:]) / 15 > 475:
+                elif self.reward_stats.crossed(15):
                     epsilon = 0.01
-                elif sum(self.acc_reward_list[-10:]) / 10 > 475:
+                elif self.reward_stats.crossed(10):
                     epsilon = 0.03
-                elif sum(self.acc_reward_list[-5:]) / 5 > 475:
+                elif self.reward_stats.crossed(5):
                     epsilon = 0.04
                 else:
                     min_epsilon = 0.05
                     epsilon = epsilon * 0.9998 if epsilon * 0.9998 > min_epsilon else min_epsilon
 
-                action = self.epsilon_greedy_action(epsilon, self.Qnet, state)
+                with prof.phase('action'):
+                    action = self.epsilon_greedy_action(epsilon, self.Qnet, state)
 
                 # advance the environment
-                next_state, reward, done, truncated, info = self.env.step(int(action))
+                with prof.phase('env_step'):
+                    next_state, reward, done, truncated, info = self.env.step(int(action))
+                prof.count('env_steps')
 
-                # save to memory
-                single_step = (state, action, reward, next_state, done)
-                self.append_to_replay_buffer(single_step)
-                state = torch.tensor(next_state, dtype=torch.float32)
+                # save to memory (a cyclic buffer, it will start rewriting itself when it is full)
+                with prof.phase('replay_append'):
+                    self.replay_buffer.append(state.numpy(), int(action), reward, next_state, done, done or truncated)
+                    state = torch.tensor(next_state, dtype=torch.float32)
 
                 acc_reward = acc_reward + reward
                 # if done==True:
@@ -207,79 +386,126 @@ class DQN():
                 if len(self.replay_buffer) < self.batch_size:  # only sample a batch if you have enough elements
                     continue
 
-                minibatch = self.sample_minibatch()
-                # TODO: from this part and forward, not fully tested
-
-                # the error in DQN is the temporal difference function
-                Qnet_optimizer.zero_grad()
-                esstimation, reference = temporal_difference(self.QNetTarget,
-                                                             self.Qnet,
-                                                             minibatch["state"],
-                                                             minibatch["next_state"],
-                                                             minibatch["action"],
-                                                             minibatch["reward"],
-                                                             minibatch["done"],
-                                                             gamma)
-                # learning:
-
-                # MSE_loss = torch.mean(error**2)
-                criterion = nn.SmoothL1Loss()
-                loss = criterion(esstimation, reference)
-                loss.backward()
-                Qnet_optimizer.step()
+                with prof.phase('learn'):
+                    loss = self.learn_step(Qnet_optimizer, gamma)
                 step_counter = step_counter + 1
-                ep_loss_list.append(loss.item())
+                prof.count('updates')
+                ep_loss_list.append(loss)
 
                 if done or truncated:  # debug print(if the model is learning then the accumulated reward should be increasing)
                     loss = sum(ep_loss_list) / len(ep_loss_list)
-                    print("total reward  in episode {0} is {1} last Qnet {2} epsilon {3:.5f} avg loss {4:.4f}".format(
-                        ep,
-                        acc_reward,
-                        self.Qnet(state).detach().numpy(),
-                        epsilon, loss))
+                    prof.count('episodes')
+                    with prof.phase('logging'):
+                        self.metrics.scalars({'reward': acc_reward, 'epsilon': epsilon, 'loss': loss}, step=ep)
+                        self.metrics.console("total reward  in episode {0} is {1} epsilon {2:.5f} avg loss {3:.4f}",
+                                             ep, acc_reward, epsilon, loss)
                     self.loss_list.append(loss)
                     self.acc_reward_list.append(acc_reward)
+                    self.reward_stats.append(acc_reward)
+                    if report is not None and not report(ep, self.reward_stats.mean(100)):
+                        flag = True
                     break
 
             if flag:
                 break
 
-            # update Q-target
-            if improved_mode:
-                target_net_state_dict = self.QNetTarget.state_dict()
-                adjusting_net_state_dict = self.Qnet.state_dict()
-                for key in adjusting_net_state_dict:
-                    target_net_state_dict[key] = adjusting_net_state_dict[key] * 0.005 + target_net_state_dict[key] * (
-                            1 - 0.005)
-                self.QNetTarget.load_state_dict(target_net_state_dict)
+            with prof.phase('target_update'):
+                self.update_target(ep, C, improved_mode)
+            if checkpointer is not None and (ep + 1) % checkpoint_interval == 0:
+                with prof.phase('checkpoint'):
+                    checkpointer.save(ep, self.snapshot(ep + 1, epsilon, step_counter, Qnet_optimizer, save_replay))
+
+        if checkpointer is not None:
+            checkpointer.close()
+        self._close_metrics()
+        if replay_dataset is not None and not warm_started:
+            dataset = ReplayDataset(replay_dataset, self.env.observation_space.shape[0], mode='a')
+            self.replay_buffer.export(dataset)
+            dataset.close()
+        self.plot_training()
+
+    def train_vectorized(self, n_episodes, epsilon, gamma, lr, C, improved_mode=False, min_epsilon=0.05):
+        '''
+            Like train, but collecting from self.n_envs persistent CartPole envs that reset themselves when their
+            episode ends. Every tick picks the actions of all the envs in one batched forward pass of the policy,
+            writes the n_envs transitions into the replay buffer (one stream per env) and takes one learning step.
+            The epsilon decay is applied per transition, and episodes are counted in the order they end across the
+            envs. The loss of an episode is the mean of the learning steps taken while it ran.
+        '''
+        envs = gym.vector.make('CartPole-v1', num_envs=self.n_envs, asynchronous=False)
+        Qnet_optimizer = torch.optim.Adam(self.Qnet.parameters(), lr=lr)
+        self._open_metrics()
+        # preallocated observation buffer
+        state = np.zeros((self.n_envs, self.env.observation_space.shape[0]), dtype=np.float32)
+        state[:], _ = envs.reset()
+        acc_reward = np.zeros(self.n_envs)
+        # every learning step counts towards the running episode of each env
+        ep_loss_sum = np.zeros(self.n_envs)
+        ep_loss_count = np.zeros(self.n_envs, dtype=np.int64)
+        ep = 0
+        while ep < n_episodes:
+            # Early stopping
+            if self.reward_stats.crossed(130):
+                break
+            if self.reward_stats.crossed(75):
+                epsilon = 0.00025
+            elif self.reward_stats.crossed(50):
+                epsilon = 0.0005
+            elif self.reward_stats.crossed(25):
+                epsilon = 0.005
+            elif self.reward_stats.crossed(15):
+                epsilon = 0.01
+            elif self.reward_stats.crossed(10):
+                epsilon = 0.03
+            elif self.reward_stats.crossed(5):
+                epsilon = 0.04
             else:
-                if ep % C == 0:
-                    self.QNetTarget = type(self.Qnet)(hidden_layers_size=self.hidden_layers)
-                    self.QNetTarget.load_state_dict(self.Qnet.state_dict())
-
-        plt.figure()
-
-        # means = np.array(self.acc_reward_list).unfold(0, 100, 1).mean(1).view(-1)
-        # means = torch.cat((torch.zeros(99), means))
-        # plt.plot(means.numpy())
-
-        running_avg_acc_reward = np.convolve(np.array(self.acc_reward_list), np.ones(100) / 100, mode='valid')
-        plt.plot(running_avg_acc_reward, linewidth=2.5)
-
-        plt.plot(self.acc_reward_list, alpha=0.7)
-        plt.ylabel("accumulated reward")
-        plt.xlabel("episode")
-        plt.legend(["accumulated reward", "average of last 100 runs"])
-
-        plt.figure()
-        plt.plot(self.loss_list, alpha=0.7)
-        plt.ylabel("loss")
-        plt.xlabel("episode")
-
-        plt.show()
-
-
-def main():
+                epsilon = max(epsilon * 0.9998 ** self.n_envs, min_epsilon)
+
+            greedy = self.policy(state)
+            explore = np.random.uniform(size=self.n_envs) <= epsilon
+            action = np.where(explore, np.random.randint(0, self.env.action_space.n, size=self.n_envs), greedy)
+
+            next_state, reward, done, truncated, info = envs.step(action)
+            ended = done | truncated
+            # the envs that ended already returned their reset observation, their last one is in the info
+            final_state = next_state.copy()
+            for i in np.flatnonzero(ended):
+                final_state[i] = info["final_observation"][i]
+            self.replay_buffer.append_batch(state, action, reward, final_state, done, ended)
+            state[:] = next_state
+            acc_reward += reward
+
+            if len(self.replay_buffer) >= self.batch_size:  # only sample a batch if you have enough elements
+                ep_loss_sum += self.learn_step(Qnet_optimizer, gamma)
+                ep_loss_count += 1
+
+            for i in np.flatnonzero(ended):
+                loss = ep_loss_sum[i] / ep_loss_count[i] if ep_loss_count[i] else 0.0
+                self.metrics.scalars({'reward': acc_reward[i], 'epsilon': epsilon, 'loss': loss}, step=ep)
+                self.metrics.console("total reward  in episode {0} is {1} epsilon {2:.5f} avg loss {3:.4f}",
+                                     ep, acc_reward[i], epsilon, loss)
+                self.loss_list.append(loss)
+                self.acc_reward_list.append(acc_reward[i])
+                self.reward_stats.append(acc_reward[i])
+                acc_reward[i] = 0
+                ep_loss_sum[i] = 0
+                ep_loss_count[i] = 0
+                ep += 1
+            if ended.any():
+                if self.prioritized_replay:
+                    self.replay_buffer.beta = self.priority_beta + (1 - self.priority_beta) * min(ep / n_episodes, 1)
+                self.update_target(ep - 1, C, improved_mode, n_finished=int(np.count_nonzero(ended)))
+        envs.close()
+        self._close_metrics()
+
+        self.plot_training()
+
+
+def main(n_envs=1):
+    '''
+        n_envs > 1 collects from that many envs at once (see DQN.train_vectorized)
+    '''
     T = 100000
     g = 0.99
     epsilon = 0.9
@@ -288,17 +514,40 @@ def main():
     c = 5
     batch_size = 64
     replay_size = 10000
-    # for c in range(2, 9, 2):
-    #    for lr in np.linspace(0.0005,0.0005*10, 4):
-    #        for g in np.linspace(0.9, 0.99, 4):
-    # print("########################## C: {0} LR: {1} G: {2} ##########################".format(c, lr, g))
+    # the sweep over c, lr and g is search()
     epsilon = 1
-    d = DQN(batch_size, hidden_layers=[128, 128, 128], replay_buffer_memory_size=replay_size)
-    d.train(episodes, T, epsilon=epsilon, gamma=g, lr=lr, C=c, improved_mode=False)
+    d = DQN(batch_size, hidden_layers=[128, 128, 128], replay_buffer_memory_size=replay_size, n_envs=n_envs)
+    if n_envs > 1:
+        d.train_vectorized(episodes, epsilon=epsilon, gamma=g, lr=lr, C=c, improved_mode=False)
+    else:
+        d.train(episodes, T, epsilon=epsilon, gamma=g, lr=lr, C=c, improved_mode=False)
     plt.show()
     # d.test_agent()
 
 
+def search_trial(config, report):
+    '''
+        One trial of search(): the training of main with the c, lr and g of config
+    '''
+    d = DQN(64, hidden_layers=[128, 128, 128], replay_buffer_memory_size=10000)
+    d.train(config.get('episodes', 3000), 100000, epsilon=1, gamma=config['g'], lr=config['lr'], C=config['c'],
+            report=report)
+    return d.reward_stats.mean(100)
+
+
+def search(n_workers=None):
+    '''
+        The sweep over c, lr and g, with a worker process per core and the configs behind at 100, 300 and 900
+        episodes pruned (see common.hparam_search.successive_halving). The table is written to q2_search.csv.
+    '''
+    configs = grid(c=range(2, 9, 2), lr=np.linspace(0.0005, 0.0005 * 10, 4).tolist(),
+                   g=np.linspace(0.9, 0.99, 4).tolist())
+    results = successive_halving('q2:search_trial', configs, rungs=[100, 300, 900], n_workers=n_workers,
+                                 paths=[os.path.dirname(os.path.abspath(__file__))], out_path='q2_search.csv')
+    print(results.to_string())
+    return results
+
+
 if __name__ == "__main__":
-    main()
+    main(n_envs=int(sys.argv[1]) if len(sys.argv) > 1 else 1)
 
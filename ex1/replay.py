@@ -0,0 +1,337 @@
+import copy
+import numpy as np
+
+
+class ReplayBuffer:
+    '''
+        Cyclic replay buffer backed by preallocated contiguous arrays (float32 states, int8 actions, float32 rewards,
+        bool dones). next_state is not duplicated: every transition keeps the index of the slot holding its next
+        state, which is the following transition of the same stream, or an observation-only slot written when the
+        episode ends. Transitions are appended per stream (one stream per environment), so several environments can
+        write into the same buffer; new streams are added on first use.
+
+        Insertion is O(1) per transition and sampling is a vectorized gather over the valid slots.
+    '''
+
+    def __init__(self, size: int, state_dim: int, n_streams: int = 1):
+        self.size = size
+        self.states = np.zeros((size, state_dim), dtype=np.float32)
+        self.actions = np.zeros(size, dtype=np.int8)
+        self.rewards = np.zeros(size, dtype=np.float32)
+        self.dones = np.zeros(size, dtype=bool)
+        self.next_idx = np.zeros(size, dtype=np.int32 if size < 2 ** 31 else np.int64)
+        # a slot is valid (sampleable) once it holds a transition whose next state is in place
+        self.valid = np.zeros(size, dtype=bool)
+        # per stream: the slot of the last transition still waiting for its next state (-1 when none)
+        self.pending = np.full(n_streams, -1, dtype=np.int64)
+        self.cursor = 0
+        self.filled = 0
+        self.n_valid = 0
+
+    def __len__(self):
+        return self.n_valid
+
+    def _take_slots(self, n):
+        idx = (self.cursor + np.arange(n)) % self.size
+        self.cursor = (self.cursor + n) % self.size
+        self.filled = min(self.size, self.filled + n)
+        # the overwritten slots lose their transitions, and a stream whose pending transition is overwritten drops it
+        self._mark_invalid(idx)
+        self.pending[np.isin(self.pending, idx)] = -1
+        return idx
+
+    def _ensure_streams(self, n_streams):
+        if n_streams > len(self.pending):
+            self.pending = np.concatenate([self.pending, np.full(n_streams - len(self.pending), -1)])
+
+    def _mark_valid(self, idx):
+        self.valid[idx] = True
+        self.n_valid += len(idx)
+
+    def _mark_invalid(self, idx):
+        self.n_valid -= int(np.count_nonzero(self.valid[idx]))
+        self.valid[idx] = False
+
+    def append(self, state, action, reward, next_state, done, episode_end=None, stream=0):
+        '''
+            Add a single transition. episode_end (defaults to done) marks the last transition of an episode,
+            including truncation, after which next_state is kept in an observation-only slot.
+        '''
+        episode_end = done if episode_end is None else episode_end
+        self.append_batch(np.asarray(state)[None], np.asarray([action]), np.asarray([reward]),
+                          np.asarray(next_state)[None], np.asarray([done]), np.asarray([episode_end]),
+                          np.asarray([stream]))
+
+    def append_batch(self, states, actions, rewards, next_states, dones, episode_ends, streams=None):
+        '''
+            Add one transition per stream (streams defaults to 0..n-1). next_states is only read for the
+            transitions that end an episode.
+        '''
+        n = len(states)
+        streams = np.arange(n) if streams is None else streams
+        self._ensure_streams(int(np.max(streams)) + 1)
+        episode_ends = np.asarray(episode_ends, dtype=bool)
+        n_ends = int(np.count_nonzero(episode_ends))
+        idx = self._take_slots(n + n_ends)
+        trans_idx, obs_idx = idx[:n], idx[n:]
+
+        # the new transitions are the next states of the streams' pending transitions
+        pending = self.pending[streams]
+        linked = pending >= 0
+        self.next_idx[pending[linked]] = trans_idx[linked]
+        self._mark_valid(pending[linked])
+
+        self.states[trans_idx] = states
+        self.actions[trans_idx] = actions
+        self.rewards[trans_idx] = rewards
+        self.dones[trans_idx] = dones
+
+        # episode ends get their next state in an observation-only slot right away
+        ended = trans_idx[episode_ends]
+        self.states[obs_idx] = np.asarray(next_states)[episode_ends]
+        self.next_idx[ended] = obs_idx
+        self._mark_valid(ended)
+        self.pending[streams] = np.where(episode_ends, -1, trans_idx)
+
+    def append_sequence(self, states, actions, rewards, next_states, dones, episode_ends, stream=0):
+        '''
+            Add n consecutive transitions of a single stream. Every transition is linked to the following one, and
+            the ones ending an episode get an observation-only slot right after them.
+        '''
+        n = len(states)
+        self._ensure_streams(stream + 1)
+        episode_ends = np.asarray(episode_ends, dtype=bool)
+        n_ends = int(np.count_nonzero(episode_ends))
+        if n + n_ends > self.size:
+            # the sequence would overwrite itself: keep the longest suffix that fits (none when even the last
+            # transition and its observation slot do not), unlinked from the pending transition of the stream
+            needed = np.arange(n, 0, -1) + np.cumsum(episode_ends[::-1])[::-1]
+            fits = needed <= self.size
+            self.pending[stream] = -1
+            if not fits.any():
+                return
+            start = int(np.argmax(fits))
+            states, actions, rewards = states[start:], actions[start:], rewards[start:]
+            next_states, dones, episode_ends = next_states[start:], dones[start:], episode_ends[start:]
+            n, n_ends = len(states), int(np.count_nonzero(episode_ends))
+        idx = self._take_slots(n + n_ends)
+        # every transition is shifted by the observation slots of the episodes that ended before it
+        shift = np.concatenate([[0], np.cumsum(episode_ends)[:-1]])
+        trans_idx = idx[np.arange(n) + shift]
+        obs_idx = idx[np.flatnonzero(episode_ends) + shift[episode_ends] + 1]
+
+        pending = self.pending[stream]
+        if pending >= 0:
+            self.next_idx[pending] = trans_idx[0]
+            self._mark_valid(np.array([pending]))
+
+        self.states[trans_idx] = states
+        self.actions[trans_idx] = actions
+        self.rewards[trans_idx] = rewards
+        self.dones[trans_idx] = dones
+        self.states[obs_idx] = np.asarray(next_states)[episode_ends]
+
+        # link to the following transition, or to the observation slot at an episode end
+        linked = np.flatnonzero(~episode_ends[:-1])
+        self.next_idx[trans_idx[linked]] = trans_idx[linked + 1]
+        self.next_idx[trans_idx[episode_ends]] = obs_idx
+        self._mark_valid(np.concatenate([trans_idx[linked], trans_idx[episode_ends]]))
+        self.pending[stream] = -1 if episode_ends[-1] else trans_idx[-1]
+
+    def sample_indices(self, batch_size: int, rng=np.random):
+        '''
+            Uniformly sample batch_size valid slots. Candidates are drawn over the filled slots and the invalid ones
+            (observation-only and pending slots, a small fraction) are redrawn.
+        '''
+        assert self.n_valid > 0, "Sampling from an empty replay buffer"
+        idx = np.empty(0, dtype=np.int64)
+        while len(idx) < batch_size:
+            candidates = rng.randint(0, self.filled, size=2 * (batch_size - len(idx)))
+            idx = np.concatenate([idx, candidates[self.valid[candidates]]])
+        return idx[:batch_size]
+
+    def gather(self, idx, as_tensors=False):
+        '''
+            Gather the transitions at idx. With as_tensors the arrays are wrapped as torch tensors without copying.
+        '''
+        batch = {
+            'states': self.states[idx],
+            'actions': self.actions[idx],
+            'rewards': self.rewards[idx],
+            'next_states': self.states[self.next_idx[idx]],
+            'dones': self.dones[idx]
+        }
+        if as_tensors:
+            import torch
+            batch = {k: torch.from_numpy(v) for k, v in batch.items()}
+        return batch
+
+    def sample(self, batch_size: int, as_tensors=False):
+        return self.gather(self.sample_indices(batch_size), as_tensors)
+
+    def export(self, dataset):
+        '''
+            Append the transitions of the buffer to a ReplayDataset, oldest first. The transitions still waiting for
+            their next state are left out.
+        '''
+        idx = (self.cursor + np.arange(self.size - self.filled, self.size)) % self.size
+        idx = idx[self.valid[idx]]
+        batch = self.gather(idx)
+        dataset.append_batch(batch['states'], batch['actions'], batch['rewards'], batch['next_states'],
+                             batch['dones'])
+        dataset.flush()
+
+    def load_dataset(self, dataset, n=None):
+        '''
+            Warm-start the buffer with the last n transitions of a ReplayDataset (as many as fit by default). A
+            transition whose next state is not the state of the following one (an episode end, or the seam between
+            two streams) is written as the end of a sequence, so the next states are kept without duplicating them.
+        '''
+        n = min(len(dataset), self.size if n is None else n)
+        if n == 0:
+            return
+        batch = dataset.gather(np.arange(len(dataset) - n, len(dataset)))
+        states, next_states = batch['states'], batch['next_states']
+        episode_ends = np.ones(n, dtype=bool)
+        episode_ends[:-1] = np.any(next_states[:-1] != states[1:], axis=1)
+        self.append_sequence(states, batch['actions'], batch['rewards'], next_states, batch['dones'], episode_ends)
+
+    # the arrays with one entry per slot, of which state_dict only copies the filled part
+    SLOT_ARRAYS = ('states', 'actions', 'rewards', 'dones', 'next_idx', 'valid')
+
+    def state_dict(self):
+        '''
+            A copy of the buffer (the filled part of the slot arrays, the cursors and, for subclasses, their own
+            state), e.g. for a checkpoint. It is taken on the training thread, as the buffer keeps changing while
+            the checkpointer writes the snapshot out, so the arrays are copied with one memcpy each and the empty
+            slots are left out.
+        '''
+        state = {key: value for key, value in vars(self).items() if key not in self.SLOT_ARRAYS}
+        state = copy.deepcopy(state)
+        for key in self.SLOT_ARRAYS:
+            state[key] = getattr(self, key)[:self.filled].copy()
+        return state
+
+    def load_state_dict(self, state):
+        assert state['size'] == self.size, "The replay buffer state has another size"
+        state = dict(state)
+        for key in self.SLOT_ARRAYS:
+            value = state.pop(key)
+            array = getattr(self, key)
+            array[:len(value)] = value
+            array[len(value):] = 0
+        self.__dict__.update(copy.deepcopy(state))
+
+
+class SegmentTree:
+    '''
+        Array-backed binary tree over capacity leaves (rounded up to a power of two) that keeps the sum or the
+        minimum of every subtree. Batches of leaves are updated together, one vectorized pass per tree level, so a
+        batch update costs O(batch * log n).
+    '''
+
+    def __init__(self, capacity, op=np.add, neutral=0.0):
+        self.capacity = 1 << int(np.ceil(np.log2(max(capacity, 2))))
+        self.op = op
+        self.neutral = neutral
+        self.tree = np.full(2 * self.capacity, neutral, dtype=np.float64)
+
+    def update(self, idx, values):
+        node = np.asarray(idx) + self.capacity
+        if node.size == 0:
+            return
+        self.tree[node] = values
+        node = np.unique(node // 2)
+        while True:
+            self.tree[node] = self.op(self.tree[2 * node], self.tree[2 * node + 1])
+            if node[0] == 1:
+                break
+            node = np.unique(node // 2)
+
+    def root(self):
+        return self.tree[1]
+
+    def leaves(self, idx):
+        return self.tree[np.asarray(idx) + self.capacity]
+
+    def find_prefix_sum(self, u):
+        '''
+            For a sum tree: the leaves where the cumulative sums of the values reach u (vectorized over u). Empty
+            subtrees are never entered, so only leaves with a positive value are returned.
+        '''
+        node = np.ones(len(u), dtype=np.int64)
+        u = np.array(u, dtype=np.float64)
+        while node[0] < self.capacity:
+            left = self.tree[2 * node]
+            go_right = (u >= left) & (self.tree[2 * node + 1] > 0)
+            u -= left * go_right
+            node = 2 * node + go_right
+        return node - self.capacity
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    '''
+        ReplayBuffer sampling transitions with probability proportional to priority^alpha, where the priority is
+        the absolute TD error of the transition (new transitions get the highest priority seen so far). Priorities
+        are kept in a sum tree for O(log n) updates and stratified batch sampling, and in a min tree for the
+        normalization of the importance-sampling weights. Invalid slots have priority 0 and are never sampled.
+    '''
+
+    def __init__(self, size: int, state_dim: int, n_streams: int = 1, alpha: float = 0.6, beta: float = 0.4,
+                 eps: float = 1e-5):
+        super().__init__(size, state_dim, n_streams)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.max_priority = 1.0
+        self.sum_tree = SegmentTree(size, np.add, 0.0)
+        self.min_tree = SegmentTree(size, np.minimum, np.inf)
+
+    def _mark_valid(self, idx):
+        super()._mark_valid(idx)
+        if len(idx):
+            self.sum_tree.update(idx, self.max_priority)
+            self.min_tree.update(idx, self.max_priority)
+
+    def _mark_invalid(self, idx):
+        super()._mark_invalid(idx)
+        if len(idx):
+            self.sum_tree.update(idx, 0.0)
+            self.min_tree.update(idx, np.inf)
+
+    def sample_indices(self, batch_size: int, rng=np.random):
+        '''
+            Stratified sampling: one uniform draw in each of batch_size equal segments of the total priority
+        '''
+        assert self.n_valid > 0, "Sampling from an empty replay buffer"
+        segment = self.sum_tree.root() / batch_size
+        u = (np.arange(batch_size) + rng.uniform(size=batch_size)) * segment
+        return self.sum_tree.find_prefix_sum(u)
+
+    def sample(self, batch_size: int, as_tensors=False, beta=None):
+        '''
+            Like ReplayBuffer.sample, with the sampled slot indices (to update their priorities later) under
+            'indices' and the importance-sampling weights, normalized by the largest possible weight, under 'weights'
+        '''
+        beta = self.beta if beta is None else beta
+        idx = self.sample_indices(batch_size)
+        total = self.sum_tree.root()
+        weights = (self.sum_tree.leaves(idx) / total * self.n_valid) ** -beta
+        max_weight = (self.min_tree.root() / total * self.n_valid) ** -beta
+        batch = self.gather(idx, as_tensors)
+        weights = (weights / max_weight).astype(np.float32)
+        if as_tensors:
+            import torch
+            weights = torch.from_numpy(weights)
+        batch['indices'] = idx
+        batch['weights'] = weights
+        return batch
+
+    def update_priorities(self, idx, td_errors):
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        # a slot invalidated since it was sampled must stay at priority 0
+        still_valid = self.valid[idx]
+        idx, priorities = idx[still_valid], priorities[still_valid]
+        self.sum_tree.update(idx, priorities)
+        self.min_tree.update(idx, priorities)
+        self.max_priority = max(self.max_priority, float(priorities.max(initial=0.0)))
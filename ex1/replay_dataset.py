@@ -0,0 +1,112 @@
+import json
+import os
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+class ReplayDataset:
+    '''
+        Transitions on disk, in a directory of memory-mapped .npy chunks of chunk_size rows. Every row holds a whole
+        transition (state, action, reward, next state, done), so a sampled transition is read from a single place of
+        a single chunk and only the touched pages are loaded. meta.json records the state size, the chunk size and
+        the number of complete rows, and is only rewritten (atomically) by flush(), after the rows themselves.
+
+        mode 'r' opens an existing dataset read-only, so any number of runs can sample the same files while the OS
+        shares their pages; refresh() picks up the rows flushed since by a writer. mode 'a' (a single writer) opens
+        or creates the dataset for appending, state_dim being needed to create it.
+    '''
+
+    def __init__(self, directory, state_dim=None, chunk_size=1 << 16, mode='r'):
+        assert mode in ('r', 'a'), "Unknown mode"
+        self.directory = directory
+        self.mode = mode
+        self._chunks = {}
+        meta_path = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_path):
+            self.refresh()
+        else:
+            assert mode == 'a' and state_dim is not None, f"No replay dataset in {directory}"
+            os.makedirs(directory, exist_ok=True)
+            self.state_dim, self.chunk_size, self.length = state_dim, chunk_size, 0
+            self.flush()
+        self.dtype = np.dtype([('state', np.float32, (self.state_dim,)), ('action', np.int8), ('reward', np.float32),
+                               ('next_state', np.float32, (self.state_dim,)), ('done', bool)])
+
+    def __len__(self):
+        return self.length
+
+    def refresh(self):
+        with open(os.path.join(self.directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.state_dim, self.chunk_size, self.length = meta['state_dim'], meta['chunk_size'], meta['length']
+
+    def _chunk(self, i):
+        if i not in self._chunks:
+            path = os.path.join(self.directory, f'chunk-{i:05d}.npy')
+            if self.mode == 'r':
+                self._chunks[i] = np.load(path, mmap_mode='r')
+            else:
+                self._chunks[i] = open_memmap(path, mode='r+' if os.path.exists(path) else 'w+', dtype=self.dtype,
+                                              shape=(self.chunk_size,))
+        return self._chunks[i]
+
+    def append_batch(self, states, actions, rewards, next_states, dones):
+        '''
+            Append n transitions. They become visible to the readers at the next flush().
+        '''
+        assert self.mode == 'a', "The replay dataset is read-only"
+        n = len(states)
+        rows = np.empty(n, dtype=self.dtype)
+        rows['state'], rows['action'], rows['reward'] = states, actions, rewards
+        rows['next_state'], rows['done'] = next_states, dones
+        start = 0
+        while start < n:
+            chunk, offset = divmod(self.length, self.chunk_size)
+            count = min(n - start, self.chunk_size - offset)
+            self._chunk(chunk)[offset:offset + count] = rows[start:start + count]
+            self.length += count
+            start += count
+
+    def flush(self):
+        for chunk in self._chunks.values():
+            chunk.flush()
+        meta_path = os.path.join(self.directory, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'state_dim': self.state_dim, 'chunk_size': self.chunk_size, 'length': self.length}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def gather(self, idx, as_tensors=False):
+        '''
+            The transitions at idx, in the same format as ReplayBuffer.gather. The rows are read chunk by chunk, in
+            increasing order within a chunk.
+        '''
+        idx = np.asarray(idx)
+        rows = np.empty(len(idx), dtype=self.dtype)
+        chunks, offsets = np.divmod(idx, self.chunk_size)
+        for chunk in np.unique(chunks):
+            sel = np.flatnonzero(chunks == chunk)
+            order = np.argsort(offsets[sel])
+            rows[sel[order]] = self._chunk(int(chunk))[offsets[sel[order]]]
+        batch = {
+            'states': rows['state'],
+            'actions': rows['action'],
+            'rewards': rows['reward'],
+            'next_states': rows['next_state'],
+            'dones': rows['done']
+        }
+        if as_tensors:
+            import torch
+            batch = {k: torch.from_numpy(np.ascontiguousarray(v)) for k, v in batch.items()}
+        return batch
+
+    def sample_indices(self, batch_size: int, rng=np.random):
+        assert self.length > 0, "Sampling from an empty replay dataset"
+        return rng.randint(0, self.length, size=batch_size)
+
+    def sample(self, batch_size: int, as_tensors=False):
+        return self.gather(self.sample_indices(batch_size), as_tensors)
+
+    def close(self):
+        if self.mode == 'a':
+            self.flush()
+        self._chunks.clear()
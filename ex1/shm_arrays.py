@@ -0,0 +1,45 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class SharedArrays:
+    '''
+        Named numpy arrays laid out in one shared memory block. Pickling only sends the layout and the block name,
+        so a SharedArrays passed to another process attaches to the same memory instead of copying it.
+    '''
+
+    ALIGNMENT = 64
+
+    def __init__(self, layout, name=None):
+        '''
+            layout maps every array name to its (shape, dtype). A new block is created when name is None, otherwise
+            the existing block with that name is attached.
+        '''
+        self.layout = layout
+        offsets, size = {}, 0
+        for key, (shape, dtype) in layout.items():
+            offsets[key] = size
+            nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            size += -(-nbytes // self.ALIGNMENT) * self.ALIGNMENT
+        self._owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self._owner, size=max(size, 1))
+        self.arrays = {key: np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offsets[key])
+                       for key, (shape, dtype) in layout.items()}
+        if self._owner:
+            for array in self.arrays.values():
+                array.fill(0)
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def __reduce__(self):
+        return SharedArrays, (self.layout, self.shm.name)
+
+    def close(self):
+        '''
+            Detach from the block, and free it when this is the process that created it
+        '''
+        self.arrays = {}
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
@@ -0,0 +1,116 @@
+import queue
+import threading
+import numpy as np
+from numpy.lib.format import open_memmap
+
+
+class QSnapshotRecorder:
+    '''
+        Journal of Q-table snapshots in a memory-mapped .npy file. record() only copies the table and queues it, a
+        background thread writes the copies into the file, so the training loop never waits on disk or matplotlib.
+        Every row of the file holds the episode index (-1 for unused rows) and the table itself.
+    '''
+
+    def __init__(self, path, shape, max_snapshots, interval=500):
+        self.path = path
+        self.interval = interval
+        self.max_snapshots = max_snapshots
+        dtype = np.dtype([('episode', np.int64), ('Q', np.float64, tuple(shape))])
+        self._history = open_memmap(path, mode='w+', dtype=dtype, shape=(max_snapshots,))
+        self._history['episode'] = -1
+        self._n_snapshots = 0
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def due(self, episode):
+        return episode % self.interval == 0
+
+    def record(self, episode, Q):
+        '''
+            Queue a copy of Q for writing. Snapshots past max_snapshots overwrite the last row.
+        '''
+        self._queue.put((episode, np.array(Q, copy=True)))
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            episode, Q = item
+            row = min(self._n_snapshots, self.max_snapshots - 1)
+            self._history[row] = (episode, Q)
+            self._n_snapshots += 1
+
+    def close(self):
+        '''
+            Wait for the queued snapshots to be written and flush the file
+        '''
+        self._queue.put(None)
+        self._writer.join()
+        self._history.flush()
+        del self._history
+
+
+def load_snapshots(path):
+    '''
+        Lazily open a snapshot journal. Returns the episode indices and the (n_snapshots, ...) memory-mapped tables.
+    '''
+    history = np.load(path, mmap_mode='r')
+    valid = history['episode'] >= 0
+    return history['episode'][valid], history['Q'][valid]
+
+
+def render_snapshots(path, out_path, max_annotated_cells=256, animate=False, fps=2):
+    '''
+        Render a snapshot journal offline, either as one figure with a heatmap per snapshot or as an animation
+        (.gif). Above max_annotated_cells cells per table the per-cell value texts are dropped and only the images
+        are drawn, since one text artist per cell does not scale to large maps.
+    '''
+    # a bare Figure renders without pyplot, so this never touches the interactive backend or blocks on show()
+    from matplotlib.figure import Figure
+    from matplotlib import animation
+
+    episodes, Qs = load_snapshots(path)
+    if len(episodes) == 0:
+        print(f'No snapshots in {path}, nothing to render')
+        return
+    annotate = Qs[0].size <= max_annotated_cells
+    vmin, vmax = float(Qs.min()), float(Qs.max())
+
+    def draw(ax, episode, Q):
+        image = ax.imshow(Q, cmap='cool', interpolation='nearest', vmin=vmin, vmax=vmax)
+        ax.set_title(f'Q-table after {episode} episodes')
+        if annotate:
+            for (i, j), q in np.ndenumerate(Q):
+                ax.text(j, i, f'{q:.2f}', ha='center', va='center', color='black')
+        return image
+
+    if animate:
+        fig = Figure(figsize=(10, 10))
+        ax = fig.subplots()
+        image = draw(ax, episodes[0], Qs[0])
+        fig.colorbar(image, label='Q-value')
+
+        def update(i):
+            # redraw when annotating, otherwise only swap the image data
+            if annotate:
+                ax.clear()
+                return [draw(ax, episodes[i], Qs[i])]
+            image.set_data(Qs[i])
+            ax.set_title(f'Q-table after {episodes[i]} episodes')
+            return [image]
+
+        anim = animation.FuncAnimation(fig, update, frames=len(episodes), blit=not annotate)
+        anim.save(out_path, writer=animation.PillowWriter(fps=fps))
+    else:
+        n_cols = int(np.ceil(np.sqrt(len(episodes))))
+        n_rows = int(np.ceil(len(episodes) / n_cols))
+        fig = Figure(figsize=(5 * n_cols, 5 * n_rows))
+        axes = fig.subplots(n_rows, n_cols, squeeze=False)
+        for ax, episode, Q in zip(axes.ravel(), episodes, Qs):
+            image = draw(ax, episode, Q)
+        for ax in axes.ravel()[len(episodes):]:
+            ax.axis('off')
+        fig.colorbar(image, ax=axes, label='Q-value')
+        fig.savefig(out_path)
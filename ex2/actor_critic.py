@@ -1,7 +1,18 @@
+import os
+import sys
 import gym
 import numpy as np
 import tensorflow.compat.v1 as tf
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.rolling_stats import RollingStats
+from common.policy_runtime import NumpyPolicy, sample_categorical
+from common.episode_buffer import n_step_returns
+from common.rollout_buffer import RolloutBuffer
+from common.hparam_search import grid, successive_halving
+from common.profiler import Profiler, NULL_PROFILER
+from common.metrics import MetricsSink
+
 # optimized for Tf2
 tf.disable_v2_behavior()
 
@@ -29,6 +40,7 @@ class PolicyNetwork:
             self.Z1 = tf.add(tf.matmul(self.state, self.W1), self.b1)
             self.A1 = tf.nn.relu(self.Z1)
             self.output = tf.add(tf.matmul(self.A1, self.W2), self.b2)
+            self.variables = [self.W1, self.b1, self.W2, self.b2]
 
             # Softmax probability distribution over actions
             self.actions_distribution = tf.squeeze(tf.nn.softmax(self.output))
@@ -64,13 +76,104 @@ class ValueNetwork:
             self.Z2 = tf.add(tf.matmul(self.A1, self.W2), self.b2)
             self.A2 = tf.nn.relu(self.Z2)
             self.output = tf.add(tf.matmul(self.A2, self.W3), self.b3)
+            self.variables = [self.W1, self.b1, self.W2, self.b2, self.W3, self.b3]
 
             # Loss calculation  - for gradient ascent we minimize the negative loss. Loss = delta*I*V
             self.loss = -self.advantage_delta * self.I_factor * self.output #
             self.optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate).minimize(self.loss)
 
 
-def run(discount_factor, policy_learning_rate, sv_learning_rate):
+# One fused training step of the actor and the critic
+class ActorCriticStep:
+    def __init__(self, policy, state_value, discount_factor, name='actor_critic_step'):
+        '''
+            Feed policy.state with S, state_value.state with [S, S'] and next_state with S': V(S) and V(S') come
+            from one batched pass, the TD delta is formed in-graph and both networks are updated by the same run.
+            next_distribution is pi(*|S') under the updated policy weights, the distribution of the next action.
+        '''
+        with tf.variable_scope(name):
+            self.next_state = tf.placeholder(tf.float32, [None, policy.state_size], name="next_state")
+            self.reward = tf.placeholder(tf.float32, [], name="reward")
+            self.done = tf.placeholder(tf.float32, [], name="done")
+            self.I_factor = tf.placeholder(tf.float32, [], name="I_factor")
+
+            value_current_state, value_next_state = state_value.output[0, 0], state_value.output[1, 0]
+            target = self.reward + discount_factor * (1.0 - self.done) * value_next_state
+            # delta is a constant for both updates, like the fed advantage_delta of the networks' own losses
+            self.advantage_delta = tf.stop_gradient(target - value_current_state)
+
+            # Same losses as ValueNetwork.loss and PolicyNetwork.loss
+            self.value_loss = -self.advantage_delta * self.I_factor * value_current_state
+            self.policy_loss = self.I_factor * -tf.math.reduce_sum(self.advantage_delta * policy.actions_log_probs)
+            self.train_ops = [
+                tf.train.AdamOptimizer(learning_rate=state_value.learning_rate).minimize(
+                    self.value_loss, var_list=state_value.variables),
+                tf.train.AdamOptimizer(learning_rate=policy.learning_rate).minimize(
+                    self.policy_loss, var_list=policy.variables)]
+
+            # read the policy weights again once both updates are applied
+            with tf.control_dependencies(self.train_ops):
+                W1, b1, W2, b2 = [v.read_value() for v in policy.variables]
+                A1 = tf.nn.relu(tf.add(tf.matmul(self.next_state, W1), b1))
+                self.next_distribution = tf.squeeze(tf.nn.softmax(tf.add(tf.matmul(A1, W2), b2)))
+
+
+# Batched update of the actor and the critic over a rollout of several envs (A2C)
+class A2CStep:
+    def __init__(self, policy, state_value, name='a2c_step'):
+        '''
+            Feed policy.state and state_value.state with the states of a rollout (n_steps * n_envs of them), actions
+            with the actions taken and returns with their n-step returns. The advantages are formed in-graph from
+            the critic's values, and both networks take one step on the mean of their losses over the rollout.
+        '''
+        with tf.variable_scope(name):
+            self.actions = tf.placeholder(tf.int32, [None], name="actions")
+            self.returns = tf.placeholder(tf.float32, [None], name="returns")
+
+            values = state_value.output[:, 0]
+            self.advantages = tf.stop_gradient(self.returns - values)
+            log_probs = tf.reduce_sum(tf.one_hot(self.actions, policy.action_size) * tf.nn.log_softmax(policy.output),
+                                      axis=1)
+            self.policy_loss = -tf.reduce_mean(self.advantages * log_probs)
+            self.value_loss = tf.reduce_mean(tf.square(self.returns - values))
+            self.train_ops = [
+                tf.train.AdamOptimizer(learning_rate=state_value.learning_rate).minimize(
+                    self.value_loss, var_list=state_value.variables),
+                tf.train.AdamOptimizer(learning_rate=policy.learning_rate).minimize(
+                    self.policy_loss, var_list=policy.variables)]
+
+
+# Clipped-ratio (PPO) update of the actor and the critic on a minibatch of a rollout
+class PPOStep:
+    def __init__(self, policy, state_value, clip_ratio=0.2, name='ppo_step'):
+        '''
+            Feed policy.state and state_value.state with the minibatch states, and the placeholders with the actions,
+            their log-probabilities under the policy that collected them, the advantages and the returns. The
+            policy maximizes min(ratio * A, clip(ratio, 1 - clip_ratio, 1 + clip_ratio) * A), so reusing the rollout
+            for several epochs cannot move it far from the collecting policy, and the critic fits the returns.
+        '''
+        with tf.variable_scope(name):
+            self.actions = tf.placeholder(tf.int32, [None], name="actions")
+            self.old_log_probs = tf.placeholder(tf.float32, [None], name="old_log_probs")
+            self.advantages = tf.placeholder(tf.float32, [None], name="advantages")
+            self.returns = tf.placeholder(tf.float32, [None], name="returns")
+
+            log_probs = tf.reduce_sum(tf.one_hot(self.actions, policy.action_size) * tf.nn.log_softmax(policy.output),
+                                      axis=1)
+            ratio = tf.exp(log_probs - self.old_log_probs)
+            clipped_ratio = tf.clip_by_value(ratio, 1.0 - clip_ratio, 1.0 + clip_ratio)
+            self.policy_loss = -tf.reduce_mean(tf.minimum(ratio * self.advantages, clipped_ratio * self.advantages))
+            self.value_loss = tf.reduce_mean(tf.square(self.returns - state_value.output[:, 0]))
+            self.train_ops = [
+                tf.train.AdamOptimizer(learning_rate=state_value.learning_rate).minimize(
+                    self.value_loss, var_list=state_value.variables),
+                tf.train.AdamOptimizer(learning_rate=policy.learning_rate).minimize(
+                    self.policy_loss, var_list=policy.variables)]
+
+
+def run(discount_factor, policy_learning_rate, sv_learning_rate, report=None, profiler=NULL_PROFILER):
+    # per-episode scalars (add backends to keep them) and the rate-limited progress line, see common.metrics
+    metrics = MetricsSink()
     env = gym.make('CartPole-v1')
     np.random.seed(SEED)
     env.seed(SEED)
@@ -92,6 +195,7 @@ def run(discount_factor, policy_learning_rate, sv_learning_rate):
 
     policy = PolicyNetwork(state_size, action_size, policy_learning_rate)
     state_value = ValueNetwork(state_size, sv_learning_rate)
+    train_step = ActorCriticStep(policy, state_value, discount_factor)
 
     # Start training the agent with REINFORCE algorithm
     with tf.Session() as sess:
@@ -99,24 +203,37 @@ def run(discount_factor, policy_learning_rate, sv_learning_rate):
         sess.run(tf.global_variables_initializer())
         solved = False
         episode_rewards = np.zeros(max_episodes)
+        reward_stats = RollingStats(windows=(6, 100), threshold=475)
         average_rewards = 0.0
         early_stopping = False
+        # NumPy copy of the policy once its weights are frozen by the early stopping
+        frozen_policy = None
+        # phase timers, no-ops unless a Profiler is given
+        prof = profiler
         # pdb.set_trace()
         for episode in range(max_episodes):
 
             # pdb.set_trace
-            state = env.reset()
+            with prof.phase('env_reset'):
+                state = env.reset()
             state = state.reshape([1, state_size])
             I_factor = 1
 
+            # pi(*|S0), the following distributions come out of the training steps
+            if frozen_policy is not None:
+                actions_distribution = frozen_policy(state)[0]
+            else:
+                actions_distribution = sess.run(policy.actions_distribution, {policy.state: state})
+
             for step in range(max_steps):
 
                 # Take action A ~ pi(*|S,thetha) and observe S',R.
-                actions_distribution = sess.run(policy.actions_distribution, {policy.state: state})
+                with prof.phase('action'):
+                    action = np.random.choice(np.arange(len(actions_distribution)), p=actions_distribution)
 
-                action = np.random.choice(np.arange(len(actions_distribution)), p=actions_distribution)
-
-                next_state, reward, done, _ = env.step(action)
+                with prof.phase('env_step'):
+                    next_state, reward, done, _ = env.step(action)
+                prof.count('env_steps')
                 next_state = next_state.reshape([1, state_size])
 
                 episode_rewards[episode] += reward
@@ -124,43 +241,41 @@ def run(discount_factor, policy_learning_rate, sv_learning_rate):
                 if render:
                     env.render()
 
-                # Calculate state-value output for current state V(S,w)
-                feed_dict = {state_value.state: state}
-                value_current_state = sess.run(state_value.output, feed_dict)
-
-                # Calculate state-value output for next state V(S',w)
-                feed_dict = {state_value.state: next_state}
-                value_next_state = sess.run(state_value.output, feed_dict)
-
-                # Calculate delta
-                advantage_delta = reward - value_current_state if done else reward + discount_factor * value_next_state - value_current_state
-
-                # Update the state_value network weights w <- w + alpha*I*delta*grad[V(S,w)]
-                feed_dict = {state_value.state: state, state_value.I_factor: I_factor,
-                             state_value.advantage_delta: advantage_delta}
-                _, loss_state = sess.run([state_value.optimizer, state_value.loss], feed_dict)
-
-                # Update the policy network weights theta <- theta + alpha*I*delta*grad[ln(theta)]
-                feed_dict = {policy.state: state, policy.I_factor: I_factor,
-                             policy.advantage_delta: advantage_delta}
                 if early_stopping:
-                    # Early stopping to prevent the network weights from changing after it is stable
-                    loss_policy = sess.run(policy.loss, feed_dict)
+                    # Early stopping to prevent the network weights from changing after it is stable: no gradient
+                    # ops at all, the frozen policy acts from NumPy
+                    with prof.phase('frozen_policy'):
+                        actions_distribution = frozen_policy(next_state)[0]
                 else:
-                  _, loss_policy = sess.run([policy.optimizer, policy.loss], feed_dict)
+                    # delta = R + gamma*V(S',w) - V(S,w) (R - V(S,w) at the end), then in the same run
+                    # w <- w + alpha*I*delta*grad[V(S,w)] and theta <- theta + alpha*I*delta*grad[ln(pi)],
+                    # and pi(*|S') under the new theta
+                    feed_dict = {policy.state: state, state_value.state: np.concatenate([state, next_state]),
+                                 train_step.next_state: next_state, train_step.reward: reward,
+                                 train_step.done: float(done), train_step.I_factor: I_factor}
+                    with prof.phase('train_step'):
+                        _, loss_policy, actions_distribution = sess.run(
+                            [train_step.train_ops, train_step.policy_loss, train_step.next_distribution], feed_dict)
+                    prof.count('updates')
 
                 if done:
+                    reward_stats.append(episode_rewards[episode])
                     if episode > 98:
-                        average_rewards = np.mean(episode_rewards[(episode - 99):episode + 1])
+                        average_rewards = reward_stats.mean(100)
 
-                    if np.mean(episode_rewards[(episode - 5):episode + 1]) > 475:
+                    if reward_stats.mean(6) > reward_stats.threshold and not early_stopping:
                         early_stopping = True
-
-                    print(
-                        "Episode {} Reward: {} Average over 100 episodes: {}".format(episode, episode_rewards[episode],
-                                                                                     round(average_rewards, 2)))
+                        frozen_policy = NumpyPolicy.from_tf1(sess, [(policy.W1, policy.b1), (policy.W2, policy.b2)],
+                                                             ['relu', 'linear'], head='softmax')
+
+                    prof.count('episodes')
+                    with prof.phase('logging'):
+                        metrics.scalars({'reward': episode_rewards[episode], 'average_reward': average_rewards},
+                                        step=episode)
+                        metrics.console("Episode {} Reward: {} Average over 100 episodes: {}", episode,
+                                        episode_rewards[episode], round(average_rewards, 2))
                     if average_rewards > 475:
-                        print(' Solved at episode: ' + str(episode))
+                        metrics.console(' Solved at episode: {}', episode, force=True)
                         solved = True
                     break
 
@@ -176,9 +291,203 @@ def run(discount_factor, policy_learning_rate, sv_learning_rate):
             rewards.append(episode_rewards[episode])
             mean_rewards.append(average_rewards)
             losses.append(loss_policy)
+            # intermediate results of a hyperparameter search trial, which stops when it is pruned
+            if report is not None and not report(episode, reward_stats.mean(100)):
+                break
+    metrics.close()
     return episode, rewards, mean_rewards, losses
 
 
+def _step_envs(sess, envs, policy, state_value, state, discount_factor):
+    '''
+        One tick of the vector env: the actions of all the envs are sampled from one batched policy pass. The time
+        limit does not end the task, so truncated episodes are bootstrapped from the value of their final
+        observation. Returns the actions, their probabilities, the next states, the rewards to learn from, the
+        episode ends and the env rewards.
+    '''
+    actions_distribution = np.atleast_2d(sess.run(policy.actions_distribution, {policy.state: state}))
+    actions = sample_categorical(actions_distribution)
+    next_state, reward, terminated, truncated, info = envs.step(actions)
+    ended = terminated | truncated
+    learn_reward = reward.astype(np.float64)
+    cut = truncated & ~terminated
+    if cut.any():
+        final_states = np.stack(info['final_observation'][cut])
+        learn_reward[cut] += discount_factor * sess.run(state_value.output, {state_value.state: final_states})[:, 0]
+    probs = actions_distribution[np.arange(len(actions)), actions]
+    return actions, probs, next_state, learn_reward, ended, reward
+
+
+def _record_episodes(ended, acc_reward, reward_stats, rewards, mean_rewards, losses, loss_policy, metrics):
+    '''
+        Record and log to metrics the episodes that just ended (acc_reward holds the reward of every env's running
+        episode). Every ended episode is recorded, and True is returned when the average over the last 100 episodes
+        passed the threshold at one of them.
+    '''
+    solved = False
+    for i in np.flatnonzero(ended):
+        reward_stats.append(acc_reward[i])
+        average_rewards = reward_stats.mean(100) if reward_stats.full(100) else 0.0
+        metrics.scalars({'reward': acc_reward[i], 'average_reward': average_rewards}, step=len(rewards))
+        metrics.console("Episode {} Reward: {} Average over 100 episodes: {}", len(rewards), acc_reward[i],
+                        round(average_rewards, 2))
+        rewards.append(acc_reward[i])
+        mean_rewards.append(average_rewards)
+        losses.append(loss_policy)
+        acc_reward[i] = 0
+        if not solved and average_rewards > reward_stats.threshold:
+            metrics.console(' Solved at episode: {}', len(rewards) - 1, force=True)
+            solved = True
+    return solved
+
+
+def run_a2c(discount_factor, policy_learning_rate, sv_learning_rate, n_envs=8, n_steps=5, max_episodes=5000,
+            report=None):
+    '''
+        Synchronous advantage actor-critic: n_envs CartPole envs are stepped together for n_steps, the actions of
+        all of them being sampled from one batched policy pass per tick, then both networks take one batched step
+        on the n-step returns of the whole rollout. Returns the same as run(), the episodes being counted in the
+        order they end across the envs.
+    '''
+    metrics = MetricsSink()
+    envs = gym.vector.make('CartPole-v1', num_envs=n_envs, asynchronous=False)
+    np.random.seed(SEED)
+    tf.set_random_seed(SEED)
+    rewards, mean_rewards, losses = [], [], []
+    state_size = 4
+    action_size = envs.single_action_space.n
+
+    tf.reset_default_graph()
+    policy = PolicyNetwork(state_size, action_size, policy_learning_rate)
+    state_value = ValueNetwork(state_size, sv_learning_rate)
+    train_step = A2CStep(policy, state_value)
+
+    # the rollout, (n_steps, n_envs) per quantity
+    states = np.zeros((n_steps, n_envs, state_size), dtype=np.float32)
+    actions = np.zeros((n_steps, n_envs), dtype=np.int64)
+    step_rewards = np.zeros((n_steps, n_envs))
+    dones = np.zeros((n_steps, n_envs))
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        reward_stats = RollingStats(windows=(100,), threshold=475)
+        acc_reward = np.zeros(n_envs)
+        loss_policy = 0.0
+        solved = False
+        state, _ = envs.reset(seed=SEED)
+        while not solved and len(rewards) < max_episodes:
+            for t in range(n_steps):
+                states[t] = state
+                actions[t], _, state, step_rewards[t], dones[t], reward = _step_envs(
+                    sess, envs, policy, state_value, state, discount_factor)
+                acc_reward += reward
+                if _record_episodes(dones[t], acc_reward, reward_stats, rewards, mean_rewards, losses, loss_policy,
+                                    metrics):
+                    solved = True
+                    break
+            if solved:
+                break
+
+            # n-step returns of the rollout, bootstrapped from V(S_n), and one update of both networks
+            last_values = sess.run(state_value.output, {state_value.state: state})[:, 0]
+            returns = n_step_returns(step_rewards, dones, last_values, discount_factor)
+            flat_states = states.reshape(-1, state_size)
+            feed_dict = {policy.state: flat_states, state_value.state: flat_states,
+                         train_step.actions: actions.ravel(), train_step.returns: returns.ravel()}
+            _, loss_policy = sess.run([train_step.train_ops, train_step.policy_loss], feed_dict)
+            if report is not None and not report(len(rewards), reward_stats.mean(100)):
+                break
+    envs.close()
+    metrics.close()
+    return len(rewards) - 1, rewards, mean_rewards, losses
+
+
+def run_ppo(discount_factor, policy_learning_rate, sv_learning_rate, n_envs=8, n_steps=128, n_epochs=4,
+            batch_size=256, gae_lambda=0.95, clip_ratio=0.2, max_episodes=5000, report=None):
+    '''
+        Clipped-ratio policy optimization (PPO) on a RolloutBuffer: n_envs CartPole envs collect n_steps ticks
+        with the current policy, the GAE advantages are computed in one backward scan, and the rollout is reused
+        for n_epochs shuffled epochs of batch_size minibatches (see PPOStep). Returns the same as run().
+    '''
+    metrics = MetricsSink()
+    envs = gym.vector.make('CartPole-v1', num_envs=n_envs, asynchronous=False)
+    np.random.seed(SEED)
+    tf.set_random_seed(SEED)
+    rewards, mean_rewards, losses = [], [], []
+    state_size = 4
+    action_size = envs.single_action_space.n
+
+    tf.reset_default_graph()
+    policy = PolicyNetwork(state_size, action_size, policy_learning_rate)
+    state_value = ValueNetwork(state_size, sv_learning_rate)
+    train_step = PPOStep(policy, state_value, clip_ratio)
+    buffer = RolloutBuffer(n_steps, n_envs, state_size)
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        reward_stats = RollingStats(windows=(100,), threshold=475)
+        acc_reward = np.zeros(n_envs)
+        loss_policy = 0.0
+        solved = False
+        state, _ = envs.reset(seed=SEED)
+        while not solved and len(rewards) < max_episodes:
+            buffer.reset()
+            while not buffer.full():
+                values = sess.run(state_value.output, {state_value.state: state})[:, 0]
+                actions, probs, next_state, learn_reward, dones, reward = _step_envs(
+                    sess, envs, policy, state_value, state, discount_factor)
+                buffer.add(state, actions, learn_reward, dones, values, np.log(probs))
+                state = next_state
+                acc_reward += reward
+                if _record_episodes(dones, acc_reward, reward_stats, rewards, mean_rewards, losses, loss_policy,
+                                    metrics):
+                    solved = True
+                    break
+            if solved:
+                break
+
+            last_values = sess.run(state_value.output, {state_value.state: state})[:, 0]
+            buffer.compute_advantages(last_values, discount_factor, gae_lambda)
+            for batch in buffer.minibatches(batch_size, n_epochs):
+                feed_dict = {policy.state: batch['states'], state_value.state: batch['states'],
+                             train_step.actions: batch['actions'], train_step.old_log_probs: batch['log_probs'],
+                             train_step.advantages: batch['advantages'], train_step.returns: batch['returns']}
+                _, loss_policy = sess.run([train_step.train_ops, train_step.policy_loss], feed_dict)
+            if report is not None and not report(len(rewards), reward_stats.mean(100)):
+                break
+    envs.close()
+    metrics.close()
+    return len(rewards) - 1, rewards, mean_rewards, losses
+
+
+def search_trial(config, report):
+    '''
+        One trial of search(): the training of config['algorithm'] (actor_critic by default) with the discount
+        factor and learning rates of config
+    '''
+    global SEED
+    SEED = config.get('seed', 42)
+    train_fn = {"actor_critic": run, "a2c": run_a2c, "ppo": run_ppo}[config.get('algorithm', 'actor_critic')]
+    _, rewards, mean_rewards, losses = train_fn(config['discount_factor'], config['policy_learning_rate'],
+                                                config['sv_learning_rate'], report=report)
+    return mean_rewards[-1] if mean_rewards else 0.0
+
+
+def search(algorithm='actor_critic', n_workers=None):
+    '''
+        Sweep the discount factor and the learning rates of an algorithm with a worker process per core, pruning
+        the configs behind at 100, 300 and 900 episodes (see common.hparam_search.successive_halving). The table
+        is written to search_<algorithm>.csv.
+    '''
+    configs = grid(algorithm=[algorithm], discount_factor=[0.95, 0.99], policy_learning_rate=[0.001, 0.003, 0.01],
+                   sv_learning_rate=[0.0007, 0.002, 0.007])
+    results = successive_halving('actor_critic:search_trial', configs, rungs=[100, 300, 900], n_workers=n_workers,
+                                 paths=[os.path.dirname(os.path.abspath(__file__))],
+                                 out_path='search_{}.csv'.format(algorithm))
+    print(results.to_string())
+    return results
+
+
 if __name__ == '__main__':
     SEED = 42
 
@@ -186,10 +495,23 @@ if __name__ == '__main__':
     optimal_policy_lr = 0.01
 
     optimal_df = 0.99
+    # "actor_critic" (one-transition updates), "a2c" (synchronous multi-env) or "ppo" (clipped multi-epoch)
     algorithm_name = "actor_critic"
-    last_episode, rewards, mean_rewards, losses = run(discount_factor=optimal_df,
-                                                      policy_learning_rate=optimal_policy_lr,
-                                                      sv_learning_rate=optimal_sv_lr)
+    # the rollout modes average their gradients, with the one-transition learning rates the policy collapses
+    if algorithm_name == "a2c":
+        optimal_sv_lr = optimal_policy_lr = 0.002
+    elif algorithm_name == "ppo":
+        optimal_sv_lr = optimal_policy_lr = 0.003
+    train_fn = {"actor_critic": run, "a2c": run_a2c, "ppo": run_ppo}[algorithm_name]
+    # time the phases of run() (see common.profiler): a table at the end and a Chrome trace
+    profile = False
+    extra_args = {'profiler': Profiler()} if profile and algorithm_name == "actor_critic" else {}
+    last_episode, rewards, mean_rewards, losses = train_fn(discount_factor=optimal_df,
+                                                           policy_learning_rate=optimal_policy_lr,
+                                                           sv_learning_rate=optimal_sv_lr, **extra_args)
+    if extra_args:
+        print(extra_args['profiler'].report())
+        extra_args['profiler'].save_chrome_trace('{}_trace.json'.format(algorithm_name))
     with open('optimal_{}.npy'.format(algorithm_name), 'wb') as f:
         np.save(f, last_episode)
         np.save(f, rewards)
@@ -1,7 +1,14 @@
+import os
+import sys
 import gymnasium as gym
 import numpy as np
 import tensorflow.compat.v1 as tf
-import collections
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.episode_buffer import EpisodeBuffer
+from common.metrics import MetricsSink
+from common.policy_runtime import sample_categorical
+from common.rollout_buffer import RolloutBuffer
 
 # optimized for Tf2
 tf.disable_v2_behavior()
@@ -18,8 +25,8 @@ class PolicyNetwork:
 
         with tf.variable_scope(name):
             self.state = tf.placeholder(tf.float32, [None, self.state_size], name="state")
-            self.action = tf.placeholder(tf.int32, [self.action_size], name="action")
-            self.delta = tf.placeholder(tf.float32, name="delta")  # Change R_t to delta for advantage
+            self.action = tf.placeholder(tf.int32, [None, self.action_size], name="action")
+            self.delta = tf.placeholder(tf.float32, [None], name="delta")  # Change R_t to delta for advantage
 
             tf2_initializer = tf.keras.initializers.glorot_normal(seed=0)
             self.W1 = tf.get_variable("W1", [self.state_size, 12], initializer=tf2_initializer)
@@ -43,7 +50,7 @@ class ValueNetwork:
 
         with tf.variable_scope(name):
             self.state = tf.placeholder(tf.float32, [None, self.state_size], name="state")
-            self.R_t = tf.placeholder(tf.float32, name="total_rewards")
+            self.R_t = tf.placeholder(tf.float32, [None, 1], name="total_rewards")
 
             tf2_initializer = tf.keras.initializers.glorot_normal(seed=0)
             self.W1 = tf.get_variable("W1", [self.state_size, 12], initializer=tf2_initializer)
@@ -58,14 +65,42 @@ class ValueNetwork:
             self.loss = tf.reduce_mean(tf.square(self.R_t - self.value))
             self.optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate).minimize(self.loss)
 
+# Clipped-ratio (PPO) update of the policy and the baseline on a minibatch of a rollout
+class PPOStep:
+    def __init__(self, policy, value_network, clip_ratio=0.2, name='ppo_step'):
+        '''
+            Feed policy.state, value_network.state and policy.action (one-hot) with the minibatch, and the
+            placeholders with the log-probabilities of the actions under the policy that collected them, the
+            advantages and the returns. The clipped ratio keeps the policy close to the collecting one while the
+            rollout is reused for several epochs.
+        '''
+        with tf.variable_scope(name):
+            self.old_log_probs = tf.placeholder(tf.float32, [None], name="old_log_probs")
+            self.advantages = tf.placeholder(tf.float32, [None], name="advantages")
+            self.returns = tf.placeholder(tf.float32, [None], name="returns")
+
+            log_probs = -tf.nn.softmax_cross_entropy_with_logits_v2(logits=policy.output, labels=policy.action)
+            ratio = tf.exp(log_probs - self.old_log_probs)
+            clipped_ratio = tf.clip_by_value(ratio, 1.0 - clip_ratio, 1.0 + clip_ratio)
+            self.policy_loss = -tf.reduce_mean(tf.minimum(ratio * self.advantages, clipped_ratio * self.advantages))
+            self.value_loss = tf.reduce_mean(tf.square(self.returns - value_network.value[:, 0]))
+            self.train_ops = [
+                tf.train.AdamOptimizer(learning_rate=value_network.learning_rate).minimize(
+                    self.value_loss, var_list=[value_network.W1, value_network.b1, value_network.W2, value_network.b2]),
+                tf.train.AdamOptimizer(learning_rate=policy.learning_rate).minimize(
+                    self.policy_loss, var_list=[policy.W1, policy.b1, policy.W2, policy.b2])]
+
 def run():
+    # rate-limited progress line, see common.metrics
+    metrics = MetricsSink()
     # Define hyperparameters
     state_size = 4
     action_size = env.action_space.n
     max_episodes = 5000
     max_steps = 501
     discount_factor = 0.99
-    learning_rate = 0.0004
+    # one optimizer step per episode (instead of one per transition) needs a larger step size
+    learning_rate = 0.01
     render = False
 
     # Initialize the policy and value networks
@@ -76,14 +111,15 @@ def run():
     with tf.Session() as sess:
         sess.run(tf.global_variables_initializer())
         solved = False
-        Transition = collections.namedtuple("Transition", ["state", "action", "reward", "next_state", "done"])
+        episode_buffer = EpisodeBuffer(max_steps, state_size)
+        one_hot = np.eye(action_size)
         episode_rewards = np.zeros(max_episodes)
         average_rewards = 0.0
 
         for episode in range(max_episodes):
             state, _ = env.reset()
             state = state.reshape([1, state_size])
-            episode_transitions = []
+            episode_buffer.reset()
 
             for step in range(max_steps):
                 # Policy action
@@ -95,17 +131,16 @@ def run():
                 if render:
                     env.render()
 
-                action_one_hot = np.zeros(action_size)
-                action_one_hot[action] = 1
-                episode_transitions.append(Transition(state=state, action=action_one_hot, reward=reward, next_state=next_state, done=done))
+                episode_buffer.add(state, action, reward)
                 episode_rewards[episode] += reward
 
                 if done:
                     if episode > 98:
                         average_rewards = np.mean(episode_rewards[(episode - 99):episode+1])
-                    print("Episode {} Reward: {} Average over 100 episodes: {}".format(episode, episode_rewards[episode], round(average_rewards, 2)))
+                    metrics.console("Episode {} Reward: {} Average over 100 episodes: {}", episode, episode_rewards[episode],
+                                    round(average_rewards, 2))
                     if average_rewards > 475:
-                        print(' Solved at episode: ' + str(episode))
+                        metrics.console(' Solved at episode: {}', episode, force=True)
                         solved = True
                     break
                 state = next_state
@@ -113,15 +148,102 @@ def run():
             if solved:
                 break
 
-            # Update policy and value networks
-            for t, transition in enumerate(episode_transitions):
-                total_discounted_return = sum(discount_factor ** i * t.reward for i, t in enumerate(episode_transitions[t:]))
-                value_curr_state = sess.run(value_network.value, {value_network.state: transition.state})
-                advantage = total_discounted_return - value_curr_state
-                feed_dict_policy = {policy.state: transition.state, policy.delta: advantage, policy.action: transition.action}
-                _, policy_loss = sess.run([policy.optimizer, policy.loss], feed_dict_policy)
-                feed_dict_value = {value_network.state: transition.state, value_network.R_t: total_discounted_return}
-                _, value_loss = sess.run([value_network.optimizer, value_network.loss], feed_dict_value)
+            # Update policy and value networks: one batched pass for the baseline, then both optimizer steps in one
+            # call over the whole episode
+            total_discounted_return = episode_buffer.returns(discount_factor)
+            states = episode_buffer.states
+            value_curr_state = sess.run(value_network.value, {value_network.state: states})
+            advantage = total_discounted_return - value_curr_state[:, 0]
+            feed_dict = {policy.state: states, policy.delta: advantage, policy.action: one_hot[episode_buffer.actions],
+                         value_network.state: states, value_network.R_t: total_discounted_return[:, None]}
+            _, policy_loss, _, value_loss = sess.run([policy.optimizer, policy.loss, value_network.optimizer,
+                                                      value_network.loss], feed_dict)
+    metrics.close()
+
+def run_ppo(n_envs=8, n_steps=128, n_epochs=4, batch_size=256, gae_lambda=0.95, clip_ratio=0.2, max_episodes=5000):
+    '''
+        The same networks trained on a RolloutBuffer instead of one episode at a time: n_envs CartPole envs collect
+        n_steps ticks with one batched policy pass per tick, the GAE advantages against the baseline are computed in
+        one backward scan (gae_lambda=1 gives the Monte Carlo advantages of run()), and the rollout is reused for
+        n_epochs shuffled epochs of batch_size minibatches (see PPOStep). Returns the episode rewards.
+    '''
+    metrics = MetricsSink()
+    state_size = 4
+    action_size = env.action_space.n
+    discount_factor = 0.99
+    # the minibatch gradients are averaged over many transitions, 0.01 makes the policy collapse
+    learning_rate = 0.003
+
+    tf.reset_default_graph()
+    policy = PolicyNetwork(state_size, action_size, learning_rate)
+    value_network = ValueNetwork(state_size, learning_rate)
+    train_step = PPOStep(policy, value_network, clip_ratio)
+    buffer = RolloutBuffer(n_steps, n_envs, state_size)
+    one_hot = np.eye(action_size)
+
+    # stepped one by one but acting together, each env is reset as soon as its episode ends
+    envs = [gym.make('CartPole-v1') for _ in range(n_envs)]
+    state = np.stack([e.reset(seed=i)[0] for i, e in enumerate(envs)])
+    episode_rewards = []
+    acc_reward = np.zeros(n_envs)
+    average_rewards = 0.0
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        solved = False
+        while not solved and len(episode_rewards) < max_episodes:
+            buffer.reset()
+            while not buffer.full():
+                actions_distribution, values = sess.run([policy.actions_distribution, value_network.value],
+                                                        {policy.state: state, value_network.state: state})
+                actions_distribution = np.atleast_2d(actions_distribution)
+                actions = sample_categorical(actions_distribution)
+                next_state = np.empty_like(state)
+                rewards = np.zeros(n_envs)
+                dones = np.zeros(n_envs, dtype=bool)
+                for i, e in enumerate(envs):
+                    next_state[i], rewards[i], terminated, truncated, _ = e.step(actions[i])
+                    acc_reward[i] += rewards[i]
+                    if truncated and not terminated:
+                        # the time limit does not end the task, bootstrap from the value of the final observation
+                        rewards[i] += discount_factor * sess.run(value_network.value,
+                                                                 {value_network.state: next_state[i:i + 1]})[0, 0]
+                    if terminated or truncated:
+                        dones[i] = True
+                        episode_rewards.append(acc_reward[i])
+                        if len(episode_rewards) >= 100:
+                            average_rewards = np.mean(episode_rewards[-100:])
+                        metrics.console("Episode {} Reward: {} Average over 100 episodes: {}", len(episode_rewards) - 1,
+                                        acc_reward[i], round(average_rewards, 2))
+                        if not solved and average_rewards > 475:
+                            metrics.console(' Solved at episode: {}', len(episode_rewards) - 1, force=True)
+                            solved = True
+                        acc_reward[i] = 0
+                        next_state[i], _ = e.reset()
+                log_probs = np.log(actions_distribution[np.arange(n_envs), actions])
+                buffer.add(state, actions, rewards, dones, values[:, 0], log_probs)
+                state = next_state
+                if solved:
+                    break
+            if solved:
+                break
+
+            last_values = sess.run(value_network.value, {value_network.state: state})[:, 0]
+            buffer.compute_advantages(last_values, discount_factor, gae_lambda)
+            for batch in buffer.minibatches(batch_size, n_epochs):
+                feed_dict = {policy.state: batch['states'], value_network.state: batch['states'],
+                             policy.action: one_hot[batch['actions']], train_step.old_log_probs: batch['log_probs'],
+                             train_step.advantages: batch['advantages'], train_step.returns: batch['returns']}
+                sess.run(train_step.train_ops, feed_dict)
+    for e in envs:
+        e.close()
+    metrics.close()
+    return episode_rewards
 
 if __name__ == '__main__':
-    run()
+    # "reinforce" (one update per episode) or "ppo" (rollout buffer, clipped multi-epoch updates)
+    mode = "reinforce"
+    if mode == "ppo":
+        run_ppo()
+    else:
+        run()
@@ -0,0 +1,264 @@
+import os
+import sys
+import gym
+import numpy as np
+import tensorflow.compat.v1 as tf
+import matplotlib.pyplot as plt
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.rolling_stats import RollingStats
+from common.episode_buffer import n_step_returns
+from common.metrics import MetricsSink
+
+# optimized for Tf2
+tf.disable_v2_behavior()
+
+algorithm_name = "multi_task_a2c"
+
+# the source tasks of the transfer experiments
+TASKS = ('CartPole-v1', 'Acrobot-v1', 'MountainCar-v0')
+
+
+class MultiTaskEnvs:
+    '''
+        n_envs copies of every task in env_ids, stepped together as one batch of len(env_ids) * n_envs envs (task i
+        owning the rows of slices[i]). The observations are written into one preallocated batch, states, padded
+        with zeros to the largest observation size, and action_mask marks the actions of every row's task among
+        the largest action space, for the masking of the policy. state_size and action_size fix larger sizes, e.g.
+        those of the source tasks for a transfer to a single target task.
+    '''
+
+    def __init__(self, env_ids=TASKS, n_envs=4, seed=0, state_size=None, action_size=None):
+        self.env_ids = list(env_ids)
+        self.seed = seed
+        self.envs = [gym.vector.make(env_id, num_envs=n_envs, asynchronous=False) for env_id in self.env_ids]
+        self.state_dims = [envs.single_observation_space.shape[0] for envs in self.envs]
+        self.action_sizes = [envs.single_action_space.n for envs in self.envs]
+        self.state_size = max(self.state_dims) if state_size is None else state_size
+        self.action_size = max(self.action_sizes) if action_size is None else action_size
+        assert self.state_size >= max(self.state_dims) and self.action_size >= max(self.action_sizes), \
+            "The padded sizes are smaller than a task's"
+        self.n_envs = n_envs * len(self.envs)
+        self.slices = [slice(i * n_envs, (i + 1) * n_envs) for i in range(len(self.envs))]
+        self.task_ids = np.repeat(np.arange(len(self.envs)), n_envs)
+
+        self.states = np.zeros((self.n_envs, self.state_size), dtype=np.float32)
+        self.final_states = np.zeros((self.n_envs, self.state_size), dtype=np.float32)
+        self.rewards = np.zeros(self.n_envs)
+        self.terminated = np.zeros(self.n_envs, dtype=bool)
+        self.truncated = np.zeros(self.n_envs, dtype=bool)
+        self.action_mask = np.zeros((self.n_envs, self.action_size), dtype=np.float32)
+        for sl, n_actions in zip(self.slices, self.action_sizes):
+            self.action_mask[sl, :n_actions] = 1
+
+    def reset(self):
+        for i, (envs, sl) in enumerate(zip(self.envs, self.slices)):
+            obs, _ = envs.reset(seed=self.seed + 1000 * i)
+            self.states[sl, :self.state_dims[i]] = obs
+        return self.states
+
+    def step(self, actions):
+        '''
+            Step every task with its rows of actions. The next states overwrite states in place (an ended episode
+            is reset by its vector env), and final_states holds the last observation of the rows whose episode
+            was truncated by the time limit, to bootstrap from. Returns states, rewards, terminated and truncated,
+            the preallocated arrays themselves.
+        '''
+        for i, (envs, sl) in enumerate(zip(self.envs, self.slices)):
+            dim = self.state_dims[i]
+            obs, reward, terminated, truncated, info = envs.step(actions[sl])
+            self.states[sl, :dim] = obs
+            self.rewards[sl], self.terminated[sl], self.truncated[sl] = reward, terminated, truncated
+            cut = truncated & ~terminated
+            if cut.any():
+                self.final_states[sl][cut, :dim] = np.stack(info['final_observation'][cut])
+        return self.states, self.rewards, self.terminated, self.truncated
+
+    def close(self):
+        for envs in self.envs:
+            envs.close()
+
+
+# Actor over the padded states of all the tasks, masked to the actions of each row's task
+class MaskedPolicyNetwork:
+    def __init__(self, state_size, action_size, learning_rate, name='policy_network'):
+        self.state_size = state_size
+        self.action_size = action_size
+        self.learning_rate = learning_rate
+
+        with tf.variable_scope(name):
+            self.state = tf.placeholder(tf.float32, [None, self.state_size], name="state")
+            self.action_mask = tf.placeholder(tf.float32, [None, self.action_size], name="action_mask")
+
+            tf2_initializer = tf.keras.initializers.glorot_normal(seed=0)
+            self.W1 = tf.get_variable("W1", [self.state_size, 32], initializer=tf2_initializer)
+            self.b1 = tf.get_variable("b1", [32], initializer=tf2_initializer)
+            self.W2 = tf.get_variable("W2", [32, self.action_size], initializer=tf2_initializer)
+            self.b2 = tf.get_variable("b2", [self.action_size], initializer=tf2_initializer)
+
+            self.Z1 = tf.add(tf.matmul(self.state, self.W1), self.b1)
+            self.A1 = tf.nn.relu(self.Z1)
+            self.output = tf.add(tf.matmul(self.A1, self.W2), self.b2)
+            self.variables = [self.W1, self.b1, self.W2, self.b2]
+
+            # the actions outside a row's task get a logit of -1e9: a probability of exactly 0 after the softmax,
+            # so they are never sampled and take no part in the log-probabilities
+            self.masked_logits = tf.where(self.action_mask > 0, self.output, tf.fill(tf.shape(self.output), -1e9))
+            self.actions_distribution = tf.nn.softmax(self.masked_logits)
+            self.actions_log_probs = tf.nn.log_softmax(self.masked_logits)
+            self.sampled_actions = tf.squeeze(tf.random.categorical(self.masked_logits, 1), axis=1)
+
+
+# Critic
+class ValueNetwork:
+    def __init__(self, state_size, learning_rate, name='state_value_network'):
+        self.state_size = state_size
+        self.learning_rate = learning_rate
+
+        with tf.variable_scope(name):
+            self.state = tf.placeholder(tf.float32, [None, self.state_size], name="state")
+
+            tf2_initializer = tf.keras.initializers.glorot_normal(seed=0)
+            self.W1 = tf.get_variable("W1", [self.state_size, 64], initializer=tf2_initializer)
+            self.b1 = tf.get_variable("b1", [64], initializer=tf2_initializer)
+            self.W2 = tf.get_variable("W2", [64, 16], initializer=tf2_initializer)
+            self.b2 = tf.get_variable("b2", [16], initializer=tf2_initializer)
+            self.W3 = tf.get_variable("W3", [16, 1], initializer=tf2_initializer)
+            self.b3 = tf.get_variable("b3", [1], initializer=tf2_initializer)
+
+            self.Z1 = tf.add(tf.matmul(self.state, self.W1), self.b1)
+            self.A1 = tf.nn.relu(self.Z1)
+            self.Z2 = tf.add(tf.matmul(self.A1, self.W2), self.b2)
+            self.A2 = tf.nn.relu(self.Z2)
+            self.output = tf.add(tf.matmul(self.A2, self.W3), self.b3)
+            self.variables = [self.W1, self.b1, self.W2, self.b2, self.W3, self.b3]
+
+
+# Batched update of the actor and the critic over a rollout of all the tasks
+class MultiTaskA2CStep:
+    def __init__(self, policy, state_value, name='a2c_step'):
+        '''
+            Feed policy.state and state_value.state with the padded states of a rollout, policy.action_mask with
+            their masks, actions with the actions taken and returns with their n-step returns. The advantages are
+            formed in-graph and both networks take one step on the mean of their losses over every task's rows.
+        '''
+        with tf.variable_scope(name):
+            self.actions = tf.placeholder(tf.int32, [None], name="actions")
+            self.returns = tf.placeholder(tf.float32, [None], name="returns")
+
+            values = state_value.output[:, 0]
+            self.advantages = tf.stop_gradient(self.returns - values)
+            log_probs = tf.gather(policy.actions_log_probs, self.actions, batch_dims=1)
+            self.policy_loss = -tf.reduce_mean(self.advantages * log_probs)
+            self.value_loss = tf.reduce_mean(tf.square(self.returns - values))
+            self.train_ops = [
+                tf.train.AdamOptimizer(learning_rate=state_value.learning_rate).minimize(
+                    self.value_loss, var_list=state_value.variables),
+                tf.train.AdamOptimizer(learning_rate=policy.learning_rate).minimize(
+                    self.policy_loss, var_list=policy.variables)]
+
+
+def run_multi_task(discount_factor, policy_learning_rate, sv_learning_rate, env_ids=TASKS, n_envs=4, n_steps=5,
+                   n_updates=20000, init_params=None, seed=0):
+    '''
+        Synchronous advantage actor-critic on all the tasks of env_ids at once (see MultiTaskEnvs): every tick, the
+        actions of all the envs are sampled by one masked policy pass, and after n_steps ticks both networks take
+        one batched step on the rollout of every task. init_params (the params returned by an earlier run) warm
+        starts the networks for the transfer experiments, the states and actions being padded to its sizes.
+
+        Returns, per env id, the rewards of its episodes and their average over the last 100, the policy loss after
+        every update, and the params: the values of the policy's and the critic's variables.
+    '''
+    # per-task episode scalars and the rate-limited progress line, see common.metrics
+    metrics = MetricsSink()
+    np.random.seed(seed)
+    tf.reset_default_graph()
+    tf.set_random_seed(seed)
+    if init_params is None:
+        envs = MultiTaskEnvs(env_ids, n_envs, seed)
+    else:
+        envs = MultiTaskEnvs(env_ids, n_envs, seed, state_size=init_params['policy'][0].shape[0],
+                             action_size=init_params['policy'][-1].shape[0])
+    policy = MaskedPolicyNetwork(envs.state_size, envs.action_size, policy_learning_rate)
+    state_value = ValueNetwork(envs.state_size, sv_learning_rate)
+    train_step = MultiTaskA2CStep(policy, state_value)
+
+    # the rollout, (n_steps, number of envs) per quantity
+    states = np.zeros((n_steps, envs.n_envs, envs.state_size), dtype=np.float32)
+    action_masks = np.broadcast_to(envs.action_mask, (n_steps,) + envs.action_mask.shape).reshape(-1, envs.action_size)
+    actions = np.zeros((n_steps, envs.n_envs), dtype=np.int64)
+    step_rewards = np.zeros((n_steps, envs.n_envs))
+    dones = np.zeros((n_steps, envs.n_envs))
+
+    rewards = {env_id: [] for env_id in envs.env_ids}
+    mean_rewards = {env_id: [] for env_id in envs.env_ids}
+    losses = []
+    reward_stats = [RollingStats(windows=(100,)) for _ in envs.env_ids]
+    acc_reward = np.zeros(envs.n_envs)
+    progress = "Update {} " + " ".join(env_id + ": {:.1f}" for env_id in envs.env_ids)
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        if init_params is not None:
+            sess.run([var.assign(value) for var, value in zip(policy.variables + state_value.variables,
+                                                              init_params['policy'] + init_params['state_value'])])
+        state = envs.reset()
+        for update in range(n_updates):
+            for t in range(n_steps):
+                states[t] = state
+                actions[t] = sess.run(policy.sampled_actions, {policy.state: state,
+                                                               policy.action_mask: envs.action_mask})
+                state, reward, terminated, truncated = envs.step(actions[t])
+                acc_reward += reward
+                # the time limit does not end the task: truncated episodes bootstrap from their final state
+                step_rewards[t] = reward
+                cut = truncated & ~terminated
+                if cut.any():
+                    step_rewards[t, cut] += discount_factor * sess.run(
+                        state_value.output, {state_value.state: envs.final_states[cut]})[:, 0]
+                dones[t] = terminated | truncated
+
+                for i in np.flatnonzero(dones[t]):
+                    task = envs.task_ids[i]
+                    env_id = envs.env_ids[task]
+                    reward_stats[task].append(acc_reward[i])
+                    rewards[env_id].append(acc_reward[i])
+                    mean_rewards[env_id].append(reward_stats[task].mean(100))
+                    metrics.scalars({env_id + '/reward': acc_reward[i],
+                                     env_id + '/average_reward': mean_rewards[env_id][-1]},
+                                    step=len(rewards[env_id]))
+                    acc_reward[i] = 0
+
+            # n-step returns of the rollout, bootstrapped from V(S_n), and one update of both networks
+            last_values = sess.run(state_value.output, {state_value.state: state})[:, 0]
+            returns = n_step_returns(step_rewards, dones, last_values, discount_factor)
+            flat_states = states.reshape(-1, envs.state_size)
+            feed_dict = {policy.state: flat_states, policy.action_mask: action_masks, state_value.state: flat_states,
+                         train_step.actions: actions.ravel(), train_step.returns: returns.ravel()}
+            _, loss_policy = sess.run([train_step.train_ops, train_step.policy_loss], feed_dict)
+            losses.append(loss_policy)
+            metrics.console(progress, update, *[stats.mean(100) for stats in reward_stats])
+        params = {'policy': sess.run(policy.variables), 'state_value': sess.run(state_value.variables)}
+    envs.close()
+    metrics.close()
+    return rewards, mean_rewards, losses, params
+
+
+def plot_tasks(mean_rewards, path=None):
+    plt.figure()
+    for env_id, curve in mean_rewards.items():
+        plt.plot(curve, label=env_id)
+    plt.xlabel('episode')
+    plt.ylabel('average reward over 100 episodes')
+    plt.legend()
+    if path is not None:
+        plt.savefig(path)
+    plt.show()
+
+
+if __name__ == '__main__':
+    # all the source tasks trained together, then the params kept for the fine-tuning on a target task
+    rewards, mean_rewards, losses, params = run_multi_task(discount_factor=0.99, policy_learning_rate=0.002,
+                                                           sv_learning_rate=0.002)
+    np.savez('{}_params.npz'.format(algorithm_name), *(params['policy'] + params['state_value']))
+    plot_tasks(mean_rewards, '{}.png'.format(algorithm_name))